@@ -423,9 +423,11 @@ class InvoiceLineItemSerializer(
     adjustments = serializers.SerializerMethodField()
 
     def get_adjustments(self, obj) -> InvoiceLineItemAdjustmentSerializer(many=True):
-        return InvoiceLineItemAdjustmentSerializer(
-            obj.adjustments.all(), many=True
-        ).data
+        try:
+            adjustments = obj.draft_adjustments
+        except AttributeError:
+            adjustments = obj.adjustments.all()
+        return InvoiceLineItemAdjustmentSerializer(adjustments, many=True).data
 
     def get_subscription_filters(
         self, obj
@@ -6,14 +6,15 @@ import logging
 import operator
 import re
 import uuid
+from datetime import timedelta
 from decimal import Decimal
 from functools import reduce
 from itertools import chain
 from typing import Optional
 
+import orjson
 import posthog
-import pytz
-from dateutil import parser
+from asgiref.sync import sync_to_async
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.db.models import (
@@ -31,7 +32,12 @@ from django.db.models import (
 )
 from django.db.models.functions import Coalesce
 from django.db.utils import IntegrityError
-from django.http import HttpRequest, HttpResponseBadRequest, JsonResponse
+from django.http import (
+    HttpRequest,
+    HttpResponseBadRequest,
+    HttpResponseNotAllowed,
+    JsonResponse,
+)
 from django.views.decorators.csrf import csrf_exempt
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import (
@@ -92,6 +98,7 @@ from api.serializers.nonmodel_serializers import (
 )
 from metering_billing.auth.auth_utils import (
     PermissionPolicyMixin,
+    async_fast_api_key_validation_and_cache,
     fast_api_key_validation_and_cache,
 )
 from metering_billing.exceptions import (
@@ -103,7 +110,13 @@ from metering_billing.exceptions import (
 from metering_billing.exceptions.exceptions import InvalidOperation, NotFoundException
 from metering_billing.invoice import generate_invoice
 from metering_billing.invoice_pdf import get_invoice_presigned_url
+from metering_billing.kafka.async_producer import AsyncProducer
+from metering_billing.kafka.direct_ingest import DirectEventWriter
 from metering_billing.kafka.producer import Producer
+from metering_billing.kafka.usage_counters import (
+    get_realtime_usage,
+    seed_realtime_usage,
+)
 from metering_billing.models import (
     ComponentChargeRecord,
     Customer,
@@ -149,6 +162,7 @@ from metering_billing.utils import (
     make_all_dates_times_strings,
     make_all_decimals_floats,
     now_utc,
+    parse_event_timestamp,
 )
 from metering_billing.utils.enums import (
     CUSTOMER_BALANCE_ADJUSTMENT_STATUS,
@@ -172,8 +186,12 @@ logger = logging.getLogger("django.server")
 USE_KAFKA = settings.USE_KAFKA
 if USE_KAFKA:
     kafka_producer = Producer()
+    async_kafka_producer = AsyncProducer()
+    direct_event_writer = None
 else:
     kafka_producer = None
+    async_kafka_producer = None
+    direct_event_writer = DirectEventWriter()
 
 logger = logging.getLogger("django.server")
 
@@ -344,8 +362,6 @@ class CustomerViewSet(PermissionPolicyMixin, viewsets.ModelViewSet):
                 ),
             )
             serializer = DraftInvoiceSerializer(invoices, many=True).data
-            for invoice in invoices:
-                invoice.delete()
             response = {"invoices": serializer or []}
         return Response(response, status=status.HTTP_200_OK)
 
@@ -1975,7 +1991,13 @@ class MetricAccessView(APIView):
                     else 0
                 )
                 total_limit = tiers[-1].range_end
-                current_usage = metric.get_billing_record_current_usage(billing_record)
+                current_usage = get_realtime_usage(metric, billing_record)
+                if current_usage is None:
+                    current_usage = seed_realtime_usage(
+                        metric,
+                        billing_record,
+                        lambda: metric.get_billing_record_current_usage(billing_record),
+                    )
                 single_sr_dict["metric_usage"] = current_usage
                 single_sr_dict["metric_free_limit"] = free_limit
                 single_sr_dict["metric_total_limit"] = total_limit
@@ -2197,9 +2219,9 @@ def load_event(request: HttpRequest) -> Optional[dict]:
     """
     if request.content_type == "application/json":
         try:
-            event_data = json.loads(request.body)
+            event_data = orjson.loads(request.body)
             return event_data
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(e)
             # if not, it's probably base64 encoded from other libraries
             event_data = json.loads(
@@ -2260,20 +2282,83 @@ def track_event(request):
     else:
         organization_pk = result
 
+    event_list, error_response = get_event_list(request)
+    if error_response:
+        return error_response
+    events_to_write, bad_events = validate_events(event_list, organization_pk)
+    if kafka_producer:
+        if events_to_write:
+            try:
+                bad_events.update(kafka_producer.produce_batch(events_to_write))
+            except Exception as e:
+                for _, stream_events in events_to_write:
+                    bad_events[stream_events["event"]["idempotency_id"]] = str(e)
+    else:
+        write_events_directly(events_to_write, bad_events)
+    return track_event_response(event_list, bad_events)
+
+
+async def track_event_async(request):
+    """Non-blocking version of track_event with the same request and response contract,
+    for deployments that serve lotus.asgi. API key lookups and Kafka delivery are awaited
+    instead of holding a worker thread.
+
+    Django 4.0's csrf_exempt and require_POST wrap views in sync functions, which would
+    make Django run this one as a sync view, so their checks are done here instead."""
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    result, success = await async_fast_api_key_validation_and_cache(request)
+    if not success:
+        return result
+    else:
+        organization_pk = result
+
+    event_list, error_response = get_event_list(request)
+    if error_response:
+        return error_response
+    events_to_write, bad_events = validate_events(event_list, organization_pk)
+    if async_kafka_producer:
+        if events_to_write:
+            try:
+                bad_events.update(
+                    await async_kafka_producer.produce_batch(events_to_write)
+                )
+            except Exception as e:
+                for _, stream_events in events_to_write:
+                    bad_events[stream_events["event"]["idempotency_id"]] = str(e)
+    else:
+        await sync_to_async(write_events_directly)(events_to_write, bad_events)
+    return track_event_response(event_list, bad_events)
+
+
+track_event_async.csrf_exempt = True
+
+
+def get_event_list(request):
     try:
         event_list = load_event(request)
     except Exception as e:
-        return HttpResponseBadRequest(f"Invalid event data: {e}")
+        return None, HttpResponseBadRequest(f"Invalid event data: {e}")
     if not event_list:
-        return HttpResponseBadRequest("No data provided")
+        return None, HttpResponseBadRequest("No data provided")
     if not isinstance(event_list, list):
         if "batch" in event_list:
             event_list = event_list["batch"]
         else:
             event_list = [event_list]
+    return event_list, None
+
+
+def validate_events(event_list, organization_pk):
+    """Validate the events of a track request.
 
+    Returns a list of (customer_id, stream_events) tuples ready to be written and a dict
+    of the events that were rejected, keyed by idempotency_id."""
     bad_events = {}
+    events_to_write = []
     now = now_utc()
+    earliest_time_created = now - timedelta(days=30)
+    latest_time_created = now + timedelta(days=1)
     for data in event_list:
         customer_id = data.get("customer_id")
         idempotency_id = data.get("idempotency_id")
@@ -2287,12 +2372,12 @@ def track_event(request):
         if not time_created:
             bad_events[idempotency_id] = "Invalid time_created"
             continue
-        tc = parser.parse(time_created)
-        # Check if the datetime object is naive
-        if tc.tzinfo is None or tc.tzinfo.utcoffset(tc) is None:
-            # If the datetime object is naive, replace its tzinfo with UTC
-            tc = tc.replace(tzinfo=pytz.UTC)
-        if not (now - relativedelta(days=30) <= tc <= now + relativedelta(days=1)):
+        try:
+            tc = parse_event_timestamp(time_created)
+        except (TypeError, ValueError, OverflowError):
+            bad_events[idempotency_id] = "Invalid time_created"
+            continue
+        if not (earliest_time_created <= tc <= latest_time_created):
             bad_events[
                 idempotency_id
             ] = "Time created too far in the past or future. Events must be within 30 days before or 1 day ahead of current time."
@@ -2300,18 +2385,30 @@ def track_event(request):
         data["time_created"] = tc.isoformat()
         try:
             transformed_event = ingest_event(data, customer_id, organization_pk)
-            stream_events = {
-                "organization_id": organization_pk,
-                "event": transformed_event,
-            }
-            if kafka_producer:
-                kafka_producer.produce(customer_id, stream_events)
         except Exception as e:
             bad_events[idempotency_id] = str(e)
             continue
+        stream_events = {
+            "organization_id": organization_pk,
+            "event": transformed_event,
+        }
+        events_to_write.append((customer_id, stream_events))
+    return events_to_write, bad_events
+
 
+def write_events_directly(events_to_write, bad_events):
+    for _, stream_events in events_to_write:
+        try:
+            direct_event_writer.write(
+                stream_events["organization_id"], stream_events["event"]
+            )
+        except Exception as e:
+            bad_events[stream_events["event"]["idempotency_id"]] = str(e)
+
+
+def track_event_response(event_list, bad_events):
     if len(bad_events) == len(event_list):
-        return Response(
+        return JsonResponse(
             {"success": "none", "failed_events": bad_events},
             status=status.HTTP_400_BAD_REQUEST,
         )
@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lotus.settings")
+os.environ.setdefault("SERVE_ASGI", "True")
 
 application = get_asgi_application()
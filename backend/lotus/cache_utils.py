@@ -50,6 +50,17 @@ class FallbackCache(BaseCache):
             "set", key, value, timeout=timeout, version=version
         )
 
+    def get_many(self, keys, version=None):
+        return self._call_with_fallback("get_many", keys, version=version)
+
+    def set_many(self, data, timeout=None, version=None):
+        return self._call_with_fallback(
+            "set_many", data, timeout=timeout, version=version
+        )
+
+    def incr(self, key, delta=1, version=None):
+        return self._call_with_fallback("incr", key, delta=delta, version=version)
+
     def delete_pattern(self, pattern, version=None):
         return self._call_with_fallback(
             "delete_pattern", pattern, version=version, raise_err=False
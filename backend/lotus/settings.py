@@ -116,6 +116,9 @@ VESSEL_API_KEY = config("VESSEL_API_KEY", default=None)
 # Partial startup
 USE_WEBHOOKS = not config("NO_WEBHOOKS", default=False, cast=bool)
 USE_KAFKA = not config("NO_EVENTS", default=False, cast=bool)
+# set by lotus.asgi, serves /api/track/ with the non-blocking version of the endpoint
+# so the ASGI deployment can stand in for the event tracker behind that URL
+SERVE_ASGI = config("SERVE_ASGI", default=False, cast=bool)
 
 if SENTRY_DSN != "":
     if not DEBUG:
@@ -329,9 +332,52 @@ KAFKA_PREFIX = config("KAFKA_PREFIX", default="")
 KAFKA_EVENTS_TOPIC = KAFKA_PREFIX + config("EVENTS_TOPIC", default="test-topic")
 KAFKA_INVOICE_TOPIC = KAFKA_PREFIX + config("INVOICE_TOPIC", default="invoice-test")
 KAFKA_PAYMENT_TOPIC = KAFKA_PREFIX + config("PAYMENT_TOPIC", default="payment-test")
+# events the consumer could not write are sent here, see the replay_dead_letters command
+KAFKA_EVENTS_DLQ_TOPIC = KAFKA_PREFIX + config(
+    "EVENTS_DLQ_TOPIC", default="test-topic-dlq"
+)
+KAFKA_DLQ_REPLAY_GROUP = config("KAFKA_DLQ_REPLAY_GROUP", default="lotus-dlq-replay")
 KAFKA_NUM_PARTITIONS = config("NUM_PARTITIONS", default=10, cast=int)
 KAFKA_REPLICATION_FACTOR = config("REPLICATION_FACTOR", default=1, cast=int)
 KAFKA_HOST = config("KAFKA_URL", default="127.0.0.1:9092")
+KAFKA_CONSUMER_GROUP = config("KAFKA_CONSUMER_GROUP", default="lotus-events-consumer")
+# the consumer flushes its buffer once it holds this many events or once this many
+# milliseconds have passed since the last flush, whichever comes first
+KAFKA_CONSUMER_BATCH_SIZE = config("KAFKA_CONSUMER_BATCH_SIZE", default=500, cast=int)
+KAFKA_CONSUMER_BATCH_TIMEOUT_MS = config(
+    "KAFKA_CONSUMER_BATCH_TIMEOUT_MS", default=1000, cast=int
+)
+# the consumer remembers the idempotency ids it has written for this long and drops
+# redelivered events with those ids before they reach the database
+KAFKA_CONSUMER_DEDUPE_TTL_SECONDS = config(
+    "KAFKA_CONSUMER_DEDUPE_TTL_SECONDS", default=60 * 60, cast=int
+)
+# number of worker processes the event_consumer command runs in the consumer group
+KAFKA_CONSUMER_WORKERS = config("KAFKA_CONSUMER_WORKERS", default=1, cast=int)
+# when kafka is disabled, events are written straight to the database by a per-process
+# write-behind queue that is flushed in batches
+DIRECT_INGEST_MAX_QUEUE_SIZE = config(
+    "DIRECT_INGEST_MAX_QUEUE_SIZE", default=10000, cast=int
+)
+DIRECT_INGEST_BATCH_SIZE = config("DIRECT_INGEST_BATCH_SIZE", default=500, cast=int)
+DIRECT_INGEST_FLUSH_INTERVAL_MS = config(
+    "DIRECT_INGEST_FLUSH_INTERVAL_MS", default=1000, cast=int
+)
+# producer batching: records for a partition are held for up to linger_ms while a batch
+# of up to batch_size bytes fills up, and whole batches are compressed if a
+# compression_type (gzip, snappy, lz4, zstd) is set. Off unless configured, since every
+# consumer of the topic has to support the codec
+KAFKA_PRODUCER_LINGER_MS = config("KAFKA_PRODUCER_LINGER_MS", default=10, cast=int)
+KAFKA_PRODUCER_BATCH_SIZE = config("KAFKA_PRODUCER_BATCH_SIZE", default=65536, cast=int)
+KAFKA_PRODUCER_COMPRESSION_TYPE = (
+    config("KAFKA_PRODUCER_COMPRESSION_TYPE", default=None) or None
+)
+# how long /api/track waits for kafka to acknowledge a request's events
+KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS = config(
+    "KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS", default=10000, cast=int
+)
+# load event batches into the staging table with COPY instead of multi-row INSERTs
+EVENT_WRITER_USE_COPY = config("EVENT_WRITER_USE_COPY", default=True, cast=bool)
 if KAFKA_HOST and USE_KAFKA:
     if "," not in KAFKA_HOST:
         KAFKA_HOST = KAFKA_HOST
@@ -343,7 +389,9 @@ if KAFKA_HOST and USE_KAFKA:
     producer_config = {
         "bootstrap_servers": KAFKA_HOST,
         "api_version": (2, 5, 0),
-        "linger_ms": 10,
+        "linger_ms": KAFKA_PRODUCER_LINGER_MS,
+        "batch_size": KAFKA_PRODUCER_BATCH_SIZE,
+        "compression_type": KAFKA_PRODUCER_COMPRESSION_TYPE,
     }
     consumer_config = {
         "bootstrap_servers": KAFKA_HOST,
@@ -351,6 +399,9 @@ if KAFKA_HOST and USE_KAFKA:
         "value_deserializer": value_deserializer,
         "key_deserializer": key_deserializer,
         "api_version": (2, 5, 0),
+        "group_id": KAFKA_CONSUMER_GROUP,
+        # offsets are committed manually once a batch has been written to the db
+        "enable_auto_commit": False,
     }
     admin_client_config = {
         "bootstrap_servers": KAFKA_HOST,
@@ -368,6 +419,7 @@ if KAFKA_HOST and USE_KAFKA:
             cfg["sasl_plain_password"] = KAFKA_SASL_PASSWORD
 
     PRODUCER_CONFIG = producer_config
+    CONSUMER_CONFIG = consumer_config
     CONSUMER = KafkaConsumer(KAFKA_EVENTS_TOPIC, **consumer_config)
     ADMIN_CLIENT = KafkaAdminClient(**admin_client_config)
 
@@ -411,8 +463,22 @@ if KAFKA_HOST and USE_KAFKA:
             )
         except TopicAlreadyExistsError:
             pass
+    if KAFKA_EVENTS_DLQ_TOPIC not in existing_topics and DOCKERIZED:
+        try:
+            ADMIN_CLIENT.create_topics(
+                new_topics=[
+                    NewTopic(
+                        name=KAFKA_EVENTS_DLQ_TOPIC,
+                        num_partitions=KAFKA_NUM_PARTITIONS,
+                        replication_factor=KAFKA_REPLICATION_FACTOR,
+                    )
+                ]
+            )
+        except TopicAlreadyExistsError:
+            pass
 else:
     PRODUCER_CONFIG = None
+    CONSUMER_CONFIG = None
     CONSUMER = None
 
 # redis settings
@@ -426,6 +492,28 @@ elif DOCKERIZED:
     REDIS_URL = "redis://redis:6379"
 else:
     REDIS_URL = None
+# the event consumer keeps running usage totals of count and sum counter metrics in
+# redis so metric access checks don't have to query the events. Needs redis, since the
+# counters are shared between the consumer and the web processes
+REALTIME_USAGE_COUNTERS = REDIS_URL is not None and config(
+    "REALTIME_USAGE_COUNTERS", default=False, cast=bool
+)
+REALTIME_USAGE_COUNTER_TTL_SECONDS = config(
+    "REALTIME_USAGE_COUNTER_TTL_SECONDS", default=60 * 60 * 24, cast=int
+)
+# computed usage is reused for this long, or until the customer sends new events. Needs
+# redis, since the entries are invalidated by the process that writes the events. Off by
+# default: only the Python consumer and direct writer invalidate entries, so leave it
+# off when events are written any other way, e.g. by the Go event-guidance service
+USAGE_CACHE_TTL_SECONDS = (
+    config("USAGE_CACHE_TTL_SECONDS", default=0, cast=int)
+    if REDIS_URL is not None
+    else 0
+)
+# keep a partial index on the usage events of every metric's event name, over the
+# customer, the subscription filter and categorical filter properties and the time. The
+# indexes are built by a celery task, run sync_property_indexes after turning this on
+EVENT_PROPERTY_INDEXES = config("EVENT_PROPERTY_INDEXES", default=False, cast=bool)
 
 # Celery Settings
 CELERY_BROKER_URL = f"{REDIS_URL}/0"
@@ -434,6 +522,9 @@ CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
+# the periodic invoice run is split into this many subtasks, at most this many
+# customers are invoiced at the same time
+INVOICE_RUN_CONCURRENCY = config("INVOICE_RUN_CONCURRENCY", default=8, cast=int)
 
 if REDIS_URL is not None:
     CACHES = {
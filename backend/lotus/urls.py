@@ -66,6 +66,7 @@ from metering_billing.views.views import (
 
 DEBUG = settings.DEBUG
 PROFILER_ENABLED = settings.PROFILER_ENABLED
+SERVE_ASGI = settings.SERVE_ASGI
 
 # app router
 router = routers.DefaultRouter()
@@ -283,6 +284,11 @@ urlpatterns = [
     ),
 ]
 
+if SERVE_ASGI:
+    # /api/track/ belongs to the event tracker (see proxy/nginx.conf). The ASGI
+    # deployment can take its place behind the same URL, the WSGI one never serves it
+    urlpatterns += [path("api/track/", api_views.track_event_async, name="track_event")]
+
 if PROFILER_ENABLED:
     urlpatterns += [path("silk/", include("silk.urls", namespace="silk"))]
 
@@ -8,6 +8,8 @@ from .models import (
     APIToken,
     Backtest,
     BacktestSubstitution,
+    BillingRun,
+    BillingRunCustomer,
     Customer,
     Event,
     Feature,
@@ -45,6 +47,18 @@ admin.site.register(Invoice, SimpleHistoryAdmin)
 admin.site.register(TeamInviteToken)
 admin.site.unregister(APIKey)
 admin.site.register(BacktestSubstitution)
+admin.site.register(BillingRunCustomer)
+
+
+@admin.register(BillingRun)
+class BillingRunAdmin(admin.ModelAdmin):
+    list_display = (
+        "billing_run_id",
+        "status",
+        "started_at",
+        "finished_at",
+        "customers_per_minute",
+    )
 
 
 @admin.register(APIToken)
@@ -1,5 +1,6 @@
 import abc
 import datetime
+import hashlib
 import logging
 import uuid
 from collections import namedtuple
@@ -10,7 +11,7 @@ import sqlparse
 from dateutil.relativedelta import relativedelta
 from django.apps import apps
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
 from jinja2 import Template
 
 from metering_billing.exceptions import MetricValidationFailed
@@ -25,15 +26,30 @@ from metering_billing.utils import (
 from metering_billing.utils.enums import (
     METRIC_AGGREGATION,
     METRIC_GRANULARITY,
+    METRIC_STATUS,
     METRIC_TYPE,
     PLAN_DURATION,
 )
 
 from .counter_query_templates import COUNTER_TOTAL_PER_DAY
 from .gauge_query_templates import GAUGE_DELTA_TOTAL_PER_DAY, GAUGE_TOTAL_TOTAL_PER_DAY
+from .query_builder import build_query
 from .rate_query_templates import RATE_TOTAL_PER_DAY
 
 EVENT_NAME_NAMESPACE = settings.EVENT_NAME_NAMESPACE
+EVENT_PROPERTY_INDEXES = settings.EVENT_PROPERTY_INDEXES
+# maximum number of billing records whose usage is computed in one batch query
+BATCH_USAGE_CHUNK_SIZE = 1000
+# register counts supported by timescaledb_toolkit's hyperloglog
+HLL_MIN_BUCKETS = 2**4
+HLL_MAX_BUCKETS = 2**18
+# first key of the advisory locks that order incremental gauge state updates, the
+# second one is the metric's pk
+GAUGE_STATE_ADVISORY_LOCK = 1
+# the text of a json number, events whose gauge property doesn't look like one are
+# left out of incremental gauge states instead of failing the insert
+NUMERIC_PROPERTY_PATTERN = r"^\s*[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?\s*$"
+NIL_UUID = uuid.UUID("00000000-0000-0000-0000-000000000000")
 
 logger = logging.getLogger("django.server")
 
@@ -96,6 +112,97 @@ class MetricHandler(abc.ABC):
         bm.refresh_materialized_views()
         return bm
 
+    @staticmethod
+    def _property_index_prefix(organization, event_name: str) -> str:
+        return (
+            ("org_" + organization.organization_id.hex)[:22]
+            + "___"
+            + ("event_" + uuid.uuid5(EVENT_NAME_NAMESPACE, event_name).hex)[:22]
+            + "___"
+        )
+
+    @staticmethod
+    def _property_index_columns(metric: Metric) -> list[str]:
+        properties = list(metric.organization.subscription_filter_keys)
+        for categorical_filter in metric.categorical_filters.all():
+            if categorical_filter.property_name not in properties:
+                properties.append(categorical_filter.property_name)
+        return properties
+
+    @staticmethod
+    def schedule_property_index_sync(metric: Metric, exclude_metric=False):
+        """Queue sync_property_indexes for this metric. Metrics are provisioned lazily
+        from usage reads, invoicing included, so the index builds never run inline."""
+        from metering_billing.tasks import sync_metric_property_indexes
+
+        if not EVENT_PROPERTY_INDEXES or metric.event_name is None:
+            return
+        sync_metric_property_indexes.delay(metric.pk, exclude_metric=exclude_metric)
+
+    @staticmethod
+    def sync_property_indexes(metric: Metric, exclude_metric=False):
+        """Create the event indexes the active metrics on this metric's event name need
+        and drop the ones none of them use anymore. Metrics with the same event name and
+        filter properties share an index. Pass exclude_metric when the metric is being
+        archived.
+
+        Indexes are built one chunk at a time, so this can't run inside a transaction.
+        A build that was interrupted leaves an invalid index behind, which is rebuilt."""
+        from .common_query_templates import (
+            PROPERTY_INDEX_CREATE,
+            PROPERTY_INDEX_DROP,
+            PROPERTY_INDEX_LIST,
+        )
+
+        if not EVENT_PROPERTY_INDEXES or metric.event_name is None:
+            return
+        organization = metric.organization
+        prefix = MetricHandler._property_index_prefix(organization, metric.event_name)
+        metrics = (
+            Metric.objects.filter(
+                organization=organization,
+                event_name=metric.event_name,
+                status=METRIC_STATUS.ACTIVE,
+            )
+            .exclude(metric_type=METRIC_TYPE.CUSTOM)
+            .prefetch_related("categorical_filters")
+        )
+        if exclude_metric:
+            metrics = metrics.exclude(pk=metric.pk)
+        wanted = {}
+        for other_metric in metrics:
+            properties = MetricHandler._property_index_columns(other_metric)
+            digest = hashlib.md5(",".join(properties).encode()).hexdigest()[:8]
+            wanted[prefix + digest] = properties
+        with connection.cursor() as cursor:
+            cursor.execute(PROPERTY_INDEX_LIST, [len(prefix), prefix])
+            existing = dict(cursor.fetchall())
+            for index_name, properties in wanted.items():
+                if existing.get(index_name):
+                    continue
+                if index_name in existing:
+                    cursor.execute(
+                        Template(PROPERTY_INDEX_DROP).render(index_name=index_name)
+                    )
+                cursor.execute(
+                    Template(PROPERTY_INDEX_CREATE).render(
+                        index_name=index_name,
+                        properties=properties,
+                        organization_id=organization.id,
+                        uuidv5_event_name=uuid.uuid5(
+                            EVENT_NAME_NAMESPACE, metric.event_name
+                        ),
+                    ),
+                    {
+                        f"property_{i}": property_name
+                        for i, property_name in enumerate(properties)
+                    },
+                )
+            for index_name in existing.keys() - wanted.keys():
+                cursor.execute(
+                    Template(PROPERTY_INDEX_DROP).render(index_name=index_name)
+                )
+
     @staticmethod
     @abc.abstractmethod
     def get_billing_record_total_billable_usage(
@@ -104,6 +211,19 @@ class MetricHandler(abc.ABC):
         """This method returns the total quantity of usage that a subscription record should be billed for. This is very straightforward and should simply return a number that will then be used to calculate the amount due."""
         pass
 
+    @staticmethod
+    def get_billing_records_total_billable_usage(
+        metric: Metric, billing_records: list[BillingRecord]
+    ) -> dict[BillingRecord, Decimal]:
+        """Batch version of get_billing_record_total_billable_usage for many billing records of the same metric, returned as a dict keyed by billing record. Handlers that can compute it with a few grouped queries override this, the default makes one call per billing record."""
+        handler = METRIC_HANDLER_MAP[metric.metric_type]
+        return {
+            billing_record: handler.get_billing_record_total_billable_usage(
+                metric, billing_record
+            )
+            for billing_record in billing_records
+        }
+
     @staticmethod
     @abc.abstractmethod
     def get_billing_record_current_usage(
@@ -137,10 +257,114 @@ class MetricHandler(abc.ABC):
         """
         This method just returns the usage of the metric in that day, without worrying about whether it's billable, prorations, etc. Typically used for visualization purposes only and not in any billing runs. Can optionally include a customer to get a single customers usage. Can also incldue top_n, which will group the usage of the non top_n customers into a field called Other.
         """
-        from metering_billing.models import Customer, Organization
+        from metering_billing.models import Organization
 
         organization = Organization.objects.get(id=metric.organization.id)
-        all_results = {}
+        injection_dict = MetricHandler._daily_total_usage_injection_dict(
+            metric, organization, start_date, end_date, customer, top_n
+        )
+        query, params = build_query(query_template, **injection_dict)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            results = namedtuplefetchall(cursor)
+        all_results = MetricHandler._daily_usage_by_customer_uuid(results)
+        customers = MetricHandler._customers_by_uuid(organization, [all_results])
+        return MetricHandler._with_customer_objects(all_results, customers)
+
+    @staticmethod
+    def get_daily_total_usage_many(
+        metrics: list[Metric],
+        start_date: datetime.date,
+        end_date: datetime.date,
+        customer: Optional[Customer] = None,
+        top_n: Optional[int] = None,
+    ) -> dict[
+        Metric,
+        dict[Union[Customer, Literal["Other"]], dict[datetime.date, Decimal]],
+    ]:
+        """Same as get_daily_total_usage for many metrics of one organization, keyed by metric. The metrics that read the same kind of cagg are computed in a single UNION ALL query, and the customers of all of them are looked up at once."""
+        from metering_billing.models import Organization
+
+        metrics = list(metrics)
+        if len(metrics) == 0:
+            return {}
+        organization = Organization.objects.get(id=metrics[0].organization_id)
+        families = {}
+        for metric in metrics:
+            if (
+                metric.status == METRIC_STATUS.ACTIVE
+                and not metric.mat_views_provisioned
+            ):
+                metric.provision_materialized_views()
+            template = METRIC_HANDLER_MAP[
+                metric.metric_type
+            ].get_daily_total_usage_template(metric)
+            families.setdefault(template, []).append(metric)
+
+        usage_by_metric = {}
+        uncombined_usage = {}
+        for template, family_metrics in families.items():
+            if template is None:
+                # no shared query, ask the metric itself
+                for metric in family_metrics:
+                    uncombined_usage[metric] = metric.get_daily_total_usage(
+                        start_date, end_date, customer=customer, top_n=top_n
+                    )
+                continue
+            subqueries = []
+            params = {}
+            for metric_idx, metric in enumerate(family_metrics):
+                injection_dict = MetricHandler._daily_total_usage_injection_dict(
+                    metric, organization, start_date, end_date, customer, top_n
+                )
+                # every metric binds the same dates and customer under the same names,
+                # only the filter values of each metric need names of their own
+                query, metric_params = build_query(
+                    template, param_prefix=f"metric_{metric_idx}_", **injection_dict
+                )
+                params.update(metric_params)
+                subqueries.append(
+                    f"SELECT {metric_idx} AS metric_idx, metric_usage.* FROM ({query}) AS metric_usage"
+                )
+            with connection.cursor() as cursor:
+                cursor.execute("\nUNION ALL\n".join(subqueries), params)
+                results = namedtuplefetchall(cursor)
+            results_by_metric = {}
+            for result in results:
+                results_by_metric.setdefault(result.metric_idx, []).append(result)
+            for metric_idx, metric in enumerate(family_metrics):
+                usage_by_metric[metric] = MetricHandler._daily_usage_by_customer_uuid(
+                    results_by_metric.get(metric_idx, [])
+                )
+
+        customers = MetricHandler._customers_by_uuid(
+            organization, list(usage_by_metric.values())
+        )
+        return {
+            metric: (
+                uncombined_usage[metric]
+                if metric in uncombined_usage
+                else MetricHandler._with_customer_objects(
+                    usage_by_metric[metric], customers
+                )
+            )
+            for metric in metrics
+        }
+
+    @staticmethod
+    def get_daily_total_usage_template(metric: Metric) -> Optional[str]:
+        """The query template get_daily_total_usage runs for this metric, or None if it doesn't run one that can be combined with other metrics."""
+        return None
+
+    @staticmethod
+    def _daily_total_usage_injection_dict(
+        metric: Metric,
+        organization: Organization,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        customer: Optional[Customer],
+        top_n: Optional[int],
+    ) -> dict:
         injection_dict = {
             "query_type": metric.usage_aggregation_type,
             "filter_properties": {},
@@ -176,10 +400,10 @@ class MetricHandler(abc.ABC):
             )
         )
         injection_dict["group_by"] = organization.subscription_filter_keys
-        query = Template(query_template).render(**injection_dict)
-        with connection.cursor() as cursor:
-            cursor.execute(query)
-            results = namedtuplefetchall(cursor)
+        return injection_dict
+
+    @staticmethod
+    def _daily_usage_by_customer_uuid(results) -> dict:
         all_results = {}
         for result in results:
             if result.uuidv5_customer_id not in all_results:
@@ -188,18 +412,33 @@ class MetricHandler(abc.ABC):
             all_results[result.uuidv5_customer_id][time] = result.usage_qty or Decimal(
                 0
             )
-        nil_uuid = uuid.UUID("00000000-0000-0000-0000-000000000000")
-        customer_ids_minus_other = set(all_results.keys()) - {nil_uuid}
-        customers = Customer.objects.filter(
-            uuidv5_customer_id__in=customer_ids_minus_other
-        )
+        return all_results
+
+    @staticmethod
+    def _customers_by_uuid(organization: Organization, all_results: list[dict]):
+        from metering_billing.models import Customer
+
+        customer_uuids = set()
+        for results in all_results:
+            customer_uuids |= set(results.keys())
+        customer_uuids -= {NIL_UUID}
+        if len(customer_uuids) == 0:
+            return {}
+        return {
+            customer.uuidv5_customer_id: customer
+            for customer in Customer.objects.filter(
+                organization=organization, uuidv5_customer_id__in=customer_uuids
+            )
+        }
+
+    @staticmethod
+    def _with_customer_objects(all_results: dict, customers: dict) -> dict:
         all_results_with_customer_objects = {}
-        for customer in customers:
-            all_results_with_customer_objects[customer] = all_results[
-                customer.uuidv5_customer_id
-            ]
-        if nil_uuid in all_results:
-            all_results_with_customer_objects["Other"] = all_results[nil_uuid]
+        for customer_uuid, usage in all_results.items():
+            if customer_uuid in customers:
+                all_results_with_customer_objects[customers[customer_uuid]] = usage
+        if NIL_UUID in all_results:
+            all_results_with_customer_objects["Other"] = all_results[NIL_UUID]
         return all_results_with_customer_objects
 
 
@@ -220,22 +459,100 @@ class CounterHandler(MetricHandler):
         billing_record: BillingRecord,
         organization: Organization,
     ) -> dict:
-        customer = billing_record.subscription.customer
-        uuidv5_customer_id = customer.uuidv5_customer_id
-        if uuidv5_customer_id is None:
-            uuidv5_customer_id = customer_id_uuidv5(customer.customer_id)
-            customer.uuidv5_customer_id = uuidv5_customer_id
-            customer.save()
         injection_dict = {
             "query_type": metric.usage_aggregation_type,
             "filter_properties": {},
-            "uuidv5_customer_id": uuidv5_customer_id,
+            "uuidv5_customer_id": CounterHandler._get_uuidv5_customer_id(
+                billing_record.subscription.customer
+            ),
         }
         injection_dict["group_by"] = organization.subscription_filter_keys
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         return injection_dict
 
+    @staticmethod
+    def _get_uuidv5_customer_id(customer: Customer) -> uuid.UUID:
+        uuidv5_customer_id = customer.uuidv5_customer_id
+        if uuidv5_customer_id is None:
+            uuidv5_customer_id = customer_id_uuidv5(customer.customer_id)
+            customer.uuidv5_customer_id = uuidv5_customer_id
+            customer.save()
+        return uuidv5_customer_id
+
+    @staticmethod
+    def _hll_buckets(approximate_unique_error: Decimal) -> int:
+        """Number of HyperLogLog registers needed for a relative standard error of
+        approximate_unique_error, which is about 1.04 / sqrt(registers)."""
+        buckets = HLL_MIN_BUCKETS
+        while Decimal("1.04") / Decimal(buckets).sqrt() > approximate_unique_error:
+            buckets *= 2
+            if buckets > HLL_MAX_BUCKETS:
+                raise MetricValidationFailed(
+                    "[METRIC TYPE: COUNTER] Approximate unique error must be at least {:.4f}".format(
+                        Decimal("1.04") / Decimal(HLL_MAX_BUCKETS).sqrt()
+                    )
+                )
+        return buckets
+
+    @staticmethod
+    def _split_into_sketch_window(
+        start: datetime.datetime, end: datetime.datetime
+    ) -> tuple[datetime.datetime, datetime.datetime]:
+        """Returns the whole hours inside a billing period, which can be read from the
+        hourly sketches. If there are none both ends are the end of the period, so
+        everything is read from the raw events."""
+        sketch_start = start.replace(minute=0, second=0, microsecond=0)
+        if sketch_start < start:
+            sketch_start += relativedelta(hours=1)
+        sketch_end = (end + relativedelta(microseconds=1)).replace(
+            minute=0, second=0, microsecond=0
+        )
+        if sketch_start >= sketch_end:
+            return end, end
+        return sketch_start, sketch_end
+
+    @staticmethod
+    def _split_into_cagg_windows(
+        start: datetime.datetime, end: datetime.datetime, per_second_aggregate=True
+    ) -> list[tuple[str, datetime.datetime, datetime.datetime]]:
+        """Split a billing period into the (tier, start, end) windows it is read from,
+        with the end of every window exclusive. The whole days in the middle come from
+        the day cagg, the whole hours around them from the hour cagg and whatever is
+        left at either end from the second cagg, or from the raw events ("events") if
+        the metric doesn't keep one."""
+        # billing periods end on the last microsecond of the day, and the second cagg
+        # has never been more precise than a second at the start
+        start = start.astimezone(datetime.timezone.utc).replace(microsecond=0)
+        end = end.astimezone(datetime.timezone.utc) + relativedelta(microseconds=1)
+        leftover_tier = "second" if per_second_aggregate else "events"
+        units = [
+            ("day", lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0)),
+            ("hour", lambda t: t.replace(minute=0, second=0, microsecond=0)),
+        ]
+        windows = []
+
+        def split(window_start, window_end, units):
+            if window_start >= window_end:
+                return
+            if not units:
+                windows.append((leftover_tier, window_start, window_end))
+                return
+            (tier, floor), finer_units = units[0], units[1:]
+            inner_start = floor(window_start)
+            if inner_start < window_start:
+                inner_start += relativedelta(**{f"{tier}s": 1})
+            inner_end = floor(window_end)
+            if inner_start >= inner_end:
+                split(window_start, window_end, finer_units)
+                return
+            split(window_start, inner_start, finer_units)
+            windows.append((tier, inner_start, inner_end))
+            split(inner_end, window_end, finer_units)
+
+        split(start, end, units)
+        return windows
+
     @staticmethod
     def _get_total_usage_per_day_not_unique(
         metric: Metric,
@@ -251,87 +568,38 @@ class CounterHandler(MetricHandler):
         injection_dict = CounterHandler._prepare_injection_dict(
             metric, billing_record, organization
         )
-        start = billing_record.start_date
-        end = billing_record.end_date
-        # there's 3 periods here.... the chunk between the start and the end of that day,
-        # the full days in between, and the chunk between the last full day and the end. There
-        # are scenarios where all 3 of them happen or don't independently of each other, so
-        # we check individually
-        # check for start to end of day condition:
-        start_to_eod = not (
-            start.hour == 0
-            and start.minute == 0
-            and start.second == 0
-            and start.microsecond == 0
+        cagg_windows = CounterHandler._split_into_cagg_windows(
+            billing_record.start_date,
+            billing_record.end_date,
+            metric.per_second_aggregate,
         )
-        # check for start of day to endcondition:
-        sod_to_end = not (
-            end.hour == 23
-            and end.minute == 59
-            and end.second == 59
-            and end.microsecond == 999999
+        if len(cagg_windows) == 0:
+            return []
+        injection_dict["cagg_windows"] = cagg_windows
+        injection_dict["cagg_prefix"] = (
+            ("org_" + organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
         )
-        # check for full days in between condition:
-        if not start_to_eod:
-            full_days_btwn_start = start.date()
-        else:
-            full_days_btwn_start = (start + relativedelta(days=1)).date()
-        if not sod_to_end:
-            full_days_btwn_end = end.date()
-        else:
-            full_days_btwn_end = (end - relativedelta(days=1)).date()
-        full_days_between = (full_days_btwn_end - full_days_btwn_start).days > 0
-        # now use our pre-prepared queries with the injectiosn to get the usage
-        all_results = []
-        if start_to_eod:
-            injection_dict["start_date"] = start.replace(microsecond=0)
-            injection_dict["end_date"] = start.replace(
-                hour=23, minute=59, second=59, microsecond=999999
-            )
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "second"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                results = namedtuplefetchall(cursor)
-            all_results.extend(results)
-        if full_days_between:
-            injection_dict["start_date"] = full_days_btwn_start
-            injection_dict["end_date"] = full_days_btwn_end
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "day"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                results = namedtuplefetchall(cursor)
-            all_results.extend(results)
-        if sod_to_end:
-            injection_dict["start_date"] = end.replace(
-                hour=0, minute=0, second=0, microsecond=0
-            )
-            injection_dict["end_date"] = end.replace(microsecond=0)
-            injection_dict["cagg_name"] = (
-                ("org_" + organization.organization_id.hex)[:22]
-                + "___"
-                + ("metric_" + metric.metric_id.hex)[:22]
-                + "___"
-                + "second"
-            )
-            query = Template(COUNTER_CAGG_TOTAL).render(**injection_dict)
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                results = namedtuplefetchall(cursor)
-            all_results.extend(results)
+        injection_dict["property_name"] = metric.property_name
+        injection_dict["uuidv5_event_name"] = uuid.uuid5(
+            EVENT_NAME_NAMESPACE, metric.event_name
+        )
+        injection_dict["organization_id"] = organization.id
+        injection_dict["numeric_filters"] = [
+            (x.property_name, x.operator, x.comparison_value)
+            for x in metric.numeric_filters.all()
+        ]
+        injection_dict["categorical_filters"] = [
+            (x.property_name, x.operator, x.comparison_value)
+            for x in metric.categorical_filters.all()
+        ]
+        # every tier of the period is read in the same query
+        query, params = build_query(COUNTER_CAGG_TOTAL, **injection_dict)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            all_results = namedtuplefetchall(cursor)
         return all_results
 
     @staticmethod
@@ -339,6 +607,7 @@ class CounterHandler(MetricHandler):
         metric: Metric, billing_record: BillingRecord
     ) -> Decimal:
         from metering_billing.aggregation.counter_query_templates import (
+            COUNTER_UNIQUE_HLL_TOTAL,
             COUNTER_UNIQUE_TOTAL,
         )
         from metering_billing.models import Organization
@@ -369,9 +638,26 @@ class CounterHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ]
-            query = Template(COUNTER_UNIQUE_TOTAL).render(**injection_dict)
+            if metric.approximate_unique_error is not None:
+                (
+                    injection_dict["sketch_start"],
+                    injection_dict["sketch_end"],
+                ) = CounterHandler._split_into_sketch_window(start, end)
+                injection_dict["hll_buckets"] = CounterHandler._hll_buckets(
+                    metric.approximate_unique_error
+                )
+                injection_dict["cagg_name"] = (
+                    ("org_" + organization.organization_id.hex)[:22]
+                    + "___"
+                    + ("metric_" + metric.metric_id.hex)[:22]
+                    + "___"
+                    + "hll"
+                )
+                query, params = build_query(COUNTER_UNIQUE_HLL_TOTAL, **injection_dict)
+            else:
+                query, params = build_query(COUNTER_UNIQUE_TOTAL, **injection_dict)
             with connection.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, params)
                 results = namedtuplefetchall(cursor)
             all_results = results
         totals = {"usage_qty": 0, "num_events": 0}
@@ -389,6 +675,130 @@ class CounterHandler(MetricHandler):
             totals["usage_qty"] = totals["usage_qty"] / totals["num_events"]
         return totals["usage_qty"]
 
+    @staticmethod
+    def get_billing_records_total_billable_usage(
+        metric: Metric, billing_records: list[BillingRecord]
+    ) -> dict[BillingRecord, Decimal]:
+        from metering_billing.aggregation.counter_query_templates import (
+            COUNTER_CAGG_TOTAL_BATCH,
+            COUNTER_UNIQUE_TOTAL_BATCH,
+        )
+        from metering_billing.models import Organization
+
+        if metric.approximate_unique_error is not None:
+            # merging sketches across many records at once isn't worth it, the
+            # per record query already reads mostly pre-aggregated sketches
+            return MetricHandler.get_billing_records_total_billable_usage(
+                metric, billing_records
+            )
+        organization = Organization.objects.get(id=metric.organization.id)
+        group_by = organization.subscription_filter_keys
+        is_unique = metric.usage_aggregation_type == METRIC_AGGREGATION.UNIQUE
+        injection_dict = {
+            "group_by": group_by,
+            "cagg_prefix": (
+                ("org_" + organization.organization_id.hex)[:22]
+                + "___"
+                + ("metric_" + metric.metric_id.hex)[:22]
+                + "___"
+            ),
+            "property_name": metric.property_name,
+            "uuidv5_event_name": uuid.uuid5(EVENT_NAME_NAMESPACE, metric.event_name),
+            "organization_id": organization.id,
+            "numeric_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.numeric_filters.all()
+            ],
+            "categorical_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.categorical_filters.all()
+            ],
+        }
+        billing_records = list(billing_records)
+        totals = {}
+        for chunk_start in range(0, len(billing_records), BATCH_USAGE_CHUNK_SIZE):
+            windows = []
+            for record_idx in range(
+                chunk_start,
+                min(chunk_start + BATCH_USAGE_CHUNK_SIZE, len(billing_records)),
+            ):
+                billing_record = billing_records[record_idx]
+                uuidv5_customer_id = CounterHandler._get_uuidv5_customer_id(
+                    billing_record.customer
+                )
+                filters = dict(billing_record.subscription.subscription_filters)
+                filter_values = [
+                    str(filters[key]) if key in filters else None for key in group_by
+                ]
+                if is_unique:
+                    record_windows = [
+                        ("events", billing_record.start_date, billing_record.end_date)
+                    ]
+                else:
+                    record_windows = CounterHandler._split_into_cagg_windows(
+                        billing_record.start_date,
+                        billing_record.end_date,
+                        metric.per_second_aggregate,
+                    )
+                for window_kind, start, end in record_windows:
+                    windows.append(
+                        {
+                            "record_idx": record_idx,
+                            "window_kind": window_kind,
+                            "uuidv5_customer_id": uuidv5_customer_id,
+                            "start_date": start,
+                            "end_date": end,
+                            "filter_values": filter_values,
+                        }
+                    )
+            if len(windows) == 0:
+                continue
+            injection_dict["windows"] = windows
+            injection_dict["window_kinds"] = sorted(
+                {window["window_kind"] for window in windows}
+            )
+            query, params = build_query(
+                COUNTER_UNIQUE_TOTAL_BATCH if is_unique else COUNTER_CAGG_TOTAL_BATCH,
+                **injection_dict,
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                results = namedtuplefetchall(cursor)
+            for result in results:
+                total = totals.setdefault(
+                    result.record_idx,
+                    {"num_events": 0, "usage_qty": 0, "weighted_qty": 0, "max_qty": 0},
+                )
+                total["num_events"] += result.num_events or 0
+                if is_unique:
+                    # unique values are counted per subscription filter group and then
+                    # added up, same as get_billing_record_total_billable_usage
+                    total["usage_qty"] += result.usage_qty or 0
+                else:
+                    total["usage_qty"] += result.sum_qty or 0
+                    total["weighted_qty"] += result.weighted_qty or 0
+                    total["max_qty"] = max(total["max_qty"], result.max_qty or 0)
+
+        usage = {}
+        for record_idx, billing_record in enumerate(billing_records):
+            total = totals.get(record_idx)
+            if total is None:
+                usage_qty = 0
+            elif metric.usage_aggregation_type == METRIC_AGGREGATION.COUNT:
+                usage_qty = total["num_events"]
+            elif metric.usage_aggregation_type == METRIC_AGGREGATION.AVERAGE:
+                usage_qty = (
+                    total["weighted_qty"] / total["num_events"]
+                    if total["num_events"]
+                    else 0
+                )
+            elif metric.usage_aggregation_type == METRIC_AGGREGATION.MAX:
+                usage_qty = total["max_qty"]
+            else:
+                usage_qty = total["usage_qty"]
+            usage[billing_record] = Decimal(usage_qty)
+        return usage
+
     @staticmethod
     def get_billing_record_current_usage(
         metric: Metric, billing_record: BillingRecord
@@ -406,9 +816,18 @@ class CounterHandler(MetricHandler):
         top_n: Optional[int],
     ) -> dict[Union[Customer, Literal["Other"]], dict[datetime.date, Decimal]]:
         return MetricHandler.get_daily_total_usage(
-            metric, start_date, end_date, customer, top_n, COUNTER_TOTAL_PER_DAY
+            metric,
+            start_date,
+            end_date,
+            customer,
+            top_n,
+            CounterHandler.get_daily_total_usage_template(metric),
         )
 
+    @staticmethod
+    def get_daily_total_usage_template(metric: Metric) -> Optional[str]:
+        return COUNTER_TOTAL_PER_DAY
+
     @staticmethod
     def get_billing_record_daily_billable_usage(
         metric: Metric, billing_record: BillingRecord
@@ -473,9 +892,9 @@ class CounterHandler(MetricHandler):
                 (x.property_name, x.operator, x.comparison_value)
                 for x in metric.categorical_filters.all()
             ]
-            query = Template(COUNTER_UNIQUE_PER_DAY).render(**injection_dict)
+            query, params = build_query(COUNTER_UNIQUE_PER_DAY, **injection_dict)
             with connection.cursor() as cursor:
-                cursor.execute(query)
+                cursor.execute(query, params)
                 results = namedtuplefetchall(cursor)
             all_results = results
         return all_results
@@ -495,6 +914,7 @@ class CounterHandler(MetricHandler):
         data.get("categorical_filters", None)
         property_name = data.get("property_name", None)
         proration = data.get("proration", None)
+        approximate_unique_error = data.get("approximate_unique_error", None)
 
         # now validate
         if metric_type != METRIC_TYPE.COUNTER:
@@ -538,12 +958,35 @@ class CounterHandler(MetricHandler):
         if proration:
             logger.info("[METRIC TYPE: COUNTER] Proration not allowed. Making null.")
             data.pop("proration", None)
+        if data.get("incremental_state"):
+            logger.info(
+                "[METRIC TYPE: COUNTER] Incremental state not allowed. Making false."
+            )
+            data.pop("incremental_state", None)
+        if approximate_unique_error is not None:
+            if usg_agg_type != METRIC_AGGREGATION.UNIQUE:
+                logger.info(
+                    "[METRIC TYPE: COUNTER] Approximate unique error only applies to UNIQUE aggregation. Making null."
+                )
+                data.pop("approximate_unique_error", None)
+            else:
+                CounterHandler._hll_buckets(approximate_unique_error)
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb_toolkit'"
+                    )
+                    toolkit_available = cursor.fetchone() is not None
+                if not toolkit_available:
+                    raise MetricValidationFailed(
+                        "[METRIC TYPE: COUNTER] Approximate unique counts need the timescaledb_toolkit extension, which isn't available in this database"
+                    )
         return data
 
     @staticmethod
     def create_continuous_aggregate(metric: Metric, refresh=False):
-        # unfortunately there's no good way to make caggs for unique. We'll still
-        # make one for the total daily usage graph, but not for second
+        # unfortunately there's no good way to make exact caggs for unique. We'll still
+        # make one for the total daily usage graph, but not for second. Approximate
+        # unique metrics get an hourly cagg of HyperLogLog sketches instead
         # if we're refreshing the matview, then we need to drop the last
         # one and recreate it
         from metering_billing.models import Organization
@@ -551,6 +994,8 @@ class CounterHandler(MetricHandler):
         from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
         from .counter_query_templates import COUNTER_CAGG_QUERY
 
+        MetricHandler.schedule_property_index_sync(metric)
+
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
         sql_injection_data = {
@@ -587,6 +1032,14 @@ class CounterHandler(MetricHandler):
         second_compression_query = Template(CAGG_COMPRESSION).render(
             **sql_injection_data
         )
+        sql_injection_data["cagg_name"] = base_name + "hour"
+        sql_injection_data["bucket_size"] = "hour"
+        hour_query = Template(COUNTER_CAGG_QUERY).render(**sql_injection_data)
+        hour_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
+        hour_refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
+        hour_compression_query = Template(CAGG_COMPRESSION).render(**sql_injection_data)
+        sql_injection_data["cagg_name"] = base_name + "hll"
+        hll_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
         with connection.cursor() as cursor:
             # DAY QUERY FIRST
             if refresh is True:
@@ -595,13 +1048,44 @@ class CounterHandler(MetricHandler):
             cursor.execute(day_refresh_query)
         if metric.usage_aggregation_type != METRIC_AGGREGATION.UNIQUE:
             with connection.cursor() as cursor:
-                # SECOND QUERY SECOND
+                # THEN HOUR
                 if refresh is True:
+                    cursor.execute(hour_drop_query)
+                cursor.execute(hour_query)
+                cursor.execute(hour_refresh_query)
+                if not refresh:
+                    cursor.execute(hour_compression_query)
+            with connection.cursor() as cursor:
+                # AND SECOND, UNLESS THE METRIC READS PARTIAL HOURS FROM THE RAW EVENTS
+                if refresh is True or not metric.per_second_aggregate:
                     cursor.execute(second_drop_query)
-                cursor.execute(second_query)
-                cursor.execute(second_refresh_query)
+                if metric.per_second_aggregate:
+                    cursor.execute(second_query)
+                    cursor.execute(second_refresh_query)
+                    if not refresh:
+                        cursor.execute(second_compression_query)
+        elif metric.approximate_unique_error is not None:
+            # hourly HyperLogLog sketches that can be merged over any billing period
+            sql_injection_data["hll_buckets"] = CounterHandler._hll_buckets(
+                metric.approximate_unique_error
+            )
+            hll_query = Template(COUNTER_CAGG_QUERY).render(**sql_injection_data)
+            hll_refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
+            hll_compression_query = Template(CAGG_COMPRESSION).render(
+                **sql_injection_data
+            )
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS timescaledb_toolkit;")
+                if refresh is True:
+                    cursor.execute(hll_drop_query)
+                cursor.execute(hll_query)
+                cursor.execute(hll_refresh_query)
                 if not refresh:
-                    cursor.execute(second_compression_query)
+                    cursor.execute(hll_compression_query)
+        elif refresh is True:
+            # the metric may have stopped being approximate
+            with connection.cursor() as cursor:
+                cursor.execute(hll_drop_query)
 
     @staticmethod
     def create_metric(validated_data: dict) -> Metric:
@@ -623,10 +1107,19 @@ class CounterHandler(MetricHandler):
         day_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
         sql_injection_data = {"cagg_name": base_name + "second"}
         second_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
+        sql_injection_data = {"cagg_name": base_name + "hour"}
+        hour_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
+        sql_injection_data = {"cagg_name": base_name + "hll"}
+        hll_drop_query = Template(CAGG_DROP).render(**sql_injection_data)
         with connection.cursor() as cursor:
             cursor.execute(day_drop_query)
         with connection.cursor() as cursor:
             cursor.execute(second_drop_query)
+        with connection.cursor() as cursor:
+            cursor.execute(hour_drop_query)
+        with connection.cursor() as cursor:
+            cursor.execute(hll_drop_query)
+        MetricHandler.schedule_property_index_sync(metric, exclude_metric=True)
 
 
 class CustomHandler(MetricHandler):
@@ -769,6 +1262,11 @@ class CustomHandler(MetricHandler):
                 "[METRIC TYPE: CUSTOM] Property name specified but not needed for CUSTOM aggregation"
             )
             data.pop("property_name", None)
+        if data.get("incremental_state"):
+            logger.info(
+                "[METRIC TYPE: CUSTOM] Incremental state specified but not needed for CUSTOM aggregation"
+            )
+            data.pop("incremental_state", None)
         if custom_sql is None:
             raise MetricValidationFailed(
                 "Custom SQL query is required for CUSTOM metric"
@@ -959,6 +1457,8 @@ class GaugeHandler(MetricHandler):
             GAUGE_TOTAL_CUMULATIVE_SUM,
         )
 
+        MetricHandler.schedule_property_index_sync(metric)
+
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
         sql_injection_data = {
@@ -998,11 +1498,102 @@ class GaugeHandler(MetricHandler):
             cursor.execute(refresh_query)
             if not refresh:
                 cursor.execute(compression_query)
+        GaugeHandler._provision_state(metric, rebuild=refresh)
+
+    @staticmethod
+    def _state_injection_dict(metric: Metric) -> dict:
+        organization = metric.organization
+        return {
+            "state_name": (
+                ("org_" + organization.organization_id.hex)[:22]
+                + "___"
+                + ("metric_" + metric.metric_id.hex)[:22]
+                + "___"
+                + "state"
+            ),
+            "lock_class": GAUGE_STATE_ADVISORY_LOCK,
+            "metric_id": metric.pk,
+            "event_type": metric.event_type,
+            "property_name": metric.property_name,
+            "group_by": organization.subscription_filter_keys,
+            "uuidv5_event_name": uuid.uuid5(EVENT_NAME_NAMESPACE, metric.event_name),
+            "organization_id": organization.id,
+            "numeric_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.numeric_filters.all()
+            ],
+            "categorical_filters": [
+                (x.property_name, x.operator, x.comparison_value)
+                for x in metric.categorical_filters.all()
+            ],
+            "numeric_pattern": NUMERIC_PROPERTY_PATTERN,
+        }
+
+    @staticmethod
+    def _provision_state(metric: Metric, rebuild=False):
+        """Create the trigger that keeps an incremental gauge's state up to date and
+        fill the state from the event history, or drop both if the metric doesn't keep
+        one. A rebuild starts the state over, for when the subscription filter keys it
+        is grouped by have changed."""
+        from metering_billing.models import GaugeState
+
+        from .gauge_query_templates import GAUGE_STATE_DROP_TRIGGER, GAUGE_STATE_TRIGGER
+
+        injection_dict = GaugeHandler._state_injection_dict(metric)
+        if not metric.incremental_state:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    Template(GAUGE_STATE_DROP_TRIGGER).render(**injection_dict)
+                )
+            GaugeState.objects.filter(metric=metric).delete()
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(Template(GAUGE_STATE_TRIGGER).render(**injection_dict))
+        GaugeHandler.advance_state_checkpoint(metric, rebuild=rebuild)
+
+    @staticmethod
+    def advance_state_checkpoint(metric: Metric, rebuild=False):
+        """Move the events written since the last checkpoint of an incremental gauge
+        into its state, so current usage only has to read the events after now."""
+        from metering_billing.models import GaugeState
+
+        from .gauge_query_templates import (
+            GAUGE_STATE_ADVANCE,
+            GAUGE_STATE_SET_CHECKPOINT,
+        )
+
+        injection_dict = GaugeHandler._state_injection_dict(metric)
+        injection_dict["state_checkpoint"] = now_utc()
+        advance_query, advance_params = build_query(
+            GAUGE_STATE_ADVANCE, **injection_dict
+        )
+        checkpoint_query, checkpoint_params = build_query(
+            GAUGE_STATE_SET_CHECKPOINT,
+            metric_id=metric.pk,
+            state_checkpoint=injection_dict["state_checkpoint"],
+        )
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # waits for the events being written to commit, and holds off new ones
+                # until the state and checkpoint have moved
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(%s, %s)",
+                    [GAUGE_STATE_ADVISORY_LOCK, metric.pk],
+                )
+                if rebuild:
+                    GaugeState.objects.filter(metric=metric).delete()
+                cursor.execute(advance_query, advance_params)
+                cursor.execute(checkpoint_query, checkpoint_params)
 
     @staticmethod
     def archive_metric(metric: Metric) -> Metric:
+        from metering_billing.models import GaugeState
+
         from .common_query_templates import CAGG_DROP
-        from .gauge_query_templates import GAUGE_DELTA_DROP_OLD
+        from .gauge_query_templates import (
+            GAUGE_DELTA_DROP_OLD,
+            GAUGE_STATE_DROP_TRIGGER,
+        )
 
         organization = metric.organization
         sql_injection_data = {
@@ -1017,10 +1608,16 @@ class GaugeHandler(MetricHandler):
         query = Template(CAGG_DROP).render(**sql_injection_data)
         if metric.event_type == "delta":
             trigger = Template(GAUGE_DELTA_DROP_OLD).render(**sql_injection_data)
+        drop_state_trigger = Template(GAUGE_STATE_DROP_TRIGGER).render(
+            **GaugeHandler._state_injection_dict(metric)
+        )
         with connection.cursor() as cursor:
             cursor.execute(query)
             if metric.event_type == "delta":
                 cursor.execute(trigger)
+            cursor.execute(drop_state_trigger)
+        GaugeState.objects.filter(metric=metric).delete()
+        MetricHandler.schedule_property_index_sync(metric, exclude_metric=True)
         return metric
 
     @staticmethod
@@ -1084,15 +1681,15 @@ class GaugeHandler(MetricHandler):
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION).render(
-                **injection_dict
+            query, params = build_query(
+                GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION, **injection_dict
             )
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION).render(
-                **injection_dict
+            query, params = build_query(
+                GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION, **injection_dict
             )
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             result = namedtuplefetchall(cursor)
         if len(result) == 0:
             return Decimal(0)
@@ -1106,7 +1703,9 @@ class GaugeHandler(MetricHandler):
 
         from .gauge_query_templates import (
             GAUGE_DELTA_GET_CURRENT_USAGE,
+            GAUGE_DELTA_GET_CURRENT_USAGE_FROM_STATE,
             GAUGE_TOTAL_GET_CURRENT_USAGE,
+            GAUGE_TOTAL_GET_CURRENT_USAGE_FROM_STATE,
         )
 
         organization = Organization.objects.get(id=metric.organization.id)
@@ -1158,12 +1757,23 @@ class GaugeHandler(MetricHandler):
         }
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
-        if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_CURRENT_USAGE).render(**injection_dict)
+        if metric.incremental_state:
+            injection_dict["metric_id"] = metric.pk
+            injection_dict["numeric_pattern"] = NUMERIC_PROPERTY_PATTERN
+            if metric.event_type == "delta":
+                query, params = build_query(
+                    GAUGE_DELTA_GET_CURRENT_USAGE_FROM_STATE, **injection_dict
+                )
+            elif metric.event_type == "total":
+                query, params = build_query(
+                    GAUGE_TOTAL_GET_CURRENT_USAGE_FROM_STATE, **injection_dict
+                )
+        elif metric.event_type == "delta":
+            query, params = build_query(GAUGE_DELTA_GET_CURRENT_USAGE, **injection_dict)
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_CURRENT_USAGE).render(**injection_dict)
+            query, params = build_query(GAUGE_TOTAL_GET_CURRENT_USAGE, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             result = namedtuplefetchall(cursor)
         if len(result) == 0:
             return Decimal(0)
@@ -1230,15 +1840,15 @@ class GaugeHandler(MetricHandler):
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
         if metric.event_type == "delta":
-            query = Template(GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY).render(
-                **injection_dict
+            query, params = build_query(
+                GAUGE_DELTA_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY, **injection_dict
             )
         elif metric.event_type == "total":
-            query = Template(GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY).render(
-                **injection_dict
+            query, params = build_query(
+                GAUGE_TOTAL_GET_TOTAL_USAGE_WITH_PRORATION_PER_DAY, **injection_dict
             )
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             result = namedtuplefetchall(cursor)
         results_dict = {}
         for row in result:
@@ -1256,14 +1866,21 @@ class GaugeHandler(MetricHandler):
         customer: Optional[Customer],
         top_n: Optional[int],
     ) -> dict[Union[Customer, Literal["Other"]], dict[datetime.date, Decimal]]:
+        return MetricHandler.get_daily_total_usage(
+            metric,
+            start_date,
+            end_date,
+            customer,
+            top_n,
+            GaugeHandler.get_daily_total_usage_template(metric),
+        )
+
+    @staticmethod
+    def get_daily_total_usage_template(metric: Metric) -> Optional[str]:
         if metric.event_type == "delta":
-            return MetricHandler.get_daily_total_usage(
-                metric, start_date, end_date, customer, top_n, GAUGE_DELTA_TOTAL_PER_DAY
-            )
+            return GAUGE_DELTA_TOTAL_PER_DAY
         elif metric.event_type == "total":
-            return MetricHandler.get_daily_total_usage(
-                metric, start_date, end_date, customer, top_n, GAUGE_TOTAL_TOTAL_PER_DAY
-            )
+            return GAUGE_TOTAL_TOTAL_PER_DAY
 
 
 class RateHandler(MetricHandler):
@@ -1324,6 +1941,11 @@ class RateHandler(MetricHandler):
         if proration:
             logger.info("[METRIC TYPE: RATE] Proration not allowed. Making null.")
             data.pop("proration", None)
+        if data.get("incremental_state"):
+            logger.info(
+                "[METRIC TYPE: RATE] Incremental state not allowed. Making false."
+            )
+            data.pop("incremental_state", None)
         return data
 
     @staticmethod
@@ -1350,13 +1972,28 @@ class RateHandler(MetricHandler):
         top_n: Optional[int],
     ) -> dict[Union[Customer, Literal["Other"]], dict[datetime.date, Decimal]]:
         return MetricHandler.get_daily_total_usage(
-            metric, start_date, end_date, customer, top_n, RATE_TOTAL_PER_DAY
+            metric,
+            start_date,
+            end_date,
+            customer,
+            top_n,
+            RateHandler.get_daily_total_usage_template(metric),
         )
 
+    @staticmethod
+    def get_daily_total_usage_template(metric: Metric) -> Optional[str]:
+        return RATE_TOTAL_PER_DAY
+
     @staticmethod
     def create_continuous_aggregate(metric: Metric, refresh=False):
         from .common_query_templates import CAGG_COMPRESSION, CAGG_DROP, CAGG_REFRESH
-        from .rate_query_templates import RATE_CAGG_QUERY
+        from .rate_query_templates import (
+            RATE_CAGG_QUERY,
+            RATE_MINUTE_CAGG_QUERY,
+            RATE_MINUTE_CAGG_REFRESH,
+        )
+
+        MetricHandler.schedule_property_index_sync(metric)
 
         organization = Organization.objects.get(id=metric.organization.id)
         groupby = organization.subscription_filter_keys
@@ -1387,13 +2024,38 @@ class RateHandler(MetricHandler):
         query = Template(RATE_CAGG_QUERY).render(**sql_injection_data)
         refresh_query = Template(CAGG_REFRESH).render(**sql_injection_data)
         compression_query = Template(CAGG_COMPRESSION).render(**sql_injection_data)
+        minute_injection_data = {
+            **sql_injection_data,
+            "cagg_name": RateHandler._minute_cagg_name(metric),
+        }
+        minute_query = Template(RATE_MINUTE_CAGG_QUERY).render(**minute_injection_data)
+        minute_refresh_query = Template(RATE_MINUTE_CAGG_REFRESH).render(
+            **minute_injection_data
+        )
+        minute_compression_query = Template(CAGG_COMPRESSION).render(
+            **minute_injection_data
+        )
         with connection.cursor() as cursor:
             if refresh:
                 cursor.execute(Template(CAGG_DROP).render(**sql_injection_data))
+                cursor.execute(Template(CAGG_DROP).render(**minute_injection_data))
             cursor.execute(query)
             cursor.execute(refresh_query)
+            cursor.execute(minute_query)
+            cursor.execute(minute_refresh_query)
             if not refresh:
                 cursor.execute(compression_query)
+                cursor.execute(minute_compression_query)
+
+    @staticmethod
+    def _minute_cagg_name(metric: Metric) -> str:
+        return (
+            ("org_" + metric.organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+            + "rate_minute"
+        )
 
     @staticmethod
     def archive_metric(metric: Metric) -> Metric:
@@ -1412,8 +2074,13 @@ class RateHandler(MetricHandler):
             ),
         }
         query = Template(CAGG_DROP).render(**sql_injection_data)
+        minute_query = Template(CAGG_DROP).render(
+            cagg_name=RateHandler._minute_cagg_name(metric)
+        )
         with connection.cursor() as cursor:
             cursor.execute(query)
+            cursor.execute(minute_query)
+        MetricHandler.schedule_property_index_sync(metric, exclude_metric=True)
         return metric
 
     @staticmethod
@@ -1444,9 +2111,9 @@ class RateHandler(MetricHandler):
         injection_dict["group_by"] = organization.subscription_filter_keys
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
-        query = Template(RATE_CAGG_TOTAL).render(**injection_dict)
+        query, params = build_query(RATE_CAGG_TOTAL, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             results = namedtuplefetchall(cursor)
         return results
 
@@ -1460,6 +2127,63 @@ class RateHandler(MetricHandler):
         total = results[0].usage_qty
         return total
 
+    @staticmethod
+    def get_billing_records_total_billable_usage(
+        metric: Metric, billing_records: list[BillingRecord]
+    ) -> dict[BillingRecord, Decimal]:
+        from metering_billing.aggregation.rate_query_templates import (
+            RATE_CAGG_TOTAL_BATCH,
+        )
+        from metering_billing.models import Organization
+
+        organization = Organization.objects.get(id=metric.organization.id)
+        group_by = organization.subscription_filter_keys
+        injection_dict = {
+            "query_type": metric.usage_aggregation_type,
+            "group_by": group_by,
+            "cagg_name": ("org_" + organization.organization_id.hex)[:22]
+            + "___"
+            + ("metric_" + metric.metric_id.hex)[:22]
+            + "___"
+            + "rate_cagg",
+            "lookback_qty": 1,
+            "lookback_units": metric.granularity,
+        }
+        billing_records = list(billing_records)
+        totals = {}
+        for chunk_start in range(0, len(billing_records), BATCH_USAGE_CHUNK_SIZE):
+            windows = []
+            for record_idx in range(
+                chunk_start,
+                min(chunk_start + BATCH_USAGE_CHUNK_SIZE, len(billing_records)),
+            ):
+                billing_record = billing_records[record_idx]
+                filters = dict(billing_record.subscription.subscription_filters)
+                windows.append(
+                    {
+                        "record_idx": record_idx,
+                        "window_kind": "rate",
+                        "uuidv5_customer_id": billing_record.customer.uuidv5_customer_id,
+                        "start_date": billing_record.start_date.replace(microsecond=0),
+                        "end_date": billing_record.end_date.replace(microsecond=0),
+                        "filter_values": [
+                            str(filters[key]) if key in filters else None
+                            for key in group_by
+                        ],
+                    }
+                )
+            injection_dict["windows"] = windows
+            query, params = build_query(RATE_CAGG_TOTAL_BATCH, **injection_dict)
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                results = namedtuplefetchall(cursor)
+            for result in results:
+                totals[result.record_idx] = result.usage_qty
+        return {
+            billing_record: totals.get(record_idx, Decimal(0))
+            for record_idx, billing_record in enumerate(billing_records)
+        }
+
     @staticmethod
     def get_billing_record_current_usage(
         metric: Metric, billing_record: BillingRecord
@@ -1478,11 +2202,7 @@ class RateHandler(MetricHandler):
             "uuidv5_customer_id": billing_record.customer.uuidv5_customer_id,
             "start_date": start.replace(microsecond=0),
             "end_date": end.replace(microsecond=0),
-            "cagg_name": ("org_" + organization.organization_id.hex)[:22]
-            + "___"
-            + ("metric_" + metric.metric_id.hex)[:22]
-            + "___"
-            + "second",
+            "minute_cagg": RateHandler._minute_cagg_name(metric),
             "property_name": metric.property_name,
             "uuidv5_event_name": uuid.uuid5(EVENT_NAME_NAMESPACE, metric.event_name),
             "organization_id": organization.id,
@@ -1501,9 +2221,9 @@ class RateHandler(MetricHandler):
         injection_dict["group_by"] = organization.subscription_filter_keys
         for filter in billing_record.subscription.subscription_filters:
             injection_dict["filter_properties"][filter[0]] = [filter[1]]
-        query = Template(RATE_GET_CURRENT_USAGE).render(**injection_dict)
+        query, params = build_query(RATE_GET_CURRENT_USAGE, **injection_dict)
         with connection.cursor() as cursor:
-            cursor.execute(query)
+            cursor.execute(query, params)
             results = namedtuplefetchall(cursor)
         if len(results) == 0:
             return Decimal(0)
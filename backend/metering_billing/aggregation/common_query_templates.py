@@ -18,3 +18,70 @@ SELECT add_compression_policy(
     if_not_exists=>true
 );
 """
+
+# one row per (billing record, time window), used by the batch usage queries to compute
+# the usage of many billing records in a single statement. The windows are bound as one
+# array per column by build_query. Every subscription filter key of the organization
+# gets a filter_<key> column, NULL when the record doesn't filter on that key
+BILLING_RECORD_WINDOWS = """
+WITH windows AS (
+    SELECT *
+    FROM unnest(
+        %({{ param_prefix }}window_record_idx)s::integer[]
+        , %({{ param_prefix }}window_kind)s::text[]
+        , %({{ param_prefix }}window_uuidv5_customer_id)s::uuid[]
+        , %({{ param_prefix }}window_start_date)s::timestamptz[]
+        , %({{ param_prefix }}window_end_date)s::timestamptz[]
+        {%- for group_by_field in group_by %}
+        , %({{ param_prefix }}window_filter_{{ loop.index0 }})s::text[]
+        {%- endfor %}
+    ) AS window_rows (
+        record_idx
+        , window_kind
+        , uuidv5_customer_id
+        , start_date
+        , end_date
+        {%- for group_by_field in group_by %}
+        , filter_{{ group_by_field }}
+        {%- endfor %}
+    )
+)
+"""
+
+# an index on the events of one organization and event name, with the properties the
+# metrics on them filter and group by as expression columns. The expressions and the
+# WHERE clause match the ones the query templates render, so the planner uses it for
+# cagg refreshes and the reads from the raw events. Properties are only extracted as
+# text, a cast could fail the insert of an event with a property that isn't a number.
+# The property names come from users, so they're passed as %(property_<i>)s parameters
+# and quoted by the driver instead of being rendered into the DDL
+PROPERTY_INDEX_CREATE = """
+CREATE INDEX IF NOT EXISTS {{ index_name }}
+ON "metering_billing_usageevent" (
+    "uuidv5_customer_id"
+    {%- for property_name in properties %}
+    , ("properties" ->> %(property_{{ loop.index0 }})s)
+    {%- endfor %}
+    , "time_created" DESC
+)
+WITH (timescaledb.transaction_per_chunk)
+WHERE
+    "organization_id" = {{ organization_id }}
+    AND "uuidv5_event_name" = '{{ uuidv5_event_name }}'
+"""
+
+PROPERTY_INDEX_LIST = """
+SELECT
+    index_class.relname
+    , pg_index.indisvalid
+FROM pg_index
+JOIN pg_class AS index_class
+    ON index_class.oid = pg_index.indexrelid
+WHERE
+    pg_index.indrelid = '"metering_billing_usageevent"'::regclass
+    AND left(index_class.relname, %s) = %s
+"""
+
+PROPERTY_INDEX_DROP = """
+DROP INDEX IF EXISTS {{ index_name }};
+"""
@@ -1,5 +1,9 @@
+from .common_query_templates import BILLING_RECORD_WINDOWS
+
 # this will be our basic materialized view where we keep track of stuff per day
 # THIS IS A MATERIALIZED VIEW
+# if hll_buckets is set, it keeps a mergeable HyperLogLog sketch of the unique values in
+# each bucket instead of a usage_qty (needs the timescaledb_toolkit extension)
 COUNTER_CAGG_QUERY = """
 CREATE MATERIALIZED VIEW IF NOT EXISTS {{ cagg_name }}
 WITH ( timescaledb.continuous ) AS
@@ -7,6 +11,12 @@ SELECT
     "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
     , time_bucket('1 {{bucket_size}}', "metering_billing_usageevent"."time_created") AS bucket
     , COUNT("metering_billing_usageevent"."idempotency_id") AS num_events
+    {%- if hll_buckets %}
+    , hyperloglog(
+        {{ hll_buckets }},
+        "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+    ) AS usage_hll
+    {%- else %}
     , {%- if query_type == "count" -%}
     COUNT("metering_billing_usageevent"."idempotency_id")
     {%- elif query_type == "sum" -%}
@@ -24,6 +34,7 @@ SELECT
         ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
     )
     {%- endif %} AS usage_qty
+    {%- endif %}
     {%- for group_by_field in group_by %}
     , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
     {%- endfor %}
@@ -49,16 +60,19 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     uuidv5_customer_id
@@ -68,8 +82,93 @@ GROUP BY
     {%- endfor %}
 """
 
-# this query is used to get all the usage aggregated over the entire time period using the
+# this query is used to get all the usage aggregated over the entire time period. The
+# period is split into cagg_windows of whole days, whole hours and the seconds left over,
+# each read from the cagg of that granularity (or from the raw events if the metric
+# doesn't keep a per second cagg) and combined into daily rows in one query
 COUNTER_CAGG_TOTAL = """
+WITH tiers AS (
+    {%- for tier in cagg_windows %}
+    {%- if tier == "events" %}
+    SELECT
+        "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+        {%- endfor %}
+        , "metering_billing_usageevent"."time_created" AS bucket
+        , 1 AS num_events
+        , {%- if query_type == "count" %} 1
+        {%- else %} ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        {%- endif %} AS usage_qty
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ comparison }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
+            )
+        )
+        {%- endfor %}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
+        AND "metering_billing_usageevent"."time_created" >= %({{ param_prefix }}window_{{ loop.index0 }}_start)s::timestamptz
+        AND "metering_billing_usageevent"."time_created" < %({{ param_prefix }}window_{{ loop.index0 }}_end)s::timestamptz
+        {%- for property_name in filter_properties %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+    {%- else %}
+    SELECT
+        uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , {{ group_by_field }}
+        {%- endfor %}
+        , bucket
+        , num_events
+        , usage_qty
+    FROM
+        {{ cagg_prefix }}{{ tier }}
+    WHERE
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        AND bucket >= %({{ param_prefix }}window_{{ loop.index0 }}_start)s::timestamptz
+        AND bucket < %({{ param_prefix }}window_{{ loop.index0 }}_end)s::timestamptz
+        AND bucket <= NOW()
+        {%- for property_name in filter_properties %}
+        AND {{ property_name }}
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+    {%- endif %}
+    {%- if not loop.last %}
+    UNION ALL
+    {%- endif %}
+    {%- endfor %}
+)
 SELECT
     uuidv5_customer_id
     {%- for group_by_field in group_by %}
@@ -85,29 +184,15 @@ SELECT
     {%- elif query_type == "max" -%}
     MAX(usage_qty)
     {%- endif %} AS usage_qty
-    , bucket
+    , time_bucket('1 day', bucket) AS bucket
 FROM
-    {{ cagg_name }}
-WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-    AND bucket >= '{{ start_date }}'::timestamptz
-    AND bucket <= '{{ end_date }}'::timestamptz
-    AND bucket <= NOW()
-    {%- for property_name, property_values in filter_properties.items() %}
-    AND {{ property_name }}
-        IN (
-            {%- for pval in property_values %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
-        )
-    {%- endfor %}
+    tiers
 GROUP BY
     uuidv5_customer_id
     {%- for group_by_field in group_by %}
     , {{ group_by_field }}
     {%- endfor %}
-    , bucket
+    , time_bucket('1 day', bucket)
 """
 
 
@@ -125,19 +210,14 @@ WHERE
     "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
     AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
     AND "metering_billing_usageevent"."time_created" <= NOW()
-    AND "metering_billing_usageevent"."time_created" >= '{{ start_date }}'::timestamptz
-    AND "metering_billing_usageevent"."time_created" <= '{{ end_date }}'::timestamptz
+    AND "metering_billing_usageevent"."time_created" >= %(start_date)s::timestamptz
+    AND "metering_billing_usageevent"."time_created" <= %(end_date)s::timestamptz
     {%- if uuidv5_customer_id is not none %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
     {% endif %}
-    {%- for property_name, property_values in filter_properties.items() %}
+    {%- for property_name in filter_properties %}
     AND {{ property_name }}
-        IN (
-            {%- for pval in property_values %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
-        )
+        = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
     {%- endfor %}
     {%- for property_name, operator, comparison in numeric_filters %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
@@ -155,16 +235,19 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     "metering_billing_usageevent"."uuidv5_customer_id"
@@ -174,6 +257,114 @@ GROUP BY
 """
 
 
+# approximate version of COUNTER_UNIQUE_TOTAL. The whole hours of the period are read from
+# the sketches in the hll cagg, the partial hours at either end are sketched from the raw
+# events, and everything is merged into one sketch per customer / subscription filter
+COUNTER_UNIQUE_HLL_TOTAL = """
+WITH sketches AS (
+    SELECT
+        uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , {{ group_by_field }}
+        {%- endfor %}
+        , usage_hll
+        , num_events
+    FROM
+        {{ cagg_name }}
+    WHERE
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        AND bucket >= %(sketch_start)s::timestamptz
+        AND bucket < %(sketch_end)s::timestamptz
+        AND bucket <= NOW()
+        {%- for property_name in filter_properties %}
+        AND {{ property_name }}
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+    UNION ALL
+    SELECT
+        "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+        {%- endfor %}
+        , hyperloglog(
+            {{ hll_buckets }},
+            "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+        ) AS usage_hll
+        , COUNT(*) AS num_events
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        AND (
+            (
+                "metering_billing_usageevent"."time_created" >= %(start_date)s::timestamptz
+                AND "metering_billing_usageevent"."time_created" < %(sketch_start)s::timestamptz
+            )
+            OR (
+                "metering_billing_usageevent"."time_created" >= %(sketch_end)s::timestamptz
+                AND "metering_billing_usageevent"."time_created" <= %(end_date)s::timestamptz
+            )
+        )
+        {%- for property_name in filter_properties %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ comparison }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
+            )
+        )
+        {%- endfor %}
+    GROUP BY
+        "metering_billing_usageevent"."uuidv5_customer_id"
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}'
+        {%- endfor %}
+)
+SELECT
+    uuidv5_customer_id
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+    , distinct_count(rollup(usage_hll)) AS usage_qty
+    , SUM(num_events) AS num_events
+FROM
+    sketches
+GROUP BY
+    uuidv5_customer_id
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+"""
+
+
 COUNTER_UNIQUE_PER_DAY = """
 SELECT DISTINCT ON (
     "metering_billing_usageevent"."uuidv5_customer_id",
@@ -194,10 +385,10 @@ WHERE
     "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
     AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
     AND "metering_billing_usageevent"."time_created" <= NOW()
-    AND "metering_billing_usageevent"."time_created" >= '{{ start_date }}'::timestamptz
-    AND "metering_billing_usageevent"."time_created" <= '{{ end_date }}'::timestamptz
+    AND "metering_billing_usageevent"."time_created" >= %(start_date)s::timestamptz
+    AND "metering_billing_usageevent"."time_created" <= %(end_date)s::timestamptz
     {%- if uuidv5_customer_id is not none %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
+    AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
     {% endif %}
 ORDER BY
     "metering_billing_usageevent"."uuidv5_customer_id"
@@ -220,10 +411,10 @@ WITH per_customer AS (
     WHERE
         bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND bucket >= '{{ start_date }}'::timestamptz
-        AND bucket <=  '{{ end_date }}'::timestamptz
+        AND bucket >= %(start_date)s::timestamptz
+        AND bucket <=  %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -255,3 +446,170 @@ GROUP BY
     COALESCE(top_n.uuidv5_customer_id, uuid_nil())
     , per_customer.time_bucket
 """
+
+
+# batch version of COUNTER_CAGG_TOTAL, the windows of every billing record are joined
+# against the caggs (and raw events) of their granularity at once and aggregated per record
+COUNTER_CAGG_TOTAL_BATCH = BILLING_RECORD_WINDOWS + """
+{%- for window_kind in window_kinds %}
+{%- if window_kind == "events" %}
+SELECT
+    windows.record_idx
+    , COUNT(*) AS num_events
+    , SUM(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    ) AS sum_qty
+    , SUM(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    ) AS weighted_qty
+    , MAX(
+        ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+    ) AS max_qty
+FROM
+    windows
+INNER JOIN
+    "metering_billing_usageevent"
+ON
+    "metering_billing_usageevent"."uuidv5_customer_id" = windows.uuidv5_customer_id
+    AND "metering_billing_usageevent"."time_created" >= windows.start_date
+    AND "metering_billing_usageevent"."time_created" < windows.end_date
+WHERE
+    windows.window_kind = 'events'
+    AND "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+    AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+    AND "metering_billing_usageevent"."time_created" <= NOW()
+    {%- for property_name, operator, comparison in numeric_filters %}
+    AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        {% if operator == "gt" %}
+        >
+        {% elif operator == "gte" %}
+        >=
+        {% elif operator == "lt" %}
+        <
+        {% elif operator == "lte" %}
+        <=
+        {% elif operator == "eq" %}
+        =
+        {% endif %}
+        {{ comparison }}
+    {%- endfor %}
+    {%- for property_name, operator, comparison in categorical_filters %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
+        )
+    )
+    {%- endfor %}
+    {%- for group_by_field in group_by %}
+    AND (
+        windows.filter_{{ group_by_field }} IS NULL
+        OR "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' = windows.filter_{{ group_by_field }}
+    )
+    {%- endfor %}
+GROUP BY
+    windows.record_idx
+{%- else %}
+SELECT
+    windows.record_idx
+    , SUM(cagg.num_events) AS num_events
+    , SUM(cagg.usage_qty) AS sum_qty
+    , SUM(cagg.usage_qty * cagg.num_events) AS weighted_qty
+    , MAX(cagg.usage_qty) AS max_qty
+FROM
+    windows
+INNER JOIN
+    {{ cagg_prefix }}{{ window_kind }} AS cagg
+ON
+    cagg.uuidv5_customer_id = windows.uuidv5_customer_id
+    AND cagg.bucket >= windows.start_date
+    AND cagg.bucket < windows.end_date
+WHERE
+    windows.window_kind = '{{ window_kind }}'
+    AND cagg.bucket <= NOW()
+    {%- for group_by_field in group_by %}
+    AND (
+        windows.filter_{{ group_by_field }} IS NULL
+        OR cagg.{{ group_by_field }} = windows.filter_{{ group_by_field }}
+    )
+    {%- endfor %}
+GROUP BY
+    windows.record_idx
+{%- endif %}
+{%- if not loop.last %}
+UNION ALL
+{%- endif %}
+{%- endfor %}
+"""
+
+
+# batch version of COUNTER_UNIQUE_TOTAL
+COUNTER_UNIQUE_TOTAL_BATCH = BILLING_RECORD_WINDOWS + """
+SELECT
+    windows.record_idx
+    {%- for group_by_field in group_by %}
+    , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+    {%- endfor %}
+    , COUNT( DISTINCT "metering_billing_usageevent"."properties" ->> '{{ property_name }}' ) AS usage_qty
+    , COUNT( * ) AS num_events
+FROM
+    windows
+INNER JOIN
+    "metering_billing_usageevent"
+ON
+    "metering_billing_usageevent"."uuidv5_customer_id" = windows.uuidv5_customer_id
+    AND "metering_billing_usageevent"."time_created" >= windows.start_date
+    AND "metering_billing_usageevent"."time_created" <= windows.end_date
+WHERE
+    "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+    AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+    AND "metering_billing_usageevent"."time_created" <= NOW()
+    {%- for group_by_field in group_by %}
+    AND (
+        windows.filter_{{ group_by_field }} IS NULL
+        OR "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' = windows.filter_{{ group_by_field }}
+    )
+    {%- endfor %}
+    {%- for property_name, operator, comparison in numeric_filters %}
+    AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        {% if operator == "gt" %}
+        >
+        {% elif operator == "gte" %}
+        >=
+        {% elif operator == "lt" %}
+        <
+        {% elif operator == "lte" %}
+        <=
+        {% elif operator == "eq" %}
+        =
+        {% endif %}
+        {{ comparison }}
+    {%- endfor %}
+    {%- for property_name, operator, comparison in categorical_filters %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
+        )
+    )
+    {%- endfor %}
+GROUP BY
+    windows.record_idx
+    {%- for group_by_field in group_by %}
+    , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}'
+    {%- endfor %}
+"""
@@ -35,16 +35,19 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     "metering_billing_usageevent"."uuidv5_customer_id"
@@ -69,17 +72,12 @@ WITH cumsum_cagg_daily AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
-        AND time_bucket < date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND time_bucket < date_trunc('day', %(start_date)s::timestamptz)
         AND time_bucket <= CURRENT_DATE
     GROUP BY
         uuidv5_customer_id
@@ -101,8 +99,8 @@ WITH cumsum_cagg_daily AS (
         "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
         AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
-        AND "metering_billing_usageevent"."time_created" < '{{ start_date }}'::timestamptz
-        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND "metering_billing_usageevent"."time_created" < %(start_date)s::timestamptz
+        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', %(start_date)s::timestamptz)
         {%- for property_name, operator, comparison in numeric_filters %}
         AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -119,16 +117,19 @@ WITH cumsum_cagg_daily AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
         {%- endfor %}
     GROUP BY
         uuidv5_customer_id
@@ -172,8 +173,8 @@ cumulative_sum_per_event AS (
        event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
         AND event_table.organization_id = {{ organization_id }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= %(start_date)s::timestamptz
+        AND event_table.time_created <= %(end_date)s::timestamptz
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -190,16 +191,19 @@ cumulative_sum_per_event AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (event_table.properties ->> '{{ property_name }}')
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            event_table.properties ->> '{{ property_name }}'
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
         {%- endfor %}
 ),
 proration_level_query AS (
@@ -210,7 +214,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , %(start_date)s::timestamptz AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -226,19 +230,14 @@ proration_level_query AS (
     FROM
         cumulative_sum_per_event
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -250,21 +249,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < %(start_date)s::timestamptz
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM %(start_date)s::timestamptz)
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > %(end_date)s::timestamptz
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM %(end_date)s::timestamptz) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -309,17 +308,12 @@ WITH cumsum_cagg_daily AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
-        AND time_bucket < date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND time_bucket < date_trunc('day', %(start_date)s::timestamptz)
         AND time_bucket <= CURRENT_DATE
     GROUP BY
         uuidv5_customer_id
@@ -341,8 +335,8 @@ WITH cumsum_cagg_daily AS (
         "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
         AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
-        AND "metering_billing_usageevent"."time_created" < '{{ start_date }}'::timestamptz
-        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', '{{ start_date }}'::timestamptz)
+        AND "metering_billing_usageevent"."time_created" < %(start_date)s::timestamptz
+        AND date_trunc('day', "metering_billing_usageevent"."time_created") = date_trunc('day', %(start_date)s::timestamptz)
         {%- for property_name, operator, comparison in numeric_filters %}
         AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -359,16 +353,19 @@ WITH cumsum_cagg_daily AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
         {%- endfor %}
     GROUP BY
         uuidv5_customer_id
@@ -412,8 +409,8 @@ cumulative_sum_per_event AS (
        event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
         AND event_table.organization_id = {{ organization_id }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= %(start_date)s::timestamptz
+        AND event_table.time_created <= %(end_date)s::timestamptz
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -430,16 +427,19 @@ cumulative_sum_per_event AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (event_table.properties ->> '{{ property_name }}')
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            event_table.properties ->> '{{ property_name }}'
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
         {%- endfor %}
 ),
 proration_level_query AS (
@@ -450,7 +450,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , %(start_date)s::timestamptz AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -466,19 +466,14 @@ proration_level_query AS (
     FROM
         cumulative_sum_per_event
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -490,21 +485,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < %(start_date)s::timestamptz
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM %(start_date)s::timestamptz)
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > %(end_date)s::timestamptz
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM %(end_date)s::timestamptz) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -549,15 +544,10 @@ WITH cumsum_cagg_daily AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
         AND time_bucket < CURRENT_DATE
     GROUP BY
@@ -571,7 +561,6 @@ WITH cumsum_cagg_daily AS (
         {%- for group_by_field in group_by %}
         ,"metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
         {%- endfor %}
-        , "metering_billing_usageevent"."time_created" AS time_bucket
         , SUM(
             ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
         ) AS today_change
@@ -581,7 +570,7 @@ WITH cumsum_cagg_daily AS (
         "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
         AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
         AND "metering_billing_usageevent"."time_created" <= NOW()
-        AND date_trunc("day", "metering_billing_usageevent"."time_created") = CURRENT_DATE
+        AND date_trunc('day', "metering_billing_usageevent"."time_created") = CURRENT_DATE
         {%- for property_name, operator, comparison in numeric_filters %}
         AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -598,29 +587,32 @@ WITH cumsum_cagg_daily AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
+        {%- endfor %}
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
         , {{ group_by_field }}
         {%- endfor %}
-        , "metering_billing_usageevent"."time_created"
 )
 SELECT
     uuidv5_customer_id
     {%- for group_by_field in group_by %}
     , {{ group_by_field }}
     {%- endfor %}
-    , COALESCE(prev_days_usage_qty, 0) + COALESCE(today_change, 0) AS current_usage_qty
+    , COALESCE(prev_days_usage_qty, 0) + COALESCE(today_change, 0) AS usage_qty
 FROM
     cumsum_cagg_daily
 FULL OUTER JOIN
@@ -641,9 +633,9 @@ WITH prev_value AS (
     WHERE
         time_bucket <= CURRENT_DATE
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < %(start_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -677,8 +669,8 @@ WITH prev_value AS (
         event_table.uuidv5_event_name = '{{ uuidv5_event_name }}'
         AND event_table.organization_id = {{ organization_id }}
         AND event_table.time_created <= NOW()
-        AND event_table.time_created >= '{{ start_date }}'::timestamptz
-        AND event_table.time_created <= '{{ end_date }}'::timestamptz
+        AND event_table.time_created >= %(start_date)s::timestamptz
+        AND event_table.time_created <= %(end_date)s::timestamptz
         {%- for property_name, operator, comparison in numeric_filters %}
         AND (event_table.properties ->> '{{ property_name }}')::text::decimal
             {% if operator == "gt" %}
@@ -695,16 +687,19 @@ WITH prev_value AS (
             {{ comparison }}
         {%- endfor %}
         {%- for property_name, operator, comparison in categorical_filters %}
-        AND (event_table.properties ->> '{{ property_name }}')
-            {% if operator == "isnotin" %}
-            NOT
-            {% endif %}
-            IN (
-                {%- for pval in comparison %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            event_table.properties ->> '{{ property_name }}'
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
             )
+        )
         {%- endfor %}
 )
 , proration_level_query AS (
@@ -727,19 +722,14 @@ WITH prev_value AS (
         cumulative_sum_per_event
     WHERE
         time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
         {%- if uuidv5_customer_id is not none %}
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = %(uuidv5_customer_id)s
         {%- endif %}
-        {%- for property_name, property_values in filter_properties.items() %}
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %} 
     GROUP BY
         uuidv5_customer_id
@@ -758,10 +748,10 @@ WITH prev_value AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -829,16 +819,19 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     uuidv5_customer_id
@@ -858,15 +851,10 @@ SELECT
 FROM
     {{ cumsum_cagg }}
 WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-    {%- for property_name, property_values in filter_properties.items() %}
+    uuidv5_customer_id = %(uuidv5_customer_id)s
+    {%- for property_name in filter_properties %}
     AND {{ property_name }}
-        IN (
-            {%- for pval in property_values %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
-        )
+        = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
     {%- endfor %}
     AND time_bucket <= NOW()
 GROUP BY
@@ -887,17 +875,12 @@ WITH prev_state AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < %(start_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -922,7 +905,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , %(start_date)s::timestamptz AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -938,19 +921,14 @@ proration_level_query AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -962,21 +940,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < %(start_date)s::timestamptz
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM %(start_date)s::timestamptz)
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > %(end_date)s::timestamptz
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM %(end_date)s::timestamptz) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -1020,17 +998,12 @@ WITH prev_state AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < %(start_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1055,7 +1028,7 @@ proration_level_query AS (
         {%- endfor %}
         {%- if proration_units is none %}
         , MAX(cumulative_usage_qty) AS usage_qty
-        , '{{ start_date }}'::timestamptz AS time
+        , %(start_date)s::timestamptz AS time
         {%- else %}
         , time_bucket_gapfill('1 {{ proration_units }}', time_bucket) AS time
         , locf(
@@ -1071,19 +1044,14 @@ proration_level_query AS (
     FROM
         {{ cumsum_cagg }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        {%- for property_name, property_values in filter_properties.items() %}
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
         AND time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1095,21 +1063,21 @@ normalized_query AS (
 SELECT
     {%- if proration_units is not none %}
     CASE
-    WHEN time < '{{ start_date }}'::timestamptz
+    WHEN time < %(start_date)s::timestamptz
         THEN
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
-                EXTRACT( EPOCH FROM '{{ start_date }}'::timestamptz)
+                EXTRACT( EPOCH FROM %(start_date)s::timestamptz)
             )
             /
             (
                 EXTRACT( EPOCH FROM (time + '1 {{ proration_units }}'::interval)) -
                 EXTRACT( EPOCH FROM time)
             )
-    WHEN time > '{{ end_date }}'::timestamptz
+    WHEN time > %(end_date)s::timestamptz
         THEN
             (
-                EXTRACT( EPOCH FROM '{{ end_date }}'::timestamptz) -
+                EXTRACT( EPOCH FROM %(end_date)s::timestamptz) -
                 EXTRACT( EPOCH FROM time)
             )
             /
@@ -1147,9 +1115,9 @@ WITH prev_value AS (
     WHERE
         time_bucket <= CURRENT_DATE
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket < '{{ start_date }}'::timestamptz
+        AND time_bucket < %(start_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -1187,19 +1155,14 @@ WITH prev_value AS (
         {{ cagg_name }}
     WHERE
         time_bucket <= NOW()
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
         {% if uuidv5_customer_id is not none %}
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        uuidv5_customer_id = %(uuidv5_customer_id)s
         {%- endif %}
-        {%- for property_name, property_values in filter_properties.items() %}
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
     GROUP BY
         uuidv5_customer_id
@@ -1218,10 +1181,10 @@ WITH prev_value AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         , time_bucket
@@ -1253,3 +1216,301 @@ GROUP BY
     COALESCE(top_n.uuidv5_customer_id, uuid_nil())
     , per_customer.time_bucket
 """
+
+
+### INCREMENTAL STATE
+# gauges with incremental_state keep the running state of every customer and set of
+# subscription filter values in metering_billing_gaugestate. A trigger adds events
+# from before the checkpoint as they are written, advancing the checkpoint moves the
+# events in between into the state, and the current usage is the state plus the
+# events since the checkpoint. The trigger holds a shared advisory lock on the metric
+# and advancing an exclusive one, so every event ends up in the state exactly once
+
+# metric filters and the property for a row of the event table, written so that a
+# property that isn't a number never reaches a cast and fails the insert
+GAUGE_STATE_EVENT_FILTERS = """
+{%- macro event_filters(event) %}
+    COALESCE({{ event }}.properties ->> '{{ property_name }}', '') ~ '{{ numeric_pattern }}'
+    {%- for filter_property, operator, comparison in numeric_filters %}
+    AND CASE
+        WHEN COALESCE({{ event }}.properties ->> '{{ filter_property }}', '') ~ '{{ numeric_pattern }}'
+        THEN ({{ event }}.properties ->> '{{ filter_property }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ comparison }}
+        ELSE FALSE
+    END
+    {%- endfor %}
+    {%- for filter_property, operator, comparison in categorical_filters %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE({{ event }}.properties ->> '{{ filter_property }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
+        )
+    )
+    {%- endfor %}
+{%- endmacro %}
+{%- macro group_values(event) -%}
+    jsonb_build_object(
+        {%- for group_by_field in group_by %}
+        '{{ group_by_field }}', {{ event }}.properties ->> '{{ group_by_field }}'
+        {%- if not loop.last %},{% endif %}
+        {%- endfor %}
+    )
+{%- endmacro %}
+{%- macro state_checkpoint() -%}
+    COALESCE(
+        (
+            SELECT checkpoint
+            FROM "metering_billing_gaugestate"
+            WHERE metric_id = {{ metric_id }}
+            LIMIT 1
+        ),
+        '-infinity'::timestamptz
+    )
+{%- endmacro %}
+"""
+
+GAUGE_STATE_TRIGGER = GAUGE_STATE_EVENT_FILTERS + """
+CREATE OR REPLACE FUNCTION tg_{{ state_name }}() RETURNS trigger AS $$
+DECLARE
+    state_checkpoint timestamptz;
+BEGIN
+    PERFORM pg_advisory_xact_lock_shared({{ lock_class }}, {{ metric_id }});
+    SELECT checkpoint INTO state_checkpoint
+    FROM "metering_billing_gaugestate"
+    WHERE metric_id = {{ metric_id }}
+    LIMIT 1;
+    -- later events are read from the event table until the checkpoint passes them
+    IF state_checkpoint IS NULL OR NEW.time_created >= state_checkpoint THEN
+        RETURN NULL;
+    END IF;
+    IF NOT ({{ event_filters("NEW") }}
+    ) THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO "metering_billing_gaugestate" (
+        metric_id,
+        uuidv5_customer_id,
+        group_values,
+        usage_qty,
+        last_event_time,
+        checkpoint
+    )
+    VALUES (
+        {{ metric_id }},
+        NEW.uuidv5_customer_id,
+        {{ group_values("NEW") }},
+        (NEW.properties ->> '{{ property_name }}')::text::decimal,
+        NEW.time_created,
+        state_checkpoint
+    )
+    ON CONFLICT (metric_id, uuidv5_customer_id, group_values) DO UPDATE SET
+    {%- if event_type == "delta" %}
+        usage_qty = "metering_billing_gaugestate".usage_qty + EXCLUDED.usage_qty
+        , last_event_time = GREATEST(
+            "metering_billing_gaugestate".last_event_time, EXCLUDED.last_event_time
+        )
+    {%- else %}
+        usage_qty = EXCLUDED.usage_qty
+        , last_event_time = EXCLUDED.last_event_time
+    WHERE
+        "metering_billing_gaugestate".last_event_time IS NULL
+        OR "metering_billing_gaugestate".last_event_time <= EXCLUDED.last_event_time
+    {%- endif %};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS tg_{{ state_name }}_insert ON "metering_billing_usageevent";
+CREATE TRIGGER tg_{{ state_name }}_insert
+    AFTER INSERT ON "metering_billing_usageevent"
+    FOR EACH ROW
+    WHEN (
+        NEW.uuidv5_event_name = '{{ uuidv5_event_name }}'
+        AND NEW.organization_id = {{ organization_id }}
+    )
+    EXECUTE FUNCTION tg_{{ state_name }}();
+"""
+
+GAUGE_STATE_DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS tg_{{ state_name }}_insert ON "metering_billing_usageevent";
+DROP FUNCTION IF EXISTS tg_{{ state_name }};
+"""
+
+# moves the events between the current checkpoint and the new one into the state. The
+# rows without new events get the new checkpoint in a separate UPDATE
+GAUGE_STATE_ADVANCE = GAUGE_STATE_EVENT_FILTERS + """
+WITH new_events AS (
+    SELECT
+        "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+        , {{ group_values('"metering_billing_usageevent"') }} AS group_values
+        {%- if event_type == "delta" %}
+        , SUM(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        ) AS usage_qty
+        {%- else %}
+        , last(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            , "metering_billing_usageevent"."time_created"
+        ) AS usage_qty
+        {%- endif %}
+        , MAX("metering_billing_usageevent"."time_created") AS last_event_time
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."time_created" >= {{ state_checkpoint() }}
+        AND "metering_billing_usageevent"."time_created" < %(state_checkpoint)s
+        AND {{ event_filters('"metering_billing_usageevent"') }}
+    GROUP BY
+        1, 2
+)
+INSERT INTO "metering_billing_gaugestate" (
+    metric_id,
+    uuidv5_customer_id,
+    group_values,
+    usage_qty,
+    last_event_time,
+    checkpoint
+)
+SELECT
+    {{ metric_id }}
+    , uuidv5_customer_id
+    , group_values
+    , usage_qty
+    , last_event_time
+    , %(state_checkpoint)s
+FROM
+    new_events
+ON CONFLICT (metric_id, uuidv5_customer_id, group_values) DO UPDATE SET
+{%- if event_type == "delta" %}
+    usage_qty = "metering_billing_gaugestate".usage_qty + EXCLUDED.usage_qty
+    , last_event_time = GREATEST(
+        "metering_billing_gaugestate".last_event_time, EXCLUDED.last_event_time
+    )
+{%- else %}
+    usage_qty = CASE
+        WHEN "metering_billing_gaugestate".last_event_time IS NULL
+            OR "metering_billing_gaugestate".last_event_time <= EXCLUDED.last_event_time
+        THEN EXCLUDED.usage_qty
+        ELSE "metering_billing_gaugestate".usage_qty
+    END
+    , last_event_time = GREATEST(
+        "metering_billing_gaugestate".last_event_time, EXCLUDED.last_event_time
+    )
+{%- endif %}
+    , checkpoint = EXCLUDED.checkpoint
+"""
+
+GAUGE_STATE_SET_CHECKPOINT = """
+UPDATE
+    "metering_billing_gaugestate"
+SET
+    checkpoint = %(state_checkpoint)s
+WHERE
+    metric_id = {{ metric_id }}
+    AND checkpoint <> %(state_checkpoint)s
+"""
+
+GAUGE_DELTA_GET_CURRENT_USAGE_FROM_STATE = GAUGE_STATE_EVENT_FILTERS + """
+WITH state AS (
+    SELECT
+        SUM(usage_qty) AS usage_qty
+    FROM
+        "metering_billing_gaugestate"
+    WHERE
+        metric_id = {{ metric_id }}
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
+        AND group_values ->> '{{ property_name }}'
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+), since_checkpoint AS (
+    SELECT
+        SUM(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        ) AS usage_qty
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
+        AND "metering_billing_usageevent"."time_created" >= {{ state_checkpoint() }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name in filter_properties %}
+        AND "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+        AND {{ event_filters('"metering_billing_usageevent"') }}
+)
+SELECT
+    COALESCE(state.usage_qty, 0) + COALESCE(since_checkpoint.usage_qty, 0) AS usage_qty
+FROM
+    state
+    , since_checkpoint
+"""
+
+GAUGE_TOTAL_GET_CURRENT_USAGE_FROM_STATE = GAUGE_STATE_EVENT_FILTERS + """
+WITH state AS (
+    SELECT
+        group_values
+        , usage_qty
+    FROM
+        "metering_billing_gaugestate"
+    WHERE
+        metric_id = {{ metric_id }}
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
+        {%- for property_name in filter_properties %}
+        AND group_values ->> '{{ property_name }}'
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+), since_checkpoint AS (
+    SELECT
+        {{ group_values('"metering_billing_usageevent"') }} AS group_values
+        , last(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            , "metering_billing_usageevent"."time_created"
+        ) AS usage_qty
+    FROM
+        "metering_billing_usageevent"
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
+        AND "metering_billing_usageevent"."time_created" >= {{ state_checkpoint() }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name in filter_properties %}
+        AND "metering_billing_usageevent"."properties" ->> '{{ property_name }}'
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+        AND {{ event_filters('"metering_billing_usageevent"') }}
+    GROUP BY
+        1
+)
+SELECT
+    COALESCE(SUM(COALESCE(since_checkpoint.usage_qty, state.usage_qty)), 0) AS usage_qty
+FROM
+    state
+FULL OUTER JOIN
+    since_checkpoint
+USING (group_values)
+"""
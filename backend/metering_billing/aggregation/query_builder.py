@@ -0,0 +1,122 @@
+from functools import lru_cache
+
+from jinja2 import Template
+
+# values that change on every lookup of the same metric. They are passed to the database
+# as bound parameters instead of being rendered into the SQL, so the text of a query only
+# depends on the shape of the metric and can be rendered once and reused
+BOUND_PARAMETERS = {
+    "uuidv5_customer_id",
+    "start_date",
+    "end_date",
+    "reference_time",
+    "sketch_start",
+    "sketch_end",
+    "state_checkpoint",
+}
+MAX_RENDERED_QUERIES = 2048
+
+_rendered_queries = {}
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> Template:
+    return Template(template)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _escape_percent(value):
+    # whatever is rendered into the SQL goes through the driver's %-interpolation along
+    # with the bound parameters, so a literal % has to be doubled
+    if isinstance(value, str):
+        return value.replace("%", "%%")
+    if isinstance(value, dict):
+        return {k: _escape_percent(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_escape_percent(v) for v in value)
+    return value
+
+
+def build_query(
+    template: str, param_prefix: str = "", **injection_dict
+) -> tuple[str, dict]:
+    """Render a query template into SQL with bound parameters.
+
+    The values named in BOUND_PARAMETERS, the values of filter_properties, the
+    comparison values of the (property, operator, comparison) numeric_filters and
+    categorical_filters, the rows of the billing record windows and the bounds of the
+    (tier, start, end) cagg_windows are pulled out of the injection dict and returned as
+    parameters for cursor.execute. Templates refer to them as %(name)s, to a filter
+    property as %(filter_<property name>)s, to the billing record windows as one array
+    per column (see BILLING_RECORD_WINDOWS) and to the bounds of the i-th cagg window as
+    %(window_<i>_start)s and %(window_<i>_end)s. The comparison of a metric filter is
+    replaced by its placeholder, so templates render it as they would a literal.
+    Everything else is the shape of the query and is still rendered by jinja, with any %
+    escaped, and the rendered SQL is cached per (template, shape) so a metric is only
+    rendered once. param_prefix is prepended to the names of every parameter besides
+    the ones in BOUND_PARAMETERS, and templates render it in front of them as
+    {{ param_prefix }}, so the queries of several metrics with the same dates and
+    customer can be combined into one statement."""
+    params = {}
+    shape = {"param_prefix": param_prefix}
+    for name, value in injection_dict.items():
+        if name in BOUND_PARAMETERS:
+            params[name] = value
+            # templates can still branch on whether the value was given
+            shape[name] = None if value is None else True
+        elif name == "filter_properties":
+            shape[name] = list(value)
+            for property_name, property_values in value.items():
+                params[f"{param_prefix}filter_{property_name}"] = list(property_values)
+        elif name in ("numeric_filters", "categorical_filters"):
+            shape[name] = []
+            for i, (property_name, operator, comparison) in enumerate(value):
+                param = f"{param_prefix}{name[:-1]}_{i}"
+                if name == "categorical_filters":
+                    comparison = [str(v) for v in comparison]
+                params[param] = comparison
+                shape[name].append(
+                    (_escape_percent(property_name), operator, f"%({param})s")
+                )
+        elif name == "windows":
+            # the (record_idx, window_kind, uuidv5_customer_id, start_date, end_date,
+            # filter_values) rows of BILLING_RECORD_WINDOWS, bound column by column
+            shape[name] = None
+            for column in (
+                "record_idx",
+                "uuidv5_customer_id",
+                "start_date",
+                "end_date",
+            ):
+                params[f"{param_prefix}window_{column}"] = [
+                    window[column] for window in value
+                ]
+            params[f"{param_prefix}window_kind"] = [
+                window["window_kind"] for window in value
+            ]
+            for i in range(len(value[0]["filter_values"]) if value else 0):
+                params[f"{param_prefix}window_filter_{i}"] = [
+                    window["filter_values"][i] for window in value
+                ]
+        elif name == "cagg_windows":
+            shape[name] = [tier for tier, _, _ in value]
+            for i, (_, window_start, window_end) in enumerate(value):
+                params[f"{param_prefix}window_{i}_start"] = window_start
+                params[f"{param_prefix}window_{i}_end"] = window_end
+        else:
+            shape[name] = _escape_percent(value)
+    key = (template, _freeze(shape))
+    query = _rendered_queries.get(key)
+    if query is None:
+        query = compile_template(template).render(**shape)
+        if len(_rendered_queries) >= MAX_RENDERED_QUERIES:
+            _rendered_queries.clear()
+        _rendered_queries[key] = query
+    return query, params
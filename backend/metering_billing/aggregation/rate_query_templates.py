@@ -1,28 +1,165 @@
+from .common_query_templates import BILLING_RECORD_WINDOWS
+
+# the usage in the window that ends at reference_time. Whole minutes of the window are
+# read from the minute cagg, so only the partial minutes at either end, including the
+# current one that hasn't been materialized yet, are scanned from the events
 RATE_GET_CURRENT_USAGE = """
+WITH window_bounds AS (
+    SELECT
+        %(reference_time)s::timestamptz + INTERVAL '-1 {{ lookback_units }}' * {{ lookback_qty }} AS window_start
+        , %(reference_time)s::timestamptz AS window_end
+), minute_bounds AS (
+    SELECT
+        window_start
+        , window_end
+        , CASE
+            WHEN date_trunc('minute', window_start) = window_start THEN window_start
+            ELSE date_trunc('minute', window_start) + INTERVAL '1 minute'
+        END AS minutes_start
+        , date_trunc('minute', window_end) AS minutes_end
+    FROM
+        window_bounds
+), per_source AS (
+    SELECT
+        uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , {{ group_by_field }}
+        {%- endfor %}
+        , num_events
+        {%- if query_type in ["sum", "average"] %}
+        , property_sum
+        , property_count
+        {%- elif query_type == "max" %}
+        , property_max
+        {%- endif %}
+    FROM
+        {{ minute_cagg }}
+        , minute_bounds
+    WHERE
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        AND bucket >= minute_bounds.minutes_start
+        AND bucket < minute_bounds.minutes_end
+        {%- for property_name in filter_properties %}
+        AND {{ property_name }}
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+    UNION ALL
+    SELECT
+        "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+        {%- for group_by_field in group_by %}
+        , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
+        {%- endfor %}
+        , COUNT("metering_billing_usageevent"."idempotency_id") AS num_events
+        {%- if query_type in ["sum", "average"] %}
+        , SUM(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        ) AS property_sum
+        , COUNT(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        ) AS property_count
+        {%- elif query_type == "max" %}
+        , MAX(
+            ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+        ) AS property_max
+        {%- endif %}
+    FROM
+        "metering_billing_usageevent"
+        , minute_bounds
+    WHERE
+        "metering_billing_usageevent"."uuidv5_event_name" = '{{ uuidv5_event_name }}'
+        AND "metering_billing_usageevent"."organization_id" = {{ organization_id }}
+        AND "metering_billing_usageevent"."time_created" <= NOW()
+        {%- for property_name, operator, comparison in numeric_filters %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
+            {% if operator == "gt" %}
+            >
+            {% elif operator == "gte" %}
+            >=
+            {% elif operator == "lt" %}
+            <
+            {% elif operator == "lte" %}
+            <=
+            {% elif operator == "eq" %}
+            =
+            {% endif %}
+            {{ comparison }}
+        {%- endfor %}
+        {%- for property_name, operator, comparison in categorical_filters %}
+        AND {% if operator == "isnotin" %}NOT {% endif %}(
+            COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+            = ANY(
+                {%- if comparison is string %} {{ comparison }}
+                {%- else %} ARRAY[
+                    {%- for pval in comparison %}
+                    '{{ pval | replace("'", "''") }}'
+                    {%- if not loop.last %},{% endif %}
+                    {%- endfor %}
+                ]::text[]
+                {%- endif %}
+            )
+        )
+        {%- endfor %}
+        AND "metering_billing_usageevent"."uuidv5_customer_id" = %(uuidv5_customer_id)s
+        AND "metering_billing_usageevent"."time_created" >= minute_bounds.window_start
+        AND "metering_billing_usageevent"."time_created" <= minute_bounds.window_end
+        AND (
+            "metering_billing_usageevent"."time_created" < minute_bounds.minutes_start
+            OR "metering_billing_usageevent"."time_created" >= minute_bounds.minutes_end
+        )
+        {%- for property_name in filter_properties %}
+        AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
+        {%- endfor %}
+    GROUP BY
+        "metering_billing_usageevent"."uuidv5_customer_id"
+        {%- for group_by_field in group_by %}
+        , {{ group_by_field }}
+        {%- endfor %}
+)
 SELECT
-    "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id,
-    "metering_billing_usageevent"."time_created" AS time_created,
-    {% if query_type == "count" -%}
-    COUNT(
-        "metering_billing_usageevent"."idempotency_id"
-    )
-    {% elif query_type == "sum" -%}
-    SUM(
+    uuidv5_customer_id
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+    {%- if query_type == "count" %}
+    , SUM(num_events)
+    {%- elif query_type == "sum" %}
+    , SUM(property_sum)
+    {%- elif query_type == "average" %}
+    , SUM(property_sum) / NULLIF(SUM(property_count), 0)
+    {%- elif query_type == "max" %}
+    , MAX(property_max)
+    {%- endif %} AS usage_qty
+FROM
+    per_source
+GROUP BY
+    uuidv5_customer_id
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+"""
+
+# one bucket per minute, from which the windows of current usage are assembled. It
+# keeps the sums and counts instead of the averages so buckets can be combined
+RATE_MINUTE_CAGG_QUERY = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS {{ cagg_name }}
+WITH (timescaledb.continuous) AS
+SELECT
+    "metering_billing_usageevent"."uuidv5_customer_id" AS uuidv5_customer_id
+    , time_bucket('1 minute', "metering_billing_usageevent"."time_created") AS bucket
+    , COUNT("metering_billing_usageevent"."idempotency_id") AS num_events
+    {%- if query_type in ["sum", "average"] %}
+    , SUM(
         ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
-    )
-    {% elif query_type == "average" -%}
-    AVG(
+    ) AS property_sum
+    , COUNT(
         ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
-    )
-    {% elif query_type == "unique" -%}
-    COUNT(
-        DISTINCT ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
-    )
-    {% elif query_type == "max" -%}
-    MAX(
+    ) AS property_count
+    {%- elif query_type == "max" %}
+    , MAX(
         ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')::text::decimal
-    )
-    {% endif %} AS usage_qty
+    ) AS property_max
+    {%- endif %}
     {%- for group_by_field in group_by %}
     , "metering_billing_usageevent"."properties" ->> '{{ group_by_field }}' AS {{ group_by_field }}
     {%- endfor %}
@@ -48,34 +185,36 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
-        )
-    {%- endfor %}
-    AND "metering_billing_usageevent"."uuidv5_customer_id" = '{{ uuidv5_customer_id }}'
-    AND "metering_billing_usageevent"."time_created" <= '{{ reference_time }}'::timestamp
-    AND "metering_billing_usageevent"."time_created" >= '{{ reference_time }}'::timestamp + INTERVAL '-1 {{ lookback_units }}' * {{ lookback_qty }}
-    {%- for property_name, property_values in filter_properties.items() %}
-    AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
-        IN (
-            {%- for pval in property_values %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     "metering_billing_usageevent"."uuidv5_customer_id"
     {%- for group_by_field in group_by %}
     , {{ group_by_field }}
     {%- endfor %}
+    , bucket
+"""
+
+# current usage reads the minute buckets right up to the current minute, so they are
+# materialized every minute instead of lagging a day behind like the other caggs
+RATE_MINUTE_CAGG_REFRESH = """
+SELECT add_continuous_aggregate_policy('{{ cagg_name }}',
+    start_offset => INTERVAL '32 days',
+    end_offset => INTERVAL '1 minute',
+    schedule_interval => INTERVAL '1 minute',
+    if_not_exists => TRUE);
 """
 
 RATE_CAGG_QUERY = """
@@ -133,16 +272,19 @@ WHERE
         {{ comparison }}
     {%- endfor %}
     {%- for property_name, operator, comparison in categorical_filters %}
-    AND (COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', ''))
-        {% if operator == "isnotin" %}
-        NOT
-        {% endif %}
-        IN (
-            {%- for pval in comparison %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
+    AND {% if operator == "isnotin" %}NOT {% endif %}(
+        COALESCE("metering_billing_usageevent"."properties" ->> '{{ property_name }}', '')
+        = ANY(
+            {%- if comparison is string %} {{ comparison }}
+            {%- else %} ARRAY[
+                {%- for pval in comparison %}
+                '{{ pval | replace("'", "''") }}'
+                {%- if not loop.last %},{% endif %}
+                {%- endfor %}
+            ]::text[]
+            {%- endif %}
         )
+    )
     {%- endfor %}
 GROUP BY
     "metering_billing_usageevent"."uuidv5_customer_id"
@@ -180,18 +322,13 @@ WITH rate_per_bucket AS (
     FROM
         {{ cagg_name }}
     WHERE
-        uuidv5_customer_id = '{{ uuidv5_customer_id }}'
-        AND bucket >= '{{ start_date }}'::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
-        AND bucket <= '{{ end_date }}'::timestamptz
+        uuidv5_customer_id = %(uuidv5_customer_id)s
+        AND bucket >= %(start_date)s::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
+        AND bucket <= %(end_date)s::timestamptz
         AND bucket <= NOW()
-        {%- for property_name, property_values in filter_properties.items() %}
+        {%- for property_name in filter_properties %}
         AND {{ property_name }}
-            IN (
-                {%- for pval in property_values %}
-                '{{ pval }}'
-                {%- if not loop.last %},{% endif %}
-                {%- endfor %}
-            )
+            = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
         {%- endfor %}
     )
     SELECT DISTINCT ON (
@@ -209,18 +346,13 @@ WITH rate_per_bucket AS (
 FROM
     rate_per_bucket
 WHERE
-    uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+    uuidv5_customer_id = %(uuidv5_customer_id)s
     AND bucket <= NOW()
-    AND bucket >= '{{ start_date }}'::timestamptz
-    AND bucket <= '{{ end_date }}'::timestamptz
-    {%- for property_name, property_values in filter_properties.items() %}
+    AND bucket >= %(start_date)s::timestamptz
+    AND bucket <= %(end_date)s::timestamptz
+    {%- for property_name in filter_properties %}
     AND ("metering_billing_usageevent"."properties" ->> '{{ property_name }}')
-        IN (
-            {%- for pval in property_values %}
-            '{{ pval }}'
-            {%- if not loop.last %},{% endif %}
-            {%- endfor %}
-        )
+        = ANY(%({{ param_prefix }}filter_{{ property_name }})s)
     {%- endfor %}
 ORDER BY
     uuidv5_customer_id
@@ -231,6 +363,70 @@ ORDER BY
     , bucket ASC
 """
 
+# batch version of RATE_CAGG_TOTAL, the rolling rate is computed per billing record and
+# the highest one in each record's period is kept. A record whose subscription filters
+# leave some group by fields open gets the rate of the first of their groups, same as
+# the per record query
+RATE_CAGG_TOTAL_BATCH = BILLING_RECORD_WINDOWS + """
+, rate_per_bucket AS (
+    SELECT
+        windows.record_idx
+        {%- for group_by_field in group_by %}
+        , cagg.{{ group_by_field }}
+        {%- endfor %}
+        , windows.start_date
+        , cagg.bucket
+        {% if query_type == "count" -%}
+        , SUM(cagg.second_usage) OVER rate_window
+        {% elif query_type == "sum" -%}
+        , SUM(cagg.second_usage) OVER rate_window
+        {% elif query_type == "average" -%}
+        , SUM(cagg.second_usage * cagg.num_events) OVER rate_window
+            / NULLIF(SUM(cagg.num_events) OVER rate_window, 0)
+        {% elif query_type == "max" -%}
+        , MAX(cagg.second_usage) OVER rate_window
+        {% endif %} AS usage_qty
+    FROM
+        windows
+    INNER JOIN
+        {{ cagg_name }} AS cagg
+    ON
+        cagg.uuidv5_customer_id = windows.uuidv5_customer_id
+        AND cagg.bucket >= windows.start_date - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
+        AND cagg.bucket <= windows.end_date
+    WHERE
+        cagg.bucket <= NOW()
+        {%- for group_by_field in group_by %}
+        AND (
+            windows.filter_{{ group_by_field }} IS NULL
+            OR cagg.{{ group_by_field }} = windows.filter_{{ group_by_field }}
+        )
+        {%- endfor %}
+    WINDOW rate_window AS (
+        PARTITION BY windows.record_idx
+        {%- for group_by_field in group_by %}
+        , cagg.{{ group_by_field }}
+        {%- endfor %}
+        ORDER BY cagg.bucket ASC
+        RANGE BETWEEN INTERVAL '{{ lookback_qty }} {{ lookback_units }}' PRECEDING AND CURRENT ROW
+    )
+)
+SELECT DISTINCT ON (record_idx)
+    record_idx
+    , usage_qty
+FROM
+    rate_per_bucket
+WHERE
+    bucket >= start_date
+ORDER BY
+    record_idx
+    {%- for group_by_field in group_by %}
+    , {{ group_by_field }}
+    {%- endfor %}
+    , usage_qty DESC
+    , bucket ASC
+"""
+
 RATE_TOTAL_PER_DAY = """
 WITH rate_per_bucket AS (
     SELECT 
@@ -259,11 +455,11 @@ WITH rate_per_bucket AS (
     FROM
         {{ cagg_name }}
     WHERE
-        bucket >= '{{ start_date }}'::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
-        AND bucket <= '{{ end_date }}'::timestamptz
+        bucket >= %(start_date)s::timestamptz - INTERVAL '{{ lookback_qty }} {{ lookback_units }}'
+        AND bucket <= %(end_date)s::timestamptz
         AND bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
 )
 , per_groupby AS (   
@@ -279,10 +475,10 @@ WITH rate_per_bucket AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-            AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+            AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <= '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <= %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         {%- for group_by_field in group_by %}
@@ -300,10 +496,10 @@ WITH rate_per_bucket AS (
     WHERE
         time_bucket <= NOW()
         {% if uuidv5_customer_id is not none %}
-        AND uuidv5_customer_id = '{{ uuidv5_customer_id }}'
+        AND uuidv5_customer_id = %(uuidv5_customer_id)s
         {% endif %}
-        AND time_bucket >= '{{ start_date }}'::timestamptz
-        AND time_bucket <=  '{{ end_date }}'::timestamptz
+        AND time_bucket >= %(start_date)s::timestamptz
+        AND time_bucket <=  %(end_date)s::timestamptz
     GROUP BY
         uuidv5_customer_id
         , time_bucket_gapfill('1 day', time_bucket)
@@ -0,0 +1,192 @@
+import contextvars
+import hashlib
+import json
+import logging
+import uuid
+from contextlib import contextmanager
+
+import sentry_sdk
+from django.conf import settings
+from django.core.cache import cache
+
+from metering_billing.utils import customer_id_uuidv5, event_name_uuidv5, now_utc
+from metering_billing.utils.enums import METRIC_TYPE
+
+USAGE_CACHE_TTL_SECONDS = settings.USAGE_CACHE_TTL_SECONDS
+# a watermark has to outlive every entry stored against it, otherwise an entry from
+# before the watermark was first bumped would look current again once it expires
+USAGE_WATERMARK_TTL_SECONDS = USAGE_CACHE_TTL_SECONDS * 2
+# hits and misses are counted per process and added to the shared totals every this
+# many lookups
+USAGE_CACHE_STATS_FLUSH_EVERY = 100
+USAGE_CACHE_STATS = ["hits", "misses"]
+
+logger = logging.getLogger("django.server")
+
+_stats = {name: 0 for name in USAGE_CACHE_STATS}
+_bypassed = contextvars.ContextVar("usage_cache_bypassed", default=False)
+
+
+@contextmanager
+def bypass_usage_cache(bypass=True):
+    """Compute usage from the events inside this block instead of reading it from the
+    cache. Invoicing uses this, since the cache is only invalidated by the event
+    writers in this codebase and an invoice can't be allowed to miss events."""
+    token = _bypassed.set(bypass)
+    try:
+        yield
+    finally:
+        _bypassed.reset(token)
+
+
+def is_cacheable(metric, billing_record):
+    """Counter usage only depends on the events, so it stays correct until the
+    customer sends new ones. Gauge and rate usage of a period that hasn't ended also
+    depends on the time it is computed at, and custom metrics can read any event."""
+    if (
+        USAGE_CACHE_TTL_SECONDS <= 0
+        or _bypassed.get()
+        or metric.metric_type == METRIC_TYPE.CUSTOM
+    ):
+        return False
+    return metric.metric_type == METRIC_TYPE.COUNTER or (
+        billing_record.end_date < now_utc()
+    )
+
+
+def usage_cache_key(kind, metric, billing_record):
+    filters_digest = hashlib.md5(
+        json.dumps(sorted(billing_record.subscription.subscription_filters)).encode()
+    ).hexdigest()
+    return "usage_{}_{}_{}_{}_{}_{}".format(
+        kind,
+        metric.pk,
+        _uuidv5_customer_id(billing_record.customer).hex,
+        filters_digest,
+        int(billing_record.start_date.timestamp() * 1_000_000),
+        int(billing_record.end_date.timestamp() * 1_000_000),
+    )
+
+
+def usage_watermark_key(organization_pk, uuidv5_customer_id, event_name):
+    return "usage_watermark_{}_{}_{}".format(
+        organization_pk, uuidv5_customer_id.hex, event_name_uuidv5(event_name).hex
+    )
+
+
+def cached_usage(kind, metric, billing_record, compute):
+    """Returns compute() for a billing record, reusing the last result until the
+    customer sends new events for the metric or the entry expires."""
+    return cached_usage_many(
+        kind,
+        metric,
+        [billing_record],
+        lambda billing_records: {billing_records[0]: compute()},
+    )[billing_record]
+
+
+def cached_usage_many(kind, metric, billing_records, compute_many):
+    """Returns the usage of many billing records, calling compute_many with only the
+    billing records that aren't cached. compute_many has to return a dict keyed by
+    billing record."""
+    billing_records = list(billing_records)
+    cacheable = [br for br in billing_records if is_cacheable(metric, br)]
+    if not cacheable:
+        return compute_many(billing_records)
+    entry_keys = {br: usage_cache_key(kind, metric, br) for br in cacheable}
+    watermark_keys = {
+        br: usage_watermark_key(
+            metric.organization_id,
+            _uuidv5_customer_id(br.customer),
+            metric.event_name,
+        )
+        for br in cacheable
+    }
+    # the watermarks are read before the usage is computed, so events written while
+    # it is computed leave the stored entry stale instead of the other way around
+    try:
+        cached = cache.get_many(
+            list(set(entry_keys.values()) | set(watermark_keys.values()))
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not read usage cache. Exception message: {e}")
+        return compute_many(billing_records)
+
+    usage = {}
+    for br in cacheable:
+        entry = cached.get(entry_keys[br])
+        if entry is not None and entry[0] == cached.get(watermark_keys[br]):
+            usage[br] = entry[1]
+    _record_lookups(hits=len(usage), misses=len(cacheable) - len(usage))
+    missing = [br for br in billing_records if br not in usage]
+    if not missing:
+        return usage
+    computed = compute_many(missing)
+    usage.update(computed)
+    try:
+        cache.set_many(
+            {
+                entry_keys[br]: (cached.get(watermark_keys[br]), computed[br])
+                for br in missing
+                if br in entry_keys
+            },
+            USAGE_CACHE_TTL_SECONDS,
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not write usage cache. Exception message: {e}")
+    return usage
+
+
+def bump_usage_watermarks(buffer):
+    """Invalidate the cached usage of every customer and event name in a batch of
+    events that were written to the database."""
+    if USAGE_CACHE_TTL_SECONDS <= 0:
+        return
+    watermark = uuid.uuid4().hex
+    try:
+        cache.set_many(
+            {
+                usage_watermark_key(
+                    organization_pk,
+                    customer_id_uuidv5(event["customer_id"]),
+                    event["event_name"],
+                ): watermark
+                for organization_pk, events_list in buffer.items()
+                for event in events_list
+            },
+            USAGE_WATERMARK_TTL_SECONDS,
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not invalidate usage cache. Exception message: {e}")
+
+
+def get_usage_cache_stats():
+    _flush_stats()
+    totals = cache.get_many([f"usage_cache_{name}" for name in USAGE_CACHE_STATS])
+    return {name: totals.get(f"usage_cache_{name}", 0) for name in USAGE_CACHE_STATS}
+
+
+def _record_lookups(hits, misses):
+    _stats["hits"] += hits
+    _stats["misses"] += misses
+    if sum(_stats.values()) >= USAGE_CACHE_STATS_FLUSH_EVERY:
+        _flush_stats()
+
+
+def _flush_stats():
+    try:
+        for name in USAGE_CACHE_STATS:
+            if _stats[name]:
+                cache.add(f"usage_cache_{name}", 0, timeout=None)
+                cache.incr(f"usage_cache_{name}", _stats[name])
+                _stats[name] = 0
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not record usage cache stats. Exception message: {e}")
+
+
+def _uuidv5_customer_id(customer):
+    return customer.uuidv5_customer_id or customer_id_uuidv5(customer.customer_id)
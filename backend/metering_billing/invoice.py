@@ -1,13 +1,16 @@
 import logging
+from collections import defaultdict
 from collections.abc import Iterable
 from decimal import Decimal
 
 import sentry_sdk
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
-from django.db.models import Q, Sum
+from django.db import transaction
+from django.db.models import Prefetch, Q, Sum
 from django.db.models.query import QuerySet
 
+from metering_billing.aggregation.usage_cache import bypass_usage_cache
 from metering_billing.kafka.producer import Producer
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
 from metering_billing.taxes import get_lotus_tax_rates, get_taxjar_tax_rates
@@ -37,6 +40,230 @@ else:
     kafka_producer = None
 
 
+class BillingContext:
+    """Everything invoicing a set of subscription records reads: their billing records
+    with the charge records, tiers and recurring charges those point to, and how much of
+    each billing record was already invoiced. It's loaded in a fixed number of queries
+    however many plan components there are, and the line items added while invoicing
+    have to be recorded on it so the totals stay current. load_usage adds the usage of
+    the billing records, with one batch query per metric.
+
+    It also gathers what invoicing writes, the new line items and their adjustments and
+    the billing records and charge records it marks as invoiced, until write_pending
+    saves them in bulk."""
+
+    def __init__(self, subscription_records):
+        from metering_billing.models import (
+            BillingRecord,
+            ComponentChargeRecord,
+            InvoiceLineItem,
+            RecurringCharge,
+        )
+
+        subscription_records = {sr.pk: sr for sr in subscription_records}
+        self._subscription_records = subscription_records
+        billing_records = list(
+            BillingRecord.objects.filter(subscription__in=subscription_records.keys())
+            .select_related(
+                "recurring_charge", "component", "component__billable_metric"
+            )
+            .prefetch_related(
+                "component__tiers",
+                Prefetch(
+                    "component_charge_records",
+                    queryset=ComponentChargeRecord.objects.select_related(
+                        "component_charge"
+                    ),
+                ),
+            )
+        )
+        self._billing_records = {pk: [] for pk in subscription_records}
+        for billing_record in billing_records:
+            subscription_record = subscription_records[billing_record.subscription_id]
+            # point at the objects we already have instead of loading them again
+            billing_record.subscription = subscription_record
+            billing_record.customer = subscription_record.customer
+            for ccr in billing_record.component_charge_records.all():
+                ccr.billing_record = billing_record
+                ccr.component = billing_record.component
+            self._billing_records[subscription_record.pk].append(billing_record)
+
+        self._invoiced = defaultdict(
+            lambda: {"base": Decimal(0), "quantity": Decimal(0)}
+        )
+        already_invoiced = (
+            InvoiceLineItem.objects.filter(
+                associated_billing_record__in=billing_records
+            )
+            .order_by()
+            .values("associated_billing_record", "chargeable_item_type")
+            .annotate(tot_base=Sum("base"), tot_quantity=Sum("quantity"))
+        )
+        for row in already_invoiced:
+            totals = self._invoiced[
+                (row["associated_billing_record"], row["chargeable_item_type"])
+            ]
+            totals["base"] += row["tot_base"] or 0
+            totals["quantity"] += row["tot_quantity"] or 0
+
+        self._components_with_charges = set(
+            ComponentChargeRecord.objects.filter(
+                component__in={
+                    br.component_id
+                    for br in billing_records
+                    if br.component_id is not None
+                }
+            )
+            .values_list("component", flat=True)
+            .distinct()
+        )
+
+        plan_version_ids = {sr.billing_plan_id for sr in subscription_records.values()}
+        self._recurring_charges = {pk: [] for pk in plan_version_ids}
+        for recurring_charge in RecurringCharge.objects.filter(
+            plan_version__in=plan_version_ids
+        ):
+            self._recurring_charges[recurring_charge.plan_version_id].append(
+                recurring_charge
+            )
+
+        self._usage = {}
+        self._pending_line_items = []
+        self._pending_adjustments = []
+        self._adjusted_line_items = {}
+        self._pending_billing_records = {}
+        self._pending_component_charge_records = {}
+
+    def load_usage(self, draft, issue_date):
+        """Compute the usage of every billing record the invoice will bill for usage,
+        with one batch query per metric instead of one query per billing record."""
+        billing_records_per_metric = defaultdict(list)
+        for pk, subscription_record in self._subscription_records.items():
+            if not subscription_record.invoice_usage_charges:
+                continue
+            for billing_record in self._billing_records[pk]:
+                if (
+                    billing_record.component_id is None
+                    or billing_record.fully_billed
+                    or (billing_record.next_invoicing_date > issue_date and not draft)
+                ):
+                    continue
+                metric = billing_record.component.billable_metric
+                billing_records_per_metric[metric.pk].append(billing_record)
+        for billing_records in billing_records_per_metric.values():
+            metric = billing_records[0].component.billable_metric
+            usage = metric.get_billing_records_total_billable_usage(billing_records)
+            for billing_record in billing_records:
+                self._usage[billing_record.pk] = usage[billing_record]
+
+    def billing_records(self, subscription_record):
+        return self._billing_records[subscription_record.pk]
+
+    def component_charge_records(self, billing_record):
+        return billing_record.component_charge_records.all()
+
+    def recurring_charges(self, plan_version):
+        if plan_version.pk not in self._recurring_charges:
+            # the next plan version of a subscription can be one we didn't load
+            self._recurring_charges[plan_version.pk] = list(
+                plan_version.recurring_charges.all()
+            )
+        return self._recurring_charges[plan_version.pk]
+
+    def amt_already_invoiced(self, billing_record):
+        if billing_record.recurring_charge_id is not None:
+            chargeable_item_type = CHARGEABLE_ITEM_TYPE.RECURRING_CHARGE
+        else:
+            chargeable_item_type = CHARGEABLE_ITEM_TYPE.USAGE_CHARGE
+        return self._invoiced[(billing_record.pk, chargeable_item_type)]["base"]
+
+    def qty_already_invoiced(self, billing_record):
+        assert (
+            billing_record.recurring_charge_id is None
+        ), "This is a recurring charge billing record, cannot use this function."
+        return self._invoiced[(billing_record.pk, CHARGEABLE_ITEM_TYPE.USAGE_CHARGE)][
+            "quantity"
+        ]
+
+    def prepaid_already_invoiced(self, billing_record):
+        return self._invoiced[
+            (billing_record.pk, CHARGEABLE_ITEM_TYPE.PREPAID_USAGE_CHARGE)
+        ]["base"]
+
+    def usage_and_revenue(self, billing_record):
+        """Same as BillingRecord.get_usage_and_revenue, from the loaded records."""
+        assert (
+            billing_record.component is not None
+        ), "Can't call usage_and_revenue for a recurring charge."
+        kwargs = {}
+        ccrs = self.component_charge_records(billing_record)
+        if ccrs:
+            kwargs["prepaid_units"] = max(ccrs, key=lambda ccr: ccr.start_date).units
+        return billing_record.component.calculate_total_revenue(
+            billing_record,
+            has_component_charges=billing_record.component_id
+            in self._components_with_charges,
+            usage_qty=self._usage.get(billing_record.pk),
+            **kwargs,
+        )
+
+    def record_line_item(self, line_item):
+        if line_item.associated_billing_record_id is None:
+            return
+        totals = self._invoiced[
+            (line_item.associated_billing_record_id, line_item.chargeable_item_type)
+        ]
+        totals["base"] += line_item.base or 0
+        totals["quantity"] += line_item.quantity or 0
+
+    def add_pending_line_item(self, line_item):
+        self._pending_line_items.append(line_item)
+
+    def add_pending_adjustment(self, adjustment):
+        line_item = adjustment.invoice_line_item
+        line_item.amount += adjustment.amount
+        self._pending_adjustments.append(adjustment)
+        self._adjusted_line_items[id(line_item)] = line_item
+
+    def handle_invoicing(self, billing_record, invoice_date):
+        billing_record.handle_invoicing(invoice_date, save=False)
+        self._pending_billing_records[billing_record.pk] = billing_record
+
+    def mark_fully_billed(self, component_charge_record):
+        component_charge_record.fully_billed = True
+        self._pending_component_charge_records[
+            component_charge_record.pk
+        ] = component_charge_record
+
+    def write_pending(self):
+        from metering_billing.models import (
+            BillingRecord,
+            ComponentChargeRecord,
+            InvoiceLineItem,
+            InvoiceLineItemAdjustment,
+        )
+
+        InvoiceLineItem.objects.bulk_create(self._pending_line_items)
+        # the amounts of the adjusted line items were kept up to date as the
+        # adjustments were added, instead of each adjustment re-saving its line item
+        InvoiceLineItemAdjustment.objects.bulk_create(self._pending_adjustments)
+        InvoiceLineItem.objects.bulk_update(
+            self._adjusted_line_items.values(), ["amount"]
+        )
+        BillingRecord.objects.bulk_update(
+            self._pending_billing_records.values(),
+            ["next_invoicing_date", "fully_billed"],
+        )
+        ComponentChargeRecord.objects.bulk_update(
+            self._pending_component_charge_records.values(), ["fully_billed"]
+        )
+        self._pending_line_items = []
+        self._pending_adjustments = []
+        self._adjusted_line_items = {}
+        self._pending_billing_records = {}
+        self._pending_component_charge_records = {}
+
+
 def generate_invoice(
     subscription_records,
     draft=False,
@@ -48,6 +275,8 @@ def generate_invoice(
     Generate an invoice for a subscription.
 
     IMPORTANT: addons must be passed explicitly as part of subscription_records, otherwise they will not be charged.
+
+    Draft invoices are never saved. They're unsaved Invoice objects with their line items kept in memory on `draft_line_items`, so previewing one doesn't write to the database.
     """
     from metering_billing.models import Invoice, PricingUnit
     from metering_billing.tasks import generate_invoice_pdf_async
@@ -88,60 +317,92 @@ def generate_invoice(
     except AttributeError:
         distinct_currencies = {x.billing_plan.currency for x in subscription_records}
 
-    invoices = {}
-    for currency in distinct_currencies:
-        # create kwargs for invoice
-        invoice_kwargs = {
-            "issue_date": issue_date,
-            "organization": organization,
-            "customer": customer,
-            "payment_status": Invoice.PaymentStatus.DRAFT
-            if draft
-            else Invoice.PaymentStatus.UNPAID,
-            "currency": currency,
-            "due_date": due_date,
-        }
-        # Create the invoice
-        invoice = Invoice.objects.create(**invoice_kwargs)
-        invoices[currency] = invoice
-    for subscription_record in subscription_records:
-        invoice = invoices[subscription_record.billing_plan.currency]
-        invoice.subscription_records.add(subscription_record)
-        # flat fee calculation for current plan
-        calculate_subscription_record_flat_fees(subscription_record, invoice, draft)
-        # usage calculation
-        calculate_subscription_record_usage_fees(subscription_record, invoice, draft)
-        # next plan flat fee calculation
-        next_bp = find_next_billing_plan(subscription_record)
-        sr_renews = check_subscription_record_renews(subscription_record, issue_date)
-        if sr_renews:
-            if generate_next_subscription_record:
-                # actually make one, when we're actually invoicing
-                next_subscription_record = create_next_subscription_record(
-                    subscription_record, next_bp
-                )
+    # the line items and invoicing state are gathered on the context and written in
+    # bulk, all of it in one transaction. Invoices that are actually issued read usage
+    # from the events, never from the usage cache
+    with transaction.atomic(), bypass_usage_cache(not draft):
+        context = BillingContext(subscription_records)
+        context.load_usage(draft, issue_date)
+        invoices = {}
+        for currency in distinct_currencies:
+            # create kwargs for invoice
+            invoice_kwargs = {
+                "issue_date": issue_date,
+                "organization": organization,
+                "customer": customer,
+                "payment_status": Invoice.PaymentStatus.DRAFT
+                if draft
+                else Invoice.PaymentStatus.UNPAID,
+                "currency": currency,
+                "due_date": due_date,
+            }
+            # Create the invoice
+            if draft:
+                invoice = Invoice(**invoice_kwargs)
+                if not invoice.currency:
+                    invoice.currency = organization.default_currency
+                invoice.draft_line_items = []
             else:
-                # this is just a placeholder e.g. for previewing draft invoices
-                next_subscription_record = subscription_record
-            if charge_next_plan:
-                # this can be both for actual invoicing or just for drafts to see whats next
-                charge_next_plan_flat_fee(
-                    subscription_record,
-                    next_subscription_record,
-                    next_bp,
-                    invoice,
-                    draft,
-                )
+                invoice = Invoice.objects.create(**invoice_kwargs)
+            invoices[currency] = invoice
+        for subscription_record in subscription_records:
+            invoice = invoices[subscription_record.billing_plan.currency]
+            if not draft:
+                invoice.subscription_records.add(subscription_record)
+            # flat fee calculation for current plan
+            calculate_subscription_record_flat_fees(
+                subscription_record, invoice, draft, context
+            )
+            # usage calculation
+            calculate_subscription_record_usage_fees(
+                subscription_record, invoice, draft, context
+            )
+            # next plan flat fee calculation
+            next_bp = find_next_billing_plan(subscription_record)
+            sr_renews = check_subscription_record_renews(
+                subscription_record, issue_date
+            )
+            if sr_renews:
+                if generate_next_subscription_record:
+                    # actually make one, when we're actually invoicing
+                    next_subscription_record = create_next_subscription_record(
+                        subscription_record, next_bp
+                    )
+                else:
+                    # this is just a placeholder e.g. for previewing draft invoices
+                    next_subscription_record = subscription_record
+                if charge_next_plan:
+                    # this can be both for actual invoicing or just for drafts to see whats next
+                    charge_next_plan_flat_fee(
+                        subscription_record,
+                        next_subscription_record,
+                        next_bp,
+                        invoice,
+                        draft,
+                        context,
+                    )
+        context.write_pending()
+        finalized_invoices = []
+        for invoice in invoices.values():
+            if draft:
+                if len(invoice.draft_line_items) == 0:
+                    continue
+            elif invoice.line_items.count() == 0:
+                invoice.delete()
+                continue
+            # every step reads the line items and amounts the previous one wrote
+            apply_plan_discounts(invoice, draft, context)
+            context.write_pending()
+            apply_taxes(invoice, customer, organization, draft, context)
+            context.write_pending()
+            apply_customer_balance_adjustments(
+                invoice, customer, organization, draft, context
+            )
+            context.write_pending()
+            finalize_invoice_amount(invoice, draft)
+            finalized_invoices.append(invoice)
     return_list = []
-    for invoice in invoices.values():
-        if invoice.line_items.count() == 0:
-            invoice.delete()
-            continue
-        apply_plan_discounts(invoice)
-        apply_taxes(invoice, customer, organization, draft)
-        apply_customer_balance_adjustments(invoice, customer, organization, draft)
-        finalize_invoice_amount(invoice, draft)
-
+    for invoice in finalized_invoices:
         if not draft:
             new_inv = generate_external_payment_obj(invoice)
             if new_inv:
@@ -166,18 +427,15 @@ def calculate_subscription_record_flat_fees(
     subscription_record,
     invoice,
     draft,
+    context,
 ):
-    from metering_billing.models import (
-        AddOnSpecification,
-        InvoiceLineItem,
-        RecurringCharge,
-    )
+    from metering_billing.models import AddOnSpecification, RecurringCharge
 
     # go thru every billing record that has a recurring charge to determien from ther
     # whats due
-    for billing_record in subscription_record.billing_records.filter(
-        recurring_charge__isnull=False
-    ):
+    for billing_record in context.billing_records(subscription_record):
+        if billing_record.recurring_charge_id is None:
+            continue
         # if the next invoicing date is in the future, we don't need to bill for it yet
         if (
             billing_record.next_invoicing_date > invoice.issue_date
@@ -194,7 +452,7 @@ def calculate_subscription_record_flat_fees(
             relative_end_date = billing_record.next_invoicing_date
         flat_fee_due = billing_record.calculate_recurring_charge_due(relative_end_date)
         # we check how much has already been billed
-        amt_already_invoiced = billing_record.amt_already_invoiced()
+        amt_already_invoiced = context.amt_already_invoiced(billing_record)
         if (
             abs(amt_already_invoiced - flat_fee_due) < Decimal("0.01")
             and amt_already_invoiced > 0
@@ -221,7 +479,10 @@ def calculate_subscription_record_flat_fees(
             ):
                 billing_type = INVOICE_CHARGE_TIMING_TYPE.ONE_TIME
             if flat_fee_due > 0:
-                InvoiceLineItem.objects.create(
+                create_line_item(
+                    invoice,
+                    draft,
+                    context=context,
                     name=f"{billing_plan_name} Flat Fee",
                     start_date=convert_to_datetime(start, date_behavior="min"),
                     end_date=convert_to_datetime(end, date_behavior="max"),
@@ -229,7 +490,6 @@ def calculate_subscription_record_flat_fees(
                     base=flat_fee_due,
                     billing_type=billing_type,
                     chargeable_item_type=CHARGEABLE_ITEM_TYPE.RECURRING_CHARGE,
-                    invoice=invoice,
                     associated_subscription_record=subscription_record,
                     associated_billing_record=billing_record,
                     associated_plan_version=billing_plan,
@@ -237,7 +497,10 @@ def calculate_subscription_record_flat_fees(
                 )
             # to make the accounting add up, we need to subtract stuff
             if amt_already_invoiced > 0:
-                InvoiceLineItem.objects.create(
+                create_line_item(
+                    invoice,
+                    draft,
+                    context=context,
                     name=f"{billing_plan_name} Flat Fee Already Invoiced",
                     start_date=invoice.issue_date,
                     end_date=invoice.issue_date,
@@ -245,7 +508,6 @@ def calculate_subscription_record_flat_fees(
                     base=-amt_already_invoiced,
                     billing_type=billing_type,
                     chargeable_item_type=CHARGEABLE_ITEM_TYPE.RECURRING_CHARGE,
-                    invoice=invoice,
                     associated_subscription_record=subscription_record,
                     associated_billing_record=billing_record,
                     associated_plan_version=billing_plan,
@@ -253,37 +515,42 @@ def calculate_subscription_record_flat_fees(
                 )
             # now we need to handle the billing record being invoiced. This means advancing the next invoicing date, or if this was the last invoicing date, marking the billing record as fully billed. Only do this if its not a draft!
             if not draft:
-                billing_record.handle_invoicing(invoice.issue_date)
+                context.handle_invoicing(billing_record, invoice.issue_date)
 
 
-def calculate_subscription_record_usage_fees(subscription_record, invoice, draft):
+def calculate_subscription_record_usage_fees(
+    subscription_record, invoice, draft, context
+):
     # only calculate this for parent plans! addons should never calculate
     if subscription_record.invoice_usage_charges:
-        for br in subscription_record.billing_records.filter(
-            component__isnull=False, fully_billed=False
-        ):
+        for br in context.billing_records(subscription_record):
+            if br.component_id is None or br.fully_billed:
+                continue
             make_billing_record_single_line_item(
-                br, subscription_record, invoice, draft
+                br, subscription_record, invoice, draft, context
             )
 
 
 def make_billing_record_single_line_item(
-    billing_record, subscription_record, invoice, draft
+    billing_record, subscription_record, invoice, draft, context
 ):
     assert billing_record.component is not None
-    from metering_billing.models import InvoiceLineItem
 
     if (
         billing_record.next_invoicing_date > invoice.issue_date and not draft
     ) or billing_record.fully_billed:
         return
-    for component_charge_record in billing_record.component_charge_records.filter(
-        fully_billed=False
-    ):
+    for component_charge_record in context.component_charge_records(billing_record):
+        if component_charge_record.fully_billed:
+            continue
         amt_to_bill = billing_record.calculate_prepay_usage_revenue(
-            component_charge_record
+            component_charge_record,
+            amt_already_invoiced=context.prepaid_already_invoiced(billing_record),
         )
-        InvoiceLineItem.objects.create(
+        create_line_item(
+            invoice,
+            draft,
+            context=context,
             name=str(component_charge_record),
             start_date=component_charge_record.start_date,
             end_date=component_charge_record.end_date,
@@ -291,27 +558,28 @@ def make_billing_record_single_line_item(
             base=amt_to_bill,
             billing_type=INVOICE_CHARGE_TIMING_TYPE.IN_ADVANCE,
             chargeable_item_type=CHARGEABLE_ITEM_TYPE.PREPAID_USAGE_CHARGE,
-            invoice=invoice,
             associated_subscription_record=subscription_record,
             associated_billing_record=billing_record,
             associated_plan_version=subscription_record.billing_plan,
             organization=subscription_record.organization,
         )
         if not draft:
-            component_charge_record.fully_billed = True
-            component_charge_record.save()
-    usg_rev = billing_record.get_usage_and_revenue()
+            context.mark_fully_billed(component_charge_record)
+    usg_rev = context.usage_and_revenue(billing_record)
     qty = usg_rev["usage_qty"]
     rev = usg_rev["revenue"]
-    amt_already_invoiced = billing_record.amt_already_invoiced()
-    qty_already_invoiced = billing_record.qty_already_invoiced()
+    amt_already_invoiced = context.amt_already_invoiced(billing_record)
+    qty_already_invoiced = context.qty_already_invoiced(billing_record)
     net_qty = qty or 0 - qty_already_invoiced
     net_rev = rev or 0 - amt_already_invoiced
     assert (
         net_qty >= 0
     ), "net qty should be >= 0, billable quantity should never go down"
     assert net_rev >= 0, "net rev should be >= 0, billable revenue should never go down"
-    InvoiceLineItem.objects.create(
+    create_line_item(
+        invoice,
+        draft,
+        context=context,
         name=str(billing_record.component.billable_metric.billable_metric_name),
         start_date=subscription_record.start_date,
         end_date=subscription_record.end_date,
@@ -319,14 +587,13 @@ def make_billing_record_single_line_item(
         base=net_rev,
         billing_type=INVOICE_CHARGE_TIMING_TYPE.IN_ARREARS,
         chargeable_item_type=CHARGEABLE_ITEM_TYPE.USAGE_CHARGE,
-        invoice=invoice,
         associated_subscription_record=subscription_record,
         associated_billing_record=billing_record,
         associated_plan_version=subscription_record.billing_plan,
         organization=subscription_record.organization,
     )
     if not draft:
-        billing_record.handle_invoicing(invoice.issue_date)
+        context.handle_invoicing(billing_record, invoice.issue_date)
 
 
 def find_next_billing_plan(subscription_record):
@@ -398,14 +665,19 @@ def create_next_subscription_record(subscription_record, next_bp):
 
 
 def charge_next_plan_flat_fee(
-    subscription_record, next_subscription_record, next_bp, invoice, draft
+    subscription_record,
+    next_subscription_record,
+    next_bp,
+    invoice,
+    draft,
+    context,
 ):
-    from metering_billing.models import InvoiceLineItem, RecurringCharge
+    from metering_billing.models import RecurringCharge
 
     if draft or subscription_record == next_subscription_record:
         # if its a draft, OR if we are not generating the next subscription record
         timezone = subscription_record.customer.timezone
-        for recurring_charge in next_bp.recurring_charges.all():
+        for recurring_charge in context.recurring_charges(next_bp):
             charge_in_advance = (
                 recurring_charge.charge_timing
                 == RecurringCharge.ChargeTimingType.IN_ADVANCE
@@ -425,7 +697,10 @@ def charge_next_plan_flat_fee(
                 base = recurring_charge.amount * next_subscription_record.quantity
                 qty = next_subscription_record.quantity
                 qty = qty if qty > 1 else None
-                InvoiceLineItem.objects.create(
+                create_line_item(
+                    invoice,
+                    draft,
+                    context=context,
                     name=name,
                     start_date=new_start,
                     end_date=calculate_end_date(next_bp_duration, new_start, timezone),
@@ -433,86 +708,82 @@ def charge_next_plan_flat_fee(
                     base=base,
                     billing_type=INVOICE_CHARGE_TIMING_TYPE.IN_ADVANCE,
                     chargeable_item_type=CHARGEABLE_ITEM_TYPE.RECURRING_CHARGE,
-                    invoice=invoice,
                     associated_subscription_record=next_subscription_record,
                     associated_plan_version=next_bp,
                     organization=subscription_record.organization,
                 )
     else:
-        calculate_subscription_record_flat_fees(subscription_record, invoice, draft)
+        calculate_subscription_record_flat_fees(
+            subscription_record, invoice, draft, context
+        )
 
 
-def apply_plan_discounts(invoice):
-    from metering_billing.models import (
-        InvoiceLineItem,
-        InvoiceLineItemAdjustment,
-        PlanVersion,
-        SubscriptionRecord,
-    )
+def apply_plan_discounts(invoice, draft=False, context=None):
+    from metering_billing.models import InvoiceLineItem, InvoiceLineItemAdjustment
     from metering_billing.utils.enums import PRICE_ADJUSTMENT_TYPE
 
-    distinct_pvs = (
-        invoice.line_items.filter(
-            associated_subscription_record__isnull=False,
-            associated_plan_version__isnull=False,
-        )
-        .values("associated_plan_version")
-        .distinct()
-    )
-    pvs = PlanVersion.objects.filter(
-        id__in=[pv["associated_plan_version"] for pv in distinct_pvs]
-    ).select_related("price_adjustment")
+    line_items = get_invoice_line_items(invoice)
+    pvs = []
+    for line_item in line_items:
+        pv = line_item.associated_plan_version
+        if (
+            line_item.associated_subscription_record_id is not None
+            and pv is not None
+            and pv not in pvs
+        ):
+            pvs.append(pv)
     for pv in pvs:
         if pv.price_adjustment:
             price_adj_name = str(pv.price_adjustment)
+            pv_line_items = [
+                line_item
+                for line_item in line_items
+                if line_item.associated_plan_version_id == pv.id
+            ]
             if (
                 pv.price_adjustment.price_adjustment_type
                 == PRICE_ADJUSTMENT_TYPE.PERCENTAGE
             ):
-                for line_item in invoice.line_items.filter(associated_plan_version=pv):
+                for line_item in pv_line_items:
                     discount_amount = pv.price_adjustment.apply(line_item.base)
-                    InvoiceLineItemAdjustment.objects.create(
-                        invoice_line_item=line_item,
+                    create_line_item_adjustment(
+                        line_item,
+                        draft,
+                        context,
                         adjustment_type=InvoiceLineItemAdjustment.AdjustmentType.PLAN_ADJUSTMENT,
                         amount=discount_amount,
                         account=21000,
                         organization=invoice.organization,
                     )
             else:
-                distinct_srs = (
-                    invoice.line_items.filter(associated_plan_version=pv)
-                    .values("associated_subscription_record")
-                    .distinct()
-                )
-                sub_records = SubscriptionRecord.objects.filter(
-                    id__in=[sr["associated_subscription_record"] for sr in distinct_srs]
-                )
+                sub_records = []
+                for line_item in pv_line_items:
+                    sr = line_item.associated_subscription_record
+                    if sr is not None and sr not in sub_records:
+                        sub_records.append(sr)
                 for sr in sub_records:
+                    billing_line_items = [
+                        line_item
+                        for line_item in pv_line_items
+                        if line_item.associated_subscription_record_id == sr.id
+                        and line_item.chargeable_item_type
+                        != CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT
+                    ]
+                    past_discount_items = InvoiceLineItem.objects.filter(
+                        chargeable_item_type=CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT,
+                        associated_subscription_record=sr,
+                        associated_plan_version=pv,
+                    )
+                    already_discounted = (
+                        past_discount_items.aggregate(tot=Sum("base"))["tot"] or 0
+                    )
                     if (
                         pv.price_adjustment.price_adjustment_type
                         == PRICE_ADJUSTMENT_TYPE.FIXED
                     ):
-                        billing_line_items = invoice.line_items.filter(
-                            ~Q(
-                                chargeable_item_type=CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT
-                            ),
-                            associated_subscription_record=sr,
-                            associated_plan_version=pv,
+                        total_due = sum(
+                            line_item.base for line_item in billing_line_items
                         )
-                        total_due = (
-                            billing_line_items.aggregate(tot=Sum("base"))["tot"] or 0
-                        )
-                        past_discount_items = InvoiceLineItem.objects.filter(
-                            chargeable_item_type=CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT,
-                            associated_subscription_record=sr,
-                            associated_plan_version=pv,
-                        )
-                        new_total = pv.price_adjustment.apply(total_due)
-                        already_discounted = (
-                            past_discount_items.aggregate(tot=Sum("base"))["tot"] or 0
-                        )
-                        discount_amount = new_total - total_due
-                        real_discount = discount_amount - already_discounted
                     else:
                         # this is everything we've charged with the plan/subscription
                         all_plan_line_items = InvoiceLineItem.objects.filter(
@@ -525,22 +796,22 @@ def apply_plan_discounts(invoice):
                         total_due = (
                             all_plan_line_items.aggregate(tot=Sum("base"))["tot"] or 0
                         )
-                        # here, we take it to a fixed price
-                        new_total = pv.price_adjustment.apply(total_due)
-                        # the total discount is the difference between the two
-                        discount_amount = new_total - total_due
-                        # but we need to make sure we don't double discount
-                        past_discount_items = InvoiceLineItem.objects.filter(
-                            chargeable_item_type=CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT,
-                            associated_subscription_record=sr,
-                            associated_plan_version=pv,
-                        )
-                        already_discounted = (
-                            past_discount_items.aggregate(tot=Sum("base"))["tot"] or 0
-                        )
-                        real_discount = discount_amount - already_discounted
+                        # a draft's own line items aren't saved, so add them on top
+                        if draft:
+                            total_due += sum(
+                                line_item.base for line_item in billing_line_items
+                            )
+                    # here, we take it to the adjusted price
+                    new_total = pv.price_adjustment.apply(total_due)
+                    # the total discount is the difference between the two
+                    discount_amount = new_total - total_due
+                    # but we need to make sure we don't double discount
+                    real_discount = discount_amount - already_discounted
                     if real_discount != 0:
-                        InvoiceLineItem.objects.create(
+                        create_line_item(
+                            invoice,
+                            draft,
+                            context,
                             name=f"{pv.plan.plan_name} {price_adj_name}",
                             start_date=invoice.issue_date,
                             end_date=invoice.issue_date,
@@ -548,13 +819,12 @@ def apply_plan_discounts(invoice):
                             base=real_discount,
                             billing_type=INVOICE_CHARGE_TIMING_TYPE.IN_ARREARS,
                             chargeable_item_type=CHARGEABLE_ITEM_TYPE.PLAN_ADJUSTMENT,
-                            invoice=invoice,
                             associated_subscription_record=sr,
                             organization=sr.organization,
                         )
 
 
-def apply_taxes(invoice, customer, organization, draft):
+def apply_taxes(invoice, customer, organization, draft, context=None):
     """
     Apply taxes to an invoice
     """
@@ -567,21 +837,17 @@ def apply_taxes(invoice, customer, organization, draft):
     )
     if len(order_of_tax_providers_to_check) == 0:
         return
-    subscription_records = {
-        x.associated_subscription_record
-        for x in invoice.line_items.all().select_related(
-            "associated_subscription_record"
-        )
-    }
+    line_items = get_invoice_line_items(invoice)
+    subscription_records = {x.associated_subscription_record for x in line_items}
 
     tax_rate_dict = {}
     for sr in subscription_records:
-        current_base = (
-            invoice.line_items.filter(associated_subscription_record=sr).aggregate(
-                tot=Sum("base")
-            )["tot"]
-            or 0
-        )
+        sr_line_items = [
+            line_item
+            for line_item in line_items
+            if line_item.associated_subscription_record == sr
+        ]
+        current_base = sum(line_item.base for line_item in sr_line_items)
         plan = sr.billing_plan.plan
         tax_rate = tax_rate_dict.get(plan, None)
         if tax_rate is None or not draft:
@@ -613,10 +879,12 @@ def apply_taxes(invoice, customer, organization, draft):
         if tax_rate == 0:
             continue
 
-        for line_item in invoice.line_items.filter(associated_subscription_record=sr):
+        for line_item in sr_line_items:
             tax_amount = line_item.base * (tax_rate / Decimal(100))
-            InvoiceLineItemAdjustment.objects.create(
-                invoice_line_item=line_item,
+            create_line_item_adjustment(
+                line_item,
+                draft,
+                context,
                 adjustment_type=InvoiceLineItemAdjustment.AdjustmentType.SALES_TAX,
                 amount=tax_amount,
                 account=41100,
@@ -624,15 +892,13 @@ def apply_taxes(invoice, customer, organization, draft):
             )
 
 
-def apply_customer_balance_adjustments(invoice, customer, organization, draft):
+def apply_customer_balance_adjustments(
+    invoice, customer, organization, draft, context=None
+):
     """
     Apply customer balance adjustments to an invoice
     """
-    from metering_billing.models import (
-        CustomerBalanceAdjustment,
-        Invoice,
-        InvoiceLineItem,
-    )
+    from metering_billing.models import CustomerBalanceAdjustment, Invoice
 
     issue_date = invoice.issue_date
     issue_date_fmt = issue_date.strftime("%Y-%m-%d")
@@ -640,7 +906,10 @@ def apply_customer_balance_adjustments(invoice, customer, organization, draft):
         return
     amount = invoice.line_items.aggregate(tot=Sum("amount"))["tot"] or 0
     if amount < 0:
-        InvoiceLineItem.objects.create(
+        create_line_item(
+            invoice,
+            draft,
+            context,
             name="Granted Credit",
             start_date=invoice.issue_date,
             end_date=invoice.issue_date,
@@ -648,7 +917,6 @@ def apply_customer_balance_adjustments(invoice, customer, organization, draft):
             base=-amount,
             billing_type=INVOICE_CHARGE_TIMING_TYPE.ONE_TIME,
             chargeable_item_type=CHARGEABLE_ITEM_TYPE.CUSTOMER_ADJUSTMENT,
-            invoice=invoice,
             organization=organization,
         )
         if not draft:
@@ -678,7 +946,10 @@ def apply_customer_balance_adjustments(invoice, customer, organization, draft):
                     description=f"Balance decrease from invoice {invoice.invoice_number} generated on {issue_date_fmt}",
                 )
             if -balance_adjustment + leftover != 0:
-                InvoiceLineItem.objects.create(
+                create_line_item(
+                    invoice,
+                    draft,
+                    context,
                     name="Applied Credit",
                     start_date=issue_date,
                     end_date=issue_date,
@@ -686,7 +957,6 @@ def apply_customer_balance_adjustments(invoice, customer, organization, draft):
                     base=-balance_adjustment + leftover,
                     billing_type=INVOICE_CHARGE_TIMING_TYPE.ONE_TIME,
                     chargeable_item_type=CHARGEABLE_ITEM_TYPE.CUSTOMER_ADJUSTMENT,
-                    invoice=invoice,
                     organization=organization,
                 )
 
@@ -695,7 +965,7 @@ def generate_balance_adjustment_invoice(balance_adjustment, draft=False):
     """
     Generate an invoice for a subscription.
     """
-    from metering_billing.models import Invoice, InvoiceLineItem
+    from metering_billing.models import Invoice
     from metering_billing.tasks import generate_invoice_pdf_async
 
     issue_date = balance_adjustment.created
@@ -714,10 +984,16 @@ def generate_balance_adjustment_invoice(balance_adjustment, draft=False):
         "due_date": due_date,
     }
     # Create the invoice
-    invoice = Invoice.objects.create(**invoice_kwargs)
+    if draft:
+        invoice = Invoice(**invoice_kwargs)
+        invoice.draft_line_items = []
+    else:
+        invoice = Invoice.objects.create(**invoice_kwargs)
 
     # Create the invoice line item
-    InvoiceLineItem.objects.create(
+    create_line_item(
+        invoice,
+        draft,
         name=f"Credit Grant: {balance_adjustment.amount_paid_currency.symbol}{balance_adjustment.amount}",
         start_date=issue_date,
         end_date=issue_date,
@@ -725,7 +1001,6 @@ def generate_balance_adjustment_invoice(balance_adjustment, draft=False):
         base=balance_adjustment.amount_paid,
         billing_type=INVOICE_CHARGE_TIMING_TYPE.ONE_TIME,
         chargeable_item_type=CHARGEABLE_ITEM_TYPE.ONE_TIME_CHARGE,
-        invoice=invoice,
         organization=organization,
     )
 
@@ -786,7 +1061,75 @@ def calculate_due_date(issue_date, organization):
 def finalize_invoice_amount(invoice, draft):
     from metering_billing.models import Invoice
 
+    if draft:
+        line_items = invoice.draft_line_items
+        invoice.amount = sum(line_item.amount for line_item in line_items)
+        # drafts aren't saved, so set the dates the serializers would otherwise
+        # aggregate from the line items
+        invoice.min_date = min(
+            (line_item.start_date for line_item in line_items), default=None
+        )
+        invoice.max_date = max(
+            (line_item.end_date for line_item in line_items), default=None
+        )
+        return
     invoice.amount = invoice.line_items.aggregate(tot=Sum("amount"))["tot"] or 0
-    if abs(invoice.amount) < 0.01 and not draft:
+    if abs(invoice.amount) < 0.01:
         invoice.payment_status = Invoice.PaymentStatus.PAID
     invoice.save()
+
+
+def create_line_item(invoice, draft, context=None, **kwargs):
+    """Add a line item to the invoice. The line items of drafts are kept in memory
+    instead of saved. Given a BillingContext, the line item is recorded on it and
+    saved when it writes its pending changes."""
+    from metering_billing.models import InvoiceLineItem
+
+    if draft:
+        line_item = InvoiceLineItem(invoice=invoice, **kwargs)
+        line_item.amount = line_item.base
+        line_item.draft_adjustments = []
+        invoice.draft_line_items.append(line_item)
+    elif context is not None:
+        line_item = InvoiceLineItem(invoice=invoice, **kwargs)
+        line_item.amount = line_item.base
+        context.add_pending_line_item(line_item)
+    else:
+        line_item = InvoiceLineItem.objects.create(invoice=invoice, **kwargs)
+    if context is not None:
+        context.record_line_item(line_item)
+    return line_item
+
+
+def create_line_item_adjustment(line_item, draft, context=None, **kwargs):
+    """Adjust the amount of a line item. The adjustments of line items on drafts are
+    kept in memory instead of saved. Given a BillingContext, the adjustment and the new
+    amount of the line item are saved when it writes its pending changes."""
+    from metering_billing.models import InvoiceLineItemAdjustment
+
+    if draft:
+        adjustment = InvoiceLineItemAdjustment(invoice_line_item=line_item, **kwargs)
+        line_item.draft_adjustments.append(adjustment)
+        line_item.amount += adjustment.amount
+        return adjustment
+    if context is not None:
+        adjustment = InvoiceLineItemAdjustment(invoice_line_item=line_item, **kwargs)
+        context.add_pending_adjustment(adjustment)
+        return adjustment
+    return InvoiceLineItemAdjustment.objects.create(
+        invoice_line_item=line_item, **kwargs
+    )
+
+
+def get_invoice_line_items(invoice):
+    try:
+        return invoice.draft_line_items
+    except AttributeError:
+        return list(
+            invoice.line_items.select_related(
+                "associated_plan_version",
+                "associated_plan_version__price_adjustment",
+                "associated_plan_version__plan",
+                "associated_subscription_record",
+            )
+        )
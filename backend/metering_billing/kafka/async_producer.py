@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+
+from django.conf import settings
+
+from .singleton import Singleton
+
+KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
+KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS = settings.KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS
+producer_config = settings.PRODUCER_CONFIG
+
+logger = logging.getLogger("django.server")
+
+
+def aiokafka_config(config):
+    """Translate the kafka-python PRODUCER_CONFIG into AIOKafkaProducer arguments."""
+    from aiokafka.helpers import create_ssl_context
+
+    config = dict(config)
+    aio_config = {
+        "bootstrap_servers": config.pop("bootstrap_servers"),
+        "linger_ms": config.pop("linger_ms"),
+        "max_batch_size": config.pop("batch_size"),
+        "compression_type": config.pop("compression_type"),
+    }
+    api_version = config.pop("api_version", None)
+    if api_version is not None:
+        aio_config["api_version"] = ".".join(str(v) for v in api_version)
+    if config.get("security_protocol") == "SASL_SSL":
+        aio_config["ssl_context"] = create_ssl_context()
+    aio_config.update(config)
+    return aio_config
+
+
+class AsyncProducer(metaclass=Singleton):
+    """Non-blocking counterpart of Producer for the async track endpoint.
+
+    An AIOKafkaProducer is bound to the event loop it was started on, so one is started
+    lazily for every loop the endpoint runs on. Under ASGI that is once per worker.
+    aiokafka is only imported then, so WSGI deployments never load it."""
+
+    def __init__(self):
+        if hasattr(self, "producers"):
+            return
+        self.producers = {}
+
+    async def get_connection(self):
+        from aiokafka import AIOKafkaProducer
+
+        loop = asyncio.get_running_loop()
+        for closed_loop in [l for l in self.producers if l.is_closed()]:
+            del self.producers[closed_loop]
+        if loop not in self.producers:
+            connection = AIOKafkaProducer(**aiokafka_config(producer_config))
+            # concurrent requests on the same loop wait on the same start task
+            self.producers[loop] = (connection, loop.create_task(connection.start()))
+        connection, started = self.producers[loop]
+        try:
+            await asyncio.shield(started)
+        except Exception:
+            self.producers.pop(loop, None)
+            raise
+        return connection
+
+    async def produce_batch(self, stream_events_list):
+        """Produce every event of a request and wait for them to be delivered together.
+
+        Same contract as Producer.produce_batch: returns a dict mapping the
+        idempotency_id of every event that could not be delivered to the reason."""
+        connection = await self.get_connection()
+        futures = {}
+        for customer_id, stream_events in stream_events_list:
+            future = await connection.send(
+                KAFKA_EVENTS_TOPIC,
+                key=customer_id.encode("utf-8"),
+                value=json.dumps(stream_events).encode("utf-8"),
+            )
+            futures[future] = stream_events["event"]["idempotency_id"]
+        if not futures:
+            return {}
+        _, pending = await asyncio.wait(
+            futures, timeout=KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS / 1000
+        )
+
+        failed_events = {}
+        for future, idempotency_id in futures.items():
+            if future in pending:
+                failed_events[idempotency_id] = "Timed out waiting for event delivery"
+            elif future.exception() is not None:
+                failed_events[
+                    idempotency_id
+                ] = f"Could not deliver event: {future.exception()}"
+        logger.debug(
+            f"Produced {len(futures) - len(failed_events)} of {len(futures)} records to topic {KAFKA_EVENTS_TOPIC}"
+        )
+        return failed_events
@@ -1,17 +1,33 @@
+import csv
+import io
+import json
 import logging
+import time
 from dataclasses import dataclass
 
 import sentry_sdk
 from django.conf import settings
+from django.db import connection, transaction
+from kafka import ConsumerRebalanceListener
+from psycopg2.extras import execute_values
 
-from metering_billing.models import Event
+from metering_billing.aggregation.usage_cache import bump_usage_watermarks
 from metering_billing.utils import now_utc
 
+from .dedupe import drop_known_duplicates, remember_written_events
+from .producer import Producer
 from .singleton import Singleton
+from .usage_counters import count_written_events
 
 POSTHOG_PERSON = settings.POSTHOG_PERSON
 KAFKA_HOST = settings.KAFKA_HOST
 KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
+KAFKA_CONSUMER_BATCH_SIZE = settings.KAFKA_CONSUMER_BATCH_SIZE
+KAFKA_CONSUMER_BATCH_TIMEOUT_MS = settings.KAFKA_CONSUMER_BATCH_TIMEOUT_MS
+EVENT_WRITER_USE_COPY = settings.EVENT_WRITER_USE_COPY
+# first key of the advisory locks held on an idempotency id while it is claimed, the
+# same one insert_metric takes. Incremental gauge states use 1, invoicing uses 2
+IDEMPOTENCY_ADVISORY_LOCK = 3
 CONSUMER = settings.CONSUMER
 
 logger = logging.getLogger("django.server")
@@ -22,6 +38,23 @@ class ConsumerConfig:
     bootstrap_servers = [KAFKA_HOST]
     topic = KAFKA_EVENTS_TOPIC
     auto_offset_reset = "earliest"
+    batch_size = KAFKA_CONSUMER_BATCH_SIZE
+    batch_timeout_ms = KAFKA_CONSUMER_BATCH_TIMEOUT_MS
+
+
+class FlushOnRevokeListener(ConsumerRebalanceListener):
+    """Flushes the consumer's buffer before its partitions are handed to another
+    member of the consumer group, so the new owner starts from committed offsets."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+
+    def on_partitions_revoked(self, revoked):
+        logger.info(f"Partitions revoked: {revoked}")
+        self.consumer.flush()
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(f"Partitions assigned: {assigned}")
 
 
 class Consumer(metaclass=Singleton):
@@ -33,37 +66,348 @@ class Consumer(metaclass=Singleton):
         self.__connection = CONSUMER
         self.config = ConsumerConfig()
         self.topic = self.config.topic
+        self.buffer = {}
+        self.buffer_size = 0
+        self.dead_letters = []
+        self.last_flush = time.monotonic()
+        self.running = True
+        if self.__connection is not None:
+            self.__connection.subscribe(
+                topics=[self.topic], listener=FlushOnRevokeListener(self)
+            )
 
     def consume(self):
-        """Consume messages from a Redpanda topic"""
+        """Consume messages from a Redpanda topic in micro-batches.
+
+        Events are buffered per organization until either `batch_size` events have been
+        collected or `batch_timeout_ms` has passed since the last flush. Offsets are only
+        committed after the buffer has been written to the database, so events that were
+        polled but not flushed are re-delivered if the consumer dies (at-least-once).
+        """
         try:
-            for msg in self.__connection:
-                if msg is None or msg.value is None or msg.key is None:
-                    continue
-
-                logger.info(f"Consumed record. key={msg.key}, value={msg.value}")
-                try:
-                    event = msg.value["event"]
-                    organization_pk = msg.value["organization_id"]
-                    write_batch_events_to_db({organization_pk: [event]})
-                except Exception as e:
-                    sentry_sdk.capture_exception(e)
-                    logger.info(
-                        f"Could not consume from topic: {self.topic}. Excpetionmessage: {e}"
-                    )
-                    continue
+            while self.running:
+                records = self.__connection.poll(
+                    timeout_ms=self._ms_until_flush_due(),
+                    max_records=max(self.config.batch_size - self.buffer_size, 1),
+                )
+                for msgs in records.values():
+                    for msg in msgs:
+                        self.add_to_buffer(msg)
+                if self._flush_due():
+                    self.flush()
+            self.flush()
         except Exception:
             logger.info(f"Could not consume from topic: {self.topic}")
             raise
 
+    def stop(self):
+        """Ask the consume loop to flush what it has buffered and return."""
+        self.running = False
+
+    def close(self):
+        self.__connection.close(autocommit=False)
+
+    def add_to_buffer(self, msg):
+        if msg is None or msg.value is None or msg.key is None:
+            return
+        try:
+            event = msg.value["event"]
+            organization_pk = msg.value["organization_id"]
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logger.info(
+                f"Could not consume from topic: {self.topic}. Exception message: {e}"
+            )
+            self.dead_letters.append(
+                make_dead_letter(msg.key, None, None, e, message=msg.value)
+            )
+            return
+        self.buffer.setdefault(organization_pk, []).append(event)
+        self.buffer_size += 1
+
+    def flush(self):
+        """Write every buffered event to the database and commit the consumed offsets.
+
+        Events whose idempotency id this consumer group has recently written are dropped
+        before they reach the database. Events that can't be written, and messages that
+        can't be parsed, go to the dead-letter topic before the offsets are committed.
+        """
+        if self.buffer_size > 0 or self.dead_letters:
+            buffer, dropped = drop_known_duplicates(self.buffer)
+            if dropped:
+                logger.info(f"Dropped {dropped} already written events")
+            try:
+                if buffer:
+                    inserted = write_batch_events_to_db(buffer)
+                    after_events_written(buffer, inserted)
+            except Exception as e:
+                # one bad event fails the whole statement, so fall back to writing the
+                # events one at a time to isolate it
+                sentry_sdk.capture_exception(e)
+                logger.info(
+                    f"Could not write batch of {self.buffer_size} events, retrying individually. Exception message: {e}"
+                )
+                failed_events, inserted = write_events_individually(buffer)
+                for organization_pk, event, error in failed_events:
+                    self.dead_letters.append(
+                        make_dead_letter(
+                            event.get("customer_id"), organization_pk, event, error
+                        )
+                    )
+                after_events_written(
+                    without_failed_events(buffer, failed_events), inserted
+                )
+            if self.dead_letters:
+                Producer().produce_dead_letters(self.dead_letters)
+            self.__connection.commit()
+        self.buffer = {}
+        self.buffer_size = 0
+        self.dead_letters = []
+        self.last_flush = time.monotonic()
+
+    def _flush_due(self):
+        if self.buffer_size >= self.config.batch_size:
+            return True
+        return self._ms_until_flush_due() == 0
+
+    def _ms_until_flush_due(self):
+        elapsed_ms = (time.monotonic() - self.last_flush) * 1000
+        return max(int(self.config.batch_timeout_ms - elapsed_ms), 0)
+
+
+STAGING_COLUMNS = [
+    "organization_id",
+    "cust_id",
+    "event_name",
+    "idempotency_id",
+    "time_created",
+    "properties",
+]
+
+CREATE_STAGING_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS metering_billing_usageevent_staging (
+    organization_id integer,
+    cust_id text,
+    event_name text,
+    idempotency_id text,
+    time_created timestamptz,
+    properties jsonb
+) ON COMMIT DELETE ROWS;
+"""
+
+COPY_TO_STAGING_TABLE = f"""
+COPY metering_billing_usageevent_staging ({", ".join(STAGING_COLUMNS)})
+FROM STDIN WITH (FORMAT csv)
+"""
+
+INSERT_INTO_STAGING_TABLE = f"""
+INSERT INTO metering_billing_usageevent_staging ({", ".join(STAGING_COLUMNS)})
+VALUES %s
+"""
+
+# takes the same advisory locks insert_metric does on every staged idempotency id, in a
+# fixed order so two batches can't deadlock. It has to be its own statement, so the
+# merge below starts after the locks are held and sees the rows of whoever held them
+LOCK_STAGED_IDEMPOTENCY_IDS = f"""
+SELECT
+    count(pg_advisory_xact_lock({IDEMPOTENCY_ADVISORY_LOCK}, id_hash))
+FROM (
+    SELECT DISTINCT
+        hashtext(
+            uuid_generate_v5('904C0FFB-7005-414E-9B7D-8E3C5DDE266D'::uuid, idempotency_id)::text
+        ) AS id_hash
+    FROM
+        metering_billing_usageevent_staging
+    ORDER BY
+        id_hash
+) staged_ids
+"""
+
+# same rules as the insert_metric function: an event is only written if its hashed
+# idempotency id isn't in the guard table yet and could be claimed there
+MERGE_STAGING_TABLE = """
+WITH staged AS (
+    SELECT DISTINCT ON (uuidv5_idempotency_id)
+        organization_id,
+        cust_id,
+        uuid_generate_v5('D1337E57-E6A0-4650-B1C3-D6487AFFB8CA'::uuid, cust_id) AS uuidv5_customer_id,
+        event_name,
+        uuid_generate_v5('843D7005-63DE-4B72-B731-77E2866DCCFF'::uuid, event_name) AS uuidv5_event_name,
+        idempotency_id,
+        uuidv5_idempotency_id,
+        properties,
+        time_created
+    FROM (
+        SELECT
+            *,
+            uuid_generate_v5('904C0FFB-7005-414E-9B7D-8E3C5DDE266D'::uuid, idempotency_id) AS uuidv5_idempotency_id
+        FROM
+            metering_billing_usageevent_staging
+    ) hashed
+    ORDER BY
+        uuidv5_idempotency_id
+        , time_created
+), guarded AS (
+    INSERT INTO metering_billing_idempotencecheck (
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    )
+    SELECT
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    FROM
+        staged
+    WHERE
+        NOT EXISTS (
+            SELECT 1
+            FROM metering_billing_idempotencecheck existing
+            WHERE existing.uuidv5_idempotency_id = staged.uuidv5_idempotency_id
+        )
+    ON CONFLICT DO NOTHING
+    RETURNING uuidv5_idempotency_id
+)
+INSERT INTO metering_billing_usageevent (
+    organization_id,
+    cust_id,
+    uuidv5_customer_id,
+    event_name,
+    uuidv5_event_name,
+    idempotency_id,
+    uuidv5_idempotency_id,
+    properties,
+    time_created,
+    inserted_at
+)
+SELECT
+    staged.organization_id,
+    staged.cust_id,
+    staged.uuidv5_customer_id,
+    staged.event_name,
+    staged.uuidv5_event_name,
+    staged.idempotency_id,
+    staged.uuidv5_idempotency_id,
+    staged.properties,
+    staged.time_created,
+    CURRENT_TIMESTAMP
+FROM
+    staged
+INNER JOIN
+    guarded
+ON
+    staged.uuidv5_idempotency_id = guarded.uuidv5_idempotency_id
+RETURNING
+    idempotency_id
+"""
+
 
 def write_batch_events_to_db(buffer):
-    now = now_utc()
+    """Write a batch of events to the database. Returns the events that were inserted,
+    in the same {organization_pk: [event]} shape, the others were duplicates."""
+    if EVENT_WRITER_USE_COPY:
+        return copy_batch_events_to_db(buffer)
+    return insert_batch_events_to_db(buffer)
+
+
+def copy_batch_events_to_db(buffer):
+    """Stream a batch of events into a staging table with COPY and merge it into the
+    usage event hypertable in a single statement."""
+    rows = io.StringIO()
+    writer = csv.writer(rows, quoting=csv.QUOTE_ALL)
+    writer.writerows(staging_rows(buffer))
+    rows.seek(0)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING_TABLE)
+            cursor.copy_expert(COPY_TO_STAGING_TABLE, rows)
+            return merge_staged_events(cursor, buffer)
+
+
+def insert_batch_events_to_db(buffer):
+    """Same as copy_batch_events_to_db, but loads the staging table with multi-row
+    INSERTs, for databases that don't allow COPY. Events go through the same guard."""
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_STAGING_TABLE)
+            execute_values(
+                cursor.cursor, INSERT_INTO_STAGING_TABLE, list(staging_rows(buffer))
+            )
+            return merge_staged_events(cursor, buffer)
+
+
+def staging_rows(buffer):
+    for org_pk, events_list in buffer.items():
+        for event in events_list:
+            yield (
+                org_pk,
+                event["customer_id"],
+                event["event_name"],
+                event["idempotency_id"],
+                event["time_created"],
+                json.dumps(event.get("properties") or {}),
+            )
+
+
+def merge_staged_events(cursor, buffer):
+    cursor.execute(LOCK_STAGED_IDEMPOTENCY_IDS)
+    cursor.execute(MERGE_STAGING_TABLE)
+    inserted_ids = {idempotency_id for idempotency_id, in cursor.fetchall()}
+    inserted = {}
     for org_pk, events_list in buffer.items():
-        ### Match Customer pk with customer_id amd fill in customer pk
-        events_to_insert = []
         for event in events_list:
-            event["cust_id"] = event.pop("customer_id")
-            events_to_insert.append(Event(**{**event, "inserted_at": now}))
-        ## now insert events
-        Event.objects.bulk_create(events_to_insert, ignore_conflicts=True)
+            if event["idempotency_id"] in inserted_ids:
+                # an id repeated within the batch was still only written once
+                inserted_ids.discard(event["idempotency_id"])
+                inserted.setdefault(org_pk, []).append(event)
+    return inserted
+
+
+def write_events_individually(buffer):
+    """Write events one at a time. Returns an (organization_pk, event, exception) tuple
+    for every event that could not be written, and the events that were inserted like
+    write_batch_events_to_db does."""
+    failed_events = []
+    inserted = {}
+    for org_pk, events_list in buffer.items():
+        for event in events_list:
+            try:
+                if write_batch_events_to_db({org_pk: [event]}):
+                    inserted.setdefault(org_pk, []).append(event)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                logger.info(f"Could not write event to db. Exception message: {e}")
+                failed_events.append((org_pk, event, e))
+                continue
+    return failed_events, inserted
+
+
+def after_events_written(buffer, inserted):
+    """Bring everything that tracks written events up to date with a batch that made it
+    to the database: the consumer's dedupe cache, the realtime usage counters and the
+    usage cache watermarks. `inserted` are the events of the batch the database didn't
+    drop as duplicates, only those are counted. Every path that writes events from
+    Kafka goes through this."""
+    remember_written_events(buffer)
+    count_written_events(inserted)
+    bump_usage_watermarks(buffer)
+
+
+def without_failed_events(buffer, failed_events):
+    failed = {id(event) for _, event, _ in failed_events}
+    return {
+        org_pk: [event for event in events_list if id(event) not in failed]
+        for org_pk, events_list in buffer.items()
+    }
+
+
+def make_dead_letter(key, organization_pk, event, error, message=None, attempts=1):
+    return {
+        "key": key,
+        "organization_id": organization_pk,
+        "event": event,
+        "message": message,
+        "error": f"{type(error).__name__}: {error}",
+        "failed_at": now_utc().isoformat(),
+        "attempts": attempts,
+    }
@@ -0,0 +1,71 @@
+import logging
+
+import sentry_sdk
+from django.conf import settings
+from django.core.cache import cache
+
+from metering_billing.utils import idempotency_id_uuidv5
+
+KAFKA_CONSUMER_DEDUPE_TTL_SECONDS = settings.KAFKA_CONSUMER_DEDUPE_TTL_SECONDS
+
+logger = logging.getLogger("django.server")
+
+
+def written_event_cache_key(organization_pk, idempotency_id):
+    return (
+        f"written_event_{organization_pk}_{idempotency_id_uuidv5(idempotency_id).hex}"
+    )
+
+
+def drop_known_duplicates(buffer):
+    """Remove the events whose idempotency id has already been written from a buffer.
+
+    Only ids remembered by `remember_written_events` are dropped, so an event is only
+    skipped when the guard table is known to hold its id already. Everything else,
+    including every event if the cache is unavailable, is left for the database to
+    deduplicate. Returns the filtered buffer and the number of events dropped."""
+    if KAFKA_CONSUMER_DEDUPE_TTL_SECONDS <= 0:
+        return buffer, 0
+    keyed_events = [
+        (
+            organization_pk,
+            event,
+            written_event_cache_key(organization_pk, event["idempotency_id"]),
+        )
+        for organization_pk, events_list in buffer.items()
+        for event in events_list
+    ]
+    try:
+        written = cache.get_many(list({key for _, _, key in keyed_events}))
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not check for duplicate events. Exception message: {e}")
+        return buffer, 0
+
+    filtered_buffer = {}
+    seen = set()
+    dropped = 0
+    for organization_pk, event, key in keyed_events:
+        if key in written or key in seen:
+            dropped += 1
+            continue
+        seen.add(key)
+        filtered_buffer.setdefault(organization_pk, []).append(event)
+    return filtered_buffer, dropped
+
+
+def remember_written_events(buffer):
+    if KAFKA_CONSUMER_DEDUPE_TTL_SECONDS <= 0:
+        return
+    try:
+        cache.set_many(
+            {
+                written_event_cache_key(organization_pk, event["idempotency_id"]): True
+                for organization_pk, events_list in buffer.items()
+                for event in events_list
+            },
+            KAFKA_CONSUMER_DEDUPE_TTL_SECONDS,
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not remember written events. Exception message: {e}")
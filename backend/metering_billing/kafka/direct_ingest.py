@@ -0,0 +1,132 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import sentry_sdk
+from django.conf import settings
+from django.db import close_old_connections
+
+from metering_billing.aggregation.usage_cache import bump_usage_watermarks
+
+from .consumer import (
+    without_failed_events,
+    write_batch_events_to_db,
+    write_events_individually,
+)
+from .singleton import Singleton
+from .usage_counters import count_written_events
+
+DIRECT_INGEST_MAX_QUEUE_SIZE = settings.DIRECT_INGEST_MAX_QUEUE_SIZE
+DIRECT_INGEST_BATCH_SIZE = settings.DIRECT_INGEST_BATCH_SIZE
+DIRECT_INGEST_FLUSH_INTERVAL_MS = settings.DIRECT_INGEST_FLUSH_INTERVAL_MS
+SHUTDOWN_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger("django.server")
+
+
+class DirectEventWriter(metaclass=Singleton):
+    """Kafka-less ingestion backend used when events are disabled.
+
+    Events are put on a bounded in-process queue and a background thread writes them
+    to the usage event table in batches, using the same write path as the Kafka
+    consumer. If the queue is full or the writer thread is not running, the event is
+    written synchronously instead. The queue is drained when the process exits
+    normally, but events still queued when the process is killed are lost, and events
+    the database rejects can only be logged since there is no dead-letter topic without
+    Kafka. Deployments that can't lose accepted events should run with Kafka."""
+
+    def __init__(self):
+        if hasattr(self, "queue"):
+            return
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        atexit.register(self.shutdown)
+
+    def write(self, organization_pk, event):
+        self._ensure_started()
+        if self.thread.is_alive() and not self.stopping.is_set():
+            try:
+                self.queue.put_nowait((organization_pk, event))
+                return
+            except queue.Full:
+                logger.info("Direct ingest queue is full, writing event synchronously")
+        inserted = write_batch_events_to_db({organization_pk: [event]})
+        count_written_events(inserted)
+        bump_usage_watermarks({organization_pk: [event]})
+
+    def shutdown(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join(SHUTDOWN_TIMEOUT_SECONDS)
+        # anything the thread didn't get to is written here
+        while not self.queue.empty():
+            self._flush(self._drain(block=False))
+
+    def _ensure_started(self):
+        # gunicorn preloads the app and then forks, which doesn't carry threads over,
+        # so every worker process starts its own queue and writer thread
+        if self.pid == os.getpid() and self.thread is not None:
+            return
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None:
+                return
+            self.queue = queue.Queue(maxsize=DIRECT_INGEST_MAX_QUEUE_SIZE)
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(
+                target=self._run, name="direct-event-writer", daemon=True
+            )
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            self._flush(self._drain(block=True))
+
+    def _drain(self, block):
+        """Take up to a batch worth of events off the queue, waiting at most one flush
+        interval for them to arrive when `block` is set."""
+        buffer = {}
+        deadline = time.monotonic() + DIRECT_INGEST_FLUSH_INTERVAL_MS / 1000
+        for _ in range(DIRECT_INGEST_BATCH_SIZE):
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    organization_pk, event = self.queue.get(timeout=timeout)
+                else:
+                    organization_pk, event = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            buffer.setdefault(organization_pk, []).append(event)
+        return buffer
+
+    def _flush(self, buffer):
+        if not buffer:
+            return
+        close_old_connections()
+        try:
+            inserted = write_batch_events_to_db(buffer)
+            count_written_events(inserted)
+            bump_usage_watermarks(buffer)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logger.info(
+                f"Could not write batch of events, retrying individually. Exception message: {e}"
+            )
+            failed_events, inserted = write_events_individually(buffer)
+            for organization_pk, event, error in failed_events:
+                logger.error(
+                    "Dropped event that could not be written. "
+                    f"organization_id={organization_pk}, "
+                    f"idempotency_id={event.get('idempotency_id')}, "
+                    f"customer_id={event.get('customer_id')}, "
+                    f"event_name={event.get('event_name')}, error={error}"
+                )
+            count_written_events(inserted)
+            bump_usage_watermarks(without_failed_events(buffer, failed_events))
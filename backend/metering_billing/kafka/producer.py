@@ -5,6 +5,7 @@ from decimal import Decimal
 
 from django.conf import settings
 from kafka import KafkaProducer
+from kafka.errors import KafkaTimeoutError
 
 from metering_billing.models import Invoice
 
@@ -13,6 +14,8 @@ from .singleton import Singleton
 KAFKA_EVENTS_TOPIC = settings.KAFKA_EVENTS_TOPIC
 KAFKA_INVOICE_TOPIC = settings.KAFKA_INVOICE_TOPIC
 KAFKA_PAYMENT_TOPIC = settings.KAFKA_PAYMENT_TOPIC
+KAFKA_EVENTS_DLQ_TOPIC = settings.KAFKA_EVENTS_DLQ_TOPIC
+KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS = settings.KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS
 producer_config = settings.PRODUCER_CONFIG
 
 logger = logging.getLogger("django.server")
@@ -43,6 +46,61 @@ class Producer(metaclass=Singleton):
         )
         logger.info(f"Produced record to topic {KAFKA_EVENTS_TOPIC}")
 
+    def produce_batch(self, stream_events_list):
+        """Produce every event of a request and wait for them to be delivered together.
+
+        `stream_events_list` is a list of (customer_id, stream_events) tuples. All records
+        are serialized and handed to the producer first so they can share batches, then
+        the producer is flushed once. Returns a dict mapping the idempotency_id of every
+        event that could not be delivered to the reason it failed."""
+        futures = []
+        for customer_id, stream_events in stream_events_list:
+            future = self.__connection.send(
+                topic=KAFKA_EVENTS_TOPIC,
+                key=customer_id.encode("utf-8"),
+                value=json.dumps(stream_events).encode("utf-8"),
+            )
+            futures.append((stream_events["event"]["idempotency_id"], future))
+        try:
+            self.__connection.flush(timeout=KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS / 1000)
+        except KafkaTimeoutError:
+            # some records are still in flight, the futures below say which ones
+            pass
+
+        failed_events = {}
+        for idempotency_id, future in futures:
+            if not future.is_done:
+                failed_events[idempotency_id] = "Timed out waiting for event delivery"
+            elif future.failed():
+                failed_events[idempotency_id] = (
+                    f"Could not deliver event: {future.exception}"
+                )
+        logger.debug(
+            f"Produced {len(futures) - len(failed_events)} of {len(futures)} records to topic {KAFKA_EVENTS_TOPIC}"
+        )
+        return failed_events
+
+    def produce_dead_letters(self, dead_letters):
+        """Send events that could not be written to the dead-letter topic.
+
+        Blocks until every message has been acknowledged and raises if one could not be
+        delivered, so the caller can avoid committing offsets for events that were lost.
+        """
+        futures = [
+            self.__connection.send(
+                topic=KAFKA_EVENTS_DLQ_TOPIC,
+                key=dead_letter["key"].encode("utf-8") if dead_letter["key"] else None,
+                value=json.dumps(dead_letter, default=str).encode("utf-8"),
+            )
+            for dead_letter in dead_letters
+        ]
+        self.__connection.flush(timeout=KAFKA_PRODUCER_DELIVERY_TIMEOUT_MS / 1000)
+        for future in futures:
+            future.get(timeout=0)
+        logger.info(
+            f"Produced {len(futures)} dead letters to topic {KAFKA_EVENTS_DLQ_TOPIC}"
+        )
+
     def produce_invoice(self, invoice: Invoice):
         from api.serializers.model_serializers import InvoiceSerializer
 
@@ -0,0 +1,393 @@
+import hashlib
+import json
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+
+import sentry_sdk
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from metering_billing.aggregation.usage_cache import bypass_usage_cache
+from metering_billing.utils import customer_id_uuidv5, now_utc, parse_event_timestamp
+from metering_billing.utils.enums import (
+    CATEGORICAL_FILTER_OPERATORS,
+    METRIC_AGGREGATION,
+    METRIC_STATUS,
+    METRIC_TYPE,
+    NUMERIC_FILTER_OPERATORS,
+)
+
+REALTIME_USAGE_COUNTERS = settings.REALTIME_USAGE_COUNTERS
+REALTIME_USAGE_COUNTER_TTL_SECONDS = settings.REALTIME_USAGE_COUNTER_TTL_SECONDS
+# how long the consumer keeps using an organization's counted metrics before it
+# reloads them from the database
+COUNTED_METRICS_TTL_SECONDS = 60
+TRACKED_BILLING_RECORDS_KEY = "usage_counter_billing_records"
+COUNTED_AGGREGATION_TYPES = [METRIC_AGGREGATION.COUNT, METRIC_AGGREGATION.SUM]
+# how long the increments for a counter that is being seeded are kept, it only has to
+# outlast reading the billing record's usage from the database
+SEEDING_TIMEOUT_SECONDS = 300
+
+# only adds to a counter that is already there, so a counter that expired or was
+# never seeded isn't restarted from zero. While a counter is being seeded the
+# increments go to its pending total (KEYS[2]) instead
+INCREMENT_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('INCRBYFLOAT', KEYS[2], ARGV[1])
+end
+return false
+"""
+
+# starts a counter from the total read from the database plus whatever was counted
+# while it was read. Whoever seeds a counter first wins
+SEED_COUNTER = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+local pending = redis.call('GET', KEYS[2])
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+if pending then
+    redis.call('INCRBYFLOAT', KEYS[1], pending)
+end
+return true
+"""
+
+# adds the difference between the database total and the counter as it was read just
+# before it, keeping the increments made in the meantime
+CORRECT_COUNTER = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return true
+"""
+
+logger = logging.getLogger("django.server")
+
+_counted_metrics = {}
+
+
+def counts_in_real_time(metric):
+    return (
+        REALTIME_USAGE_COUNTERS
+        and metric.status == METRIC_STATUS.ACTIVE
+        and metric.metric_type == METRIC_TYPE.COUNTER
+        and metric.usage_aggregation_type in COUNTED_AGGREGATION_TYPES
+    )
+
+
+def usage_counter_key(metric, billing_record):
+    """One counter per organization, metric, customer, subscription filters and usage
+    period. Billing records of a plan and its add-ons that share all of those also
+    share a counter."""
+    filters_digest = hashlib.md5(
+        json.dumps(sorted(billing_record.subscription.subscription_filters)).encode()
+    ).hexdigest()
+    return "usage_counter_{}_{}_{}_{}_{}".format(
+        metric.organization_id,
+        metric.pk,
+        _uuidv5_customer_id(billing_record.customer).hex,
+        filters_digest,
+        int(billing_record.start_date.timestamp()),
+    )
+
+
+def pending_usage_key(counter_key):
+    return f"{counter_key}_pending"
+
+
+def usage_counter_targets_key(metric_pk, uuidv5_customer_id):
+    return f"usage_counter_targets_{metric_pk}_{uuidv5_customer_id.hex}"
+
+
+def get_realtime_usage(metric, billing_record):
+    """Returns the usage of a billing record from its counter, or None if the metric
+    isn't counted in real time or the counter hasn't been seeded yet."""
+    if not counts_in_real_time(metric):
+        return None
+    try:
+        usage = get_redis_connection("main_cache").get(
+            usage_counter_key(metric, billing_record)
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not read usage counter. Exception message: {e}")
+        return None
+    if usage is None:
+        return None
+    return Decimal(usage.decode())
+
+
+def seed_realtime_usage(metric, billing_record, read_usage):
+    """Read the usage of a billing record from the database with `read_usage` and
+    start counting it from there. Returns the usage that was read.
+
+    The consumer starts counting before the database is read, into a pending total
+    that is added to the counter when it is seeded, so the events written while the
+    usage is read aren't lost. Events written just as the read starts can be counted
+    twice, reconcile_usage_counters corrects that and the redelivered events only the
+    database knew were duplicates."""
+    if not counts_in_real_time(metric):
+        return read_usage()
+    counter_key = usage_counter_key(metric, billing_record)
+    targets_key = usage_counter_targets_key(
+        metric.pk, _uuidv5_customer_id(billing_record.customer)
+    )
+    target = {
+        "start_date": billing_record.start_date.isoformat(),
+        "end_date": billing_record.end_date.isoformat(),
+        "subscription_filters": billing_record.subscription.subscription_filters,
+    }
+    try:
+        redis = get_redis_connection("main_cache")
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(
+            pending_usage_key(counter_key),
+            "0",
+            ex=SEEDING_TIMEOUT_SECONDS,
+            nx=True,
+        )
+        pipe.hset(targets_key, counter_key, json.dumps(target))
+        pipe.expire(targets_key, REALTIME_USAGE_COUNTER_TTL_SECONDS)
+        pipe.sadd(TRACKED_BILLING_RECORDS_KEY, billing_record.pk)
+        pipe.execute()
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not seed usage counter. Exception message: {e}")
+        return read_usage()
+    with bypass_usage_cache():
+        usage = read_usage()
+    try:
+        redis.register_script(SEED_COUNTER)(
+            keys=[counter_key, pending_usage_key(counter_key)],
+            args=[str(usage), REALTIME_USAGE_COUNTER_TTL_SECONDS],
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not seed usage counter. Exception message: {e}")
+    return usage
+
+
+def count_written_events(buffer):
+    """Add a batch of events that were written to the database to the counters that
+    track them."""
+    if not REALTIME_USAGE_COUNTERS:
+        return
+    try:
+        _count_written_events(buffer)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Could not update usage counters. Exception message: {e}")
+
+
+def _count_written_events(buffer):
+    events_per_targets = {}
+    for organization_pk, events_list in buffer.items():
+        counted_metrics = get_counted_metrics(organization_pk)
+        for event in events_list:
+            metrics = counted_metrics.get(event["event_name"])
+            if not metrics:
+                continue
+            uuidv5_customer_id = customer_id_uuidv5(event["customer_id"])
+            for metric in metrics:
+                targets_key = usage_counter_targets_key(
+                    metric["pk"], uuidv5_customer_id
+                )
+                events_per_targets.setdefault(targets_key, (metric, []))[1].append(
+                    event
+                )
+    if not events_per_targets:
+        return
+
+    redis = get_redis_connection("main_cache")
+    targets_keys = list(events_per_targets)
+    pipe = redis.pipeline(transaction=False)
+    for targets_key in targets_keys:
+        pipe.hgetall(targets_key)
+    now = now_utc()
+    increments = {}
+    for targets_key, targets in zip(targets_keys, pipe.execute()):
+        metric, events = events_per_targets[targets_key]
+        for counter_key, target in targets.items():
+            target = json.loads(target)
+            for event in events:
+                usage = event_usage(metric, target, event, now)
+                if usage:
+                    increments[counter_key] = increments.get(counter_key, 0) + usage
+    if not increments:
+        return
+
+    increment_if_exists = redis.register_script(INCREMENT_IF_EXISTS)
+    pipe = redis.pipeline(transaction=False)
+    for counter_key, usage in increments.items():
+        increment_if_exists(
+            keys=[counter_key, pending_usage_key(counter_key)],
+            args=[str(usage)],
+            client=pipe,
+        )
+    pipe.execute()
+
+
+def get_counted_metrics(organization_pk):
+    """The organization's metrics that are counted in real time, per event name."""
+    from metering_billing.models import Metric
+
+    expires_at, counted_metrics = _counted_metrics.get(organization_pk, (0, None))
+    if time.monotonic() < expires_at:
+        return counted_metrics
+    counted_metrics = {}
+    metrics = Metric.objects.filter(
+        organization_id=organization_pk,
+        status=METRIC_STATUS.ACTIVE,
+        metric_type=METRIC_TYPE.COUNTER,
+        usage_aggregation_type__in=COUNTED_AGGREGATION_TYPES,
+    ).prefetch_related("numeric_filters", "categorical_filters")
+    for metric in metrics:
+        counted_metrics.setdefault(metric.event_name, []).append(
+            {
+                "pk": metric.pk,
+                "usage_aggregation_type": metric.usage_aggregation_type,
+                "property_name": metric.property_name,
+                "numeric_filters": [
+                    (x.property_name, x.operator, x.comparison_value)
+                    for x in metric.numeric_filters.all()
+                ],
+                "categorical_filters": [
+                    (x.property_name, x.operator, x.comparison_value)
+                    for x in metric.categorical_filters.all()
+                ],
+            }
+        )
+    _counted_metrics[organization_pk] = (
+        time.monotonic() + COUNTED_METRICS_TTL_SECONDS,
+        counted_metrics,
+    )
+    return counted_metrics
+
+
+def event_usage(metric, target, event, now):
+    """How much an event adds to a counter, applying the same rules as the counter
+    queries: the event has to be inside the usage period and not in the future, match
+    the subscription filters and the metric's filters, and a sum only adds numeric
+    values.
+
+    Events outside the usage period belong to another billing record's counter, if it
+    is tracked, and are never added to this one. Events in the future are skipped
+    even though the database starts counting them once their time has passed. The
+    counter catches up with them at the first reconcile_usage_counters run after
+    that, which runs every few minutes for every tracked billing record."""
+    time_created = parse_event_timestamp(event["time_created"])
+    if time_created > now:
+        return 0
+    if not (
+        parse_event_timestamp(target["start_date"])
+        <= time_created
+        <= parse_event_timestamp(target["end_date"])
+    ):
+        return 0
+    properties = event.get("properties") or {}
+    for property_name, value in target["subscription_filters"]:
+        if _property_text(properties.get(property_name)) != value:
+            return 0
+    for property_name, operator, comparison in metric["numeric_filters"]:
+        value = _property_decimal(properties.get(property_name))
+        if value is None:
+            return 0
+        comparison = Decimal(str(comparison))
+        if operator == NUMERIC_FILTER_OPERATORS.GT and not value > comparison:
+            return 0
+        elif operator == NUMERIC_FILTER_OPERATORS.GTE and not value >= comparison:
+            return 0
+        elif operator == NUMERIC_FILTER_OPERATORS.LT and not value < comparison:
+            return 0
+        elif operator == NUMERIC_FILTER_OPERATORS.LTE and not value <= comparison:
+            return 0
+        elif operator == NUMERIC_FILTER_OPERATORS.EQ and not value == comparison:
+            return 0
+    for property_name, operator, comparison in metric["categorical_filters"]:
+        value = _property_text(properties.get(property_name)) or ""
+        is_in = value in [str(x) for x in comparison]
+        if is_in != (operator == CATEGORICAL_FILTER_OPERATORS.ISIN):
+            return 0
+    if metric["usage_aggregation_type"] == METRIC_AGGREGATION.COUNT:
+        return 1
+    return _property_decimal(properties.get(metric["property_name"])) or 0
+
+
+def tracked_billing_record_pks():
+    pks = get_redis_connection("main_cache").smembers(TRACKED_BILLING_RECORDS_KEY)
+    return [int(pk) for pk in pks]
+
+
+def untrack_billing_records(billing_record_pks):
+    if billing_record_pks:
+        get_redis_connection("main_cache").srem(
+            TRACKED_BILLING_RECORDS_KEY, *billing_record_pks
+        )
+
+
+def correct_usage_counters(metric, billing_records):
+    """Correct the counters of billing records with their totals read from the
+    database, bypassing the usage cache. The counters are read just before the
+    database and only the difference is added to them, so the increments made while
+    the database is read are kept. Counters that have expired are left alone and their
+    billing records are no longer tracked, they are seeded again the next time their
+    usage is checked."""
+    redis = get_redis_connection("main_cache")
+    billing_records = list(billing_records)
+    counter_keys = [
+        usage_counter_key(metric, billing_record) for billing_record in billing_records
+    ]
+    counted = redis.mget(counter_keys)
+    with bypass_usage_cache():
+        usage_per_billing_record = metric.get_billing_records_total_billable_usage(
+            billing_records
+        )
+    correct_counter = redis.register_script(CORRECT_COUNTER)
+    pipe = redis.pipeline(transaction=False)
+    corrected = []
+    expired = []
+    for billing_record, counter_key, counted_usage in zip(
+        billing_records, counter_keys, counted
+    ):
+        if counted_usage is None:
+            expired.append(billing_record.pk)
+            continue
+        difference = usage_per_billing_record[billing_record] - Decimal(
+            counted_usage.decode()
+        )
+        correct_counter(
+            keys=[counter_key],
+            args=[str(difference), REALTIME_USAGE_COUNTER_TTL_SECONDS],
+            client=pipe,
+        )
+        corrected.append(billing_record.pk)
+    expired += [pk for pk, was_set in zip(corrected, pipe.execute()) if not was_set]
+    untrack_billing_records(expired)
+
+
+def _uuidv5_customer_id(customer):
+    return customer.uuidv5_customer_id or customer_id_uuidv5(customer.customer_id)
+
+
+def _property_text(value):
+    """The text postgres' ->> operator returns for a json property."""
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _property_decimal(value):
+    value = _property_text(value)
+    if value is None:
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
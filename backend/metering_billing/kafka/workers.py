@@ -0,0 +1,90 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+logger = logging.getLogger("django.server")
+
+RESTART_BACKOFF_SECONDS = 5
+SHUTDOWN_TIMEOUT_SECONDS = 30
+
+
+def run_consumer(consumer):
+    """Run a consumer until it receives SIGTERM/SIGINT, then flush and leave the group."""
+
+    def handle_shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, stopping event consumer")
+        consumer.stop()
+
+    signal.signal(signal.SIGTERM, handle_shutdown)
+    signal.signal(signal.SIGINT, handle_shutdown)
+    try:
+        while consumer.running:
+            consumer.consume()
+    finally:
+        consumer.close()
+
+
+def consumer_worker(worker_index):
+    # workers are spawned, not forked, so each one sets up django and opens its own
+    # kafka and database connections
+    import django
+
+    django.setup()
+
+    from metering_billing.kafka.consumer import Consumer
+
+    logger.info(f"Starting event consumer worker {worker_index}")
+    run_consumer(Consumer())
+
+
+class ConsumerSupervisor:
+    """Runs `num_workers` consumer processes in the same consumer group.
+
+    Kafka spreads the topic's partitions over the workers and rebalances them when a
+    worker joins or leaves. Workers that die are restarted; on SIGTERM/SIGINT every
+    worker is asked to flush its buffer and shut down."""
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = {}
+        self.running = True
+
+    def start_worker(self, worker_index):
+        process = self.context.Process(
+            target=consumer_worker,
+            args=(worker_index,),
+            name=f"event-consumer-{worker_index}",
+        )
+        process.start()
+        self.workers[worker_index] = process
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_index in range(self.num_workers):
+            self.start_worker(worker_index)
+        while self.running:
+            time.sleep(RESTART_BACKOFF_SECONDS)
+            for worker_index, process in list(self.workers.items()):
+                if not process.is_alive() and self.running:
+                    logger.error(
+                        f"Event consumer worker {worker_index} exited with code {process.exitcode}, restarting"
+                    )
+                    self.start_worker(worker_index)
+        self.shutdown()
+
+    def shutdown(self):
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT_SECONDS
+        for process in self.workers.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.error(f"Killing event consumer worker {process.name}")
+                process.kill()
@@ -0,0 +1,73 @@
+import json
+import time
+import uuid
+from datetime import timedelta
+
+import orjson
+import pytz
+from dateutil import parser
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand
+
+from metering_billing.utils import now_utc, parse_event_timestamp
+
+
+def make_body(num_events):
+    now = now_utc()
+    batch = []
+    for i in range(num_events):
+        time_created = now - timedelta(minutes=i)
+        if i % 2:
+            time_created = time_created.astimezone(pytz.timezone("America/New_York"))
+        batch.append(
+            {
+                "customer_id": f"customer_{i % 50}",
+                "event_name": "api_call",
+                "idempotency_id": uuid.uuid4().hex,
+                "time_created": time_created.isoformat().replace("+00:00", "Z"),
+                "properties": {"region": "us-east-1", "tokens": i},
+            }
+        )
+    return json.dumps({"batch": batch}).encode("utf-8")
+
+
+def decode_dateutil(body):
+    now = now_utc()
+    for data in json.loads(body)["batch"]:
+        tc = parser.parse(data["time_created"])
+        if tc.tzinfo is None or tc.tzinfo.utcoffset(tc) is None:
+            tc = tc.replace(tzinfo=pytz.UTC)
+        now - relativedelta(days=30) <= tc <= now + relativedelta(days=1)
+
+
+def decode_fast(body):
+    now = now_utc()
+    earliest_time_created = now - timedelta(days=30)
+    latest_time_created = now + timedelta(days=1)
+    for data in orjson.loads(body)["batch"]:
+        tc = parse_event_timestamp(data["time_created"])
+        earliest_time_created <= tc <= latest_time_created
+
+
+class Command(BaseCommand):
+    "Django command to compare the per-event cost of decoding /api/track batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        num_events = options["events"]
+        body = make_body(num_events)
+        for name, decode in [
+            ("json + dateutil", decode_dateutil),
+            ("orjson + rfc3339", decode_fast),
+        ]:
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                start = time.process_time()
+                decode(body)
+                best = min(best, time.process_time() - start)
+            self.stdout.write(
+                f"{name}: {best * 1e6 / num_events:.2f} us/event ({num_events} events, best of {options['repeat']})"
+            )
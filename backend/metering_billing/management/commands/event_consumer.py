@@ -1,12 +1,23 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from metering_billing.kafka.consumer import Consumer
+from metering_billing.kafka.workers import ConsumerSupervisor, run_consumer
 
 
 class Command(BaseCommand):
-    "Django command to pause execution until the database is available"
+    "Django command to consume events from Kafka and write them to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.KAFKA_CONSUMER_WORKERS,
+            help="Number of consumer processes to run in the consumer group.",
+        )
 
     def handle(self, *args, **options):
-        consumer = Consumer()
-        while True:
-            consumer.consume()
+        if options["workers"] > 1:
+            ConsumerSupervisor(options["workers"]).run()
+        else:
+            run_consumer(Consumer())
@@ -11,6 +11,8 @@ from metering_billing.models import (
     Customer,
     CustomerBalanceAdjustment,
     Feature,
+    InvoiceLineItem,
+    InvoiceLineItemAdjustment,
     Organization,
     Plan,
     PlanVersion,
@@ -156,8 +158,20 @@ class Command(BaseCommand):
             is_new=True,
         )
 
-        # invoice
+        # invoice, kept a draft like the collection expects. Drafts are only built in
+        # memory, so this one is saved along with its line items
         invoice = generate_invoice(sr, draft=True)[0]
+        invoice.save()
+        for line_item in invoice.draft_line_items:
+            line_item.invoice = invoice
+        InvoiceLineItem.objects.bulk_create(invoice.draft_line_items)
+        InvoiceLineItemAdjustment.objects.bulk_create(
+            [
+                adjustment
+                for line_item in invoice.draft_line_items
+                for adjustment in line_item.draft_adjustments
+            ]
+        )
         print(f"INVOICE_ID=invoice_{invoice.invoice_id.hex}")
 
         # credit
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from kafka import KafkaConsumer, TopicPartition
+
+from metering_billing.kafka.consumer import (
+    after_events_written,
+    make_dead_letter,
+    without_failed_events,
+    write_batch_events_to_db,
+    write_events_individually,
+)
+from metering_billing.kafka.producer import Producer
+
+KAFKA_EVENTS_DLQ_TOPIC = settings.KAFKA_EVENTS_DLQ_TOPIC
+KAFKA_DLQ_REPLAY_GROUP = settings.KAFKA_DLQ_REPLAY_GROUP
+CONSUMER_CONFIG = settings.CONSUMER_CONFIG
+MAX_EMPTY_POLLS = 5
+
+
+class Command(BaseCommand):
+    "Django command to write the events in the dead-letter topic to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.KAFKA_CONSUMER_BATCH_SIZE,
+            help="Number of dead letters written per batch.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Report what would be replayed without writing or committing anything.",
+        )
+
+    def handle(self, *args, **options):
+        if CONSUMER_CONFIG is None:
+            raise CommandError("Kafka is disabled, there is no dead-letter topic")
+        consumer = KafkaConsumer(
+            **{**CONSUMER_CONFIG, "group_id": KAFKA_DLQ_REPLAY_GROUP}
+        )
+        partitions = [
+            TopicPartition(KAFKA_EVENTS_DLQ_TOPIC, partition)
+            for partition in consumer.partitions_for_topic(KAFKA_EVENTS_DLQ_TOPIC) or []
+        ]
+        consumer.assign(partitions)
+        # only replay what is in the topic right now, dead letters that fail again are
+        # re-queued behind this point and left for the next run
+        end_offsets = consumer.end_offsets(partitions)
+
+        replayed = skipped = failed = 0
+        empty_polls = 0
+        try:
+            while any(consumer.position(tp) < end_offsets[tp] for tp in partitions):
+                records = consumer.poll(
+                    timeout_ms=1000, max_records=options["batch_size"]
+                )
+                if not records:
+                    empty_polls += 1
+                    if empty_polls >= MAX_EMPTY_POLLS:
+                        break
+                    continue
+                empty_polls = 0
+                buffer = {}
+                attempts = {}
+                for tp, messages in records.items():
+                    for message in messages:
+                        if message.offset >= end_offsets[tp]:
+                            continue
+                        dead_letter = message.value
+                        if not dead_letter or dead_letter.get("event") is None:
+                            # unparseable messages have nothing to replay
+                            skipped += 1
+                            continue
+                        event = dead_letter["event"]
+                        buffer.setdefault(dead_letter["organization_id"], []).append(
+                            event
+                        )
+                        attempts[id(event)] = dead_letter.get("attempts", 1)
+                        replayed += 1
+                if options["dry_run"] or not buffer:
+                    continue
+                try:
+                    inserted = write_batch_events_to_db(buffer)
+                    still_failing = []
+                except Exception:
+                    still_failing, inserted = write_events_individually(buffer)
+                after_events_written(
+                    without_failed_events(buffer, still_failing), inserted
+                )
+                if still_failing:
+                    failed += len(still_failing)
+                    Producer().produce_dead_letters(
+                        [
+                            make_dead_letter(
+                                event.get("customer_id"),
+                                organization_pk,
+                                event,
+                                error,
+                                attempts=attempts[id(event)] + 1,
+                            )
+                            for organization_pk, event, error in still_failing
+                        ]
+                    )
+                consumer.commit()
+        finally:
+            consumer.close(autocommit=False)
+
+        self.stdout.write(
+            f"Replayed {replayed - failed} events, {failed} failed again and were re-queued, {skipped} unparseable messages were skipped"
+            + (" (dry run)" if options["dry_run"] else "")
+        )
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from metering_billing.models import BillingRun
+from metering_billing.tasks import INVOICE_RUN_CONCURRENCY, resume_billing_run_inner
+
+
+class Command(BaseCommand):
+    "Django command to invoice the customers a billing run didn't get to"
+
+    def add_arguments(self, parser):
+        parser.add_argument("billing_run_id", type=str)
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            help="Also invoice the customers the run failed to invoice",
+        )
+
+    def handle(self, *args, **options):
+        billing_run = BillingRun.objects.get(billing_run_id=options["billing_run_id"])
+        resume_billing_run_inner(
+            billing_run,
+            retry_failed=options["retry_failed"],
+            shards=INVOICE_RUN_CONCURRENCY,
+        )
@@ -44,6 +44,18 @@ class Command(BaseCommand):
             defaults={"interval": every_3_minutes, "crontab": None},
         )
 
+        PeriodicTask.objects.update_or_create(
+            name="Reconcile Usage Counters",
+            task="metering_billing.tasks.reconcile_usage_counters",
+            defaults={"interval": every_3_minutes, "crontab": None},
+        )
+
+        PeriodicTask.objects.update_or_create(
+            name="Advance Gauge State Checkpoints",
+            task="metering_billing.tasks.advance_gauge_state_checkpoints",
+            defaults={"interval": every_5_mins, "crontab": None},
+        )
+
         PeriodicTask.objects.update_or_create(
             name="Run Zero Out Expired Balances",
             task="metering_billing.tasks.zero_out_expired_balance_adjustments",
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from metering_billing.aggregation.billable_metrics import MetricHandler
+from metering_billing.models import Metric
+from metering_billing.utils.enums import METRIC_STATUS, METRIC_TYPE
+
+
+class Command(BaseCommand):
+    "Django command to build the event property indexes of every active metric"
+
+    def handle(self, *args, **options):
+        if not settings.EVENT_PROPERTY_INDEXES:
+            raise CommandError("EVENT_PROPERTY_INDEXES is off")
+        metrics = (
+            Metric.objects.filter(status=METRIC_STATUS.ACTIVE)
+            .exclude(metric_type=METRIC_TYPE.CUSTOM)
+            .exclude(event_name=None)
+            .select_related("organization")
+            .order_by("organization", "event_name")
+            .distinct("organization", "event_name")
+        )
+        # one metric per event name is enough, each sync covers every metric on it
+        for metric in metrics:
+            MetricHandler.sync_property_indexes(metric)
+            self.stdout.write(
+                f"Synced indexes of {metric.event_name} for "
+                f"{metric.organization.organization_name}"
+            )
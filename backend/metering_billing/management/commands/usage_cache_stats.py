@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from metering_billing.aggregation.usage_cache import get_usage_cache_stats
+
+
+class Command(BaseCommand):
+    "Django command to print the hits and misses of the usage cache"
+
+    def handle(self, *args, **options):
+        stats = get_usage_cache_stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups else 0
+        self.stdout.write(
+            f"hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {hit_rate:.1%}"
+        )
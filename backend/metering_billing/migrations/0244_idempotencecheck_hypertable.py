@@ -0,0 +1,304 @@
+from django.db import migrations
+
+# The guard table becomes a hypertable partitioned on time_created, so expired rows can
+# be removed by dropping whole chunks instead of a row-by-row DELETE. Unique indexes on
+# a hypertable have to include the partitioning column, so the primary key becomes
+# (uuidv5_idempotency_id, time_created). A repeated idempotency_id with a different
+# time_created is still rejected by insert_metric and the Kafka consumer's merge, the
+# only two writers of the table. Both take a transaction level advisory lock on the id
+# and then check every chunk for it before claiming it, so two concurrent inserts of
+# the same id can't both pass the check.
+#
+# Existing tables are migrated by copying the rows that are still inside the 33 day
+# retention window into a new hypertable and swapping it in. A trigger on the old table
+# mirrors every row written from the moment the new table exists, so the copy can be
+# done in batches that each commit on their own while events keep being ingested. The
+# old table is only locked to swap the tables, which doesn't read any rows.
+
+# first key of the advisory locks held on an idempotency id while it is claimed, the
+# second one is the hash of the id. Incremental gauge states use 1, invoicing uses 2
+IDEMPOTENCY_ADVISORY_LOCK = 3
+COPY_BATCH_SIZE = 50000
+
+CREATE_PARTITIONED_GUARD_TABLE = """
+CREATE TABLE metering_billing_idempotencecheck_partitioned (
+    LIKE metering_billing_idempotencecheck INCLUDING DEFAULTS
+);
+ALTER TABLE metering_billing_idempotencecheck_partitioned
+    ADD CONSTRAINT metering_billing_idempotencecheck_partitioned_pkey
+    PRIMARY KEY (uuidv5_idempotency_id, time_created);
+SELECT create_hypertable(
+    'metering_billing_idempotencecheck_partitioned',
+    'time_created',
+    chunk_time_interval => INTERVAL '7 days'
+);
+
+CREATE FUNCTION mirror_idempotencecheck() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO metering_billing_idempotencecheck_partitioned (
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    )
+    VALUES (NEW.organization_id, NEW.time_created, NEW.uuidv5_idempotency_id)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mirror_idempotencecheck_insert
+    AFTER INSERT ON metering_billing_idempotencecheck
+    FOR EACH ROW EXECUTE FUNCTION mirror_idempotencecheck();
+"""
+
+DROP_PARTITIONED_GUARD_TABLE = """
+DROP TRIGGER IF EXISTS mirror_idempotencecheck_insert
+    ON metering_billing_idempotencecheck;
+DROP FUNCTION IF EXISTS mirror_idempotencecheck();
+DROP TABLE IF EXISTS metering_billing_idempotencecheck_partitioned;
+"""
+
+# walks the old table's primary key, so every batch is an index range scan
+COPY_GUARD_ROWS_BATCH = """
+WITH batch AS (
+    SELECT
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    FROM
+        metering_billing_idempotencecheck
+    WHERE
+        uuidv5_idempotency_id > %(after)s
+    ORDER BY
+        uuidv5_idempotency_id
+    LIMIT %(batch_size)s
+), copied AS (
+    INSERT INTO metering_billing_idempotencecheck_partitioned (
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    )
+    SELECT
+        organization_id,
+        time_created,
+        uuidv5_idempotency_id
+    FROM
+        batch
+    WHERE
+        time_created >= now() - INTERVAL '33 days'
+    ON CONFLICT DO NOTHING
+)
+SELECT max(uuidv5_idempotency_id::text) FROM batch
+"""
+
+# every row is already in the new table, written by the batches or mirrored by the
+# trigger, so the lock is only held for the swap itself
+SWAP_GUARD_TABLE = """
+LOCK TABLE metering_billing_idempotencecheck IN ACCESS EXCLUSIVE MODE;
+
+DROP TABLE metering_billing_idempotencecheck;
+DROP FUNCTION mirror_idempotencecheck();
+ALTER TABLE metering_billing_idempotencecheck_partitioned
+    RENAME TO metering_billing_idempotencecheck;
+ALTER INDEX metering_billing_idempotencecheck_partitioned_pkey
+    RENAME TO metering_billing_idempotencecheck_pkey;
+ALTER TABLE metering_billing_idempotencecheck
+    ADD CONSTRAINT metering_billing_idempotencecheck_organization_id_fk
+    FOREIGN KEY (organization_id) REFERENCES metering_billing_organization (id)
+    DEFERRABLE INITIALLY DEFERRED;
+"""
+
+REVERT_GUARD_TABLE = """
+CREATE TABLE metering_billing_idempotencecheck_unpartitioned (
+    LIKE metering_billing_idempotencecheck INCLUDING DEFAULTS
+);
+INSERT INTO metering_billing_idempotencecheck_unpartitioned (
+    organization_id,
+    time_created,
+    uuidv5_idempotency_id
+)
+SELECT DISTINCT ON (uuidv5_idempotency_id)
+    organization_id,
+    time_created,
+    uuidv5_idempotency_id
+FROM
+    metering_billing_idempotencecheck;
+
+DROP TABLE metering_billing_idempotencecheck;
+ALTER TABLE metering_billing_idempotencecheck_unpartitioned
+    RENAME TO metering_billing_idempotencecheck;
+ALTER TABLE metering_billing_idempotencecheck
+    ADD CONSTRAINT metering_billing_idempotencecheck_pkey
+    PRIMARY KEY (uuidv5_idempotency_id);
+ALTER TABLE metering_billing_idempotencecheck
+    ADD CONSTRAINT unique_hashed_idempotency_id_per_org_raw
+    UNIQUE (organization_id, uuidv5_idempotency_id);
+ALTER TABLE metering_billing_idempotencecheck
+    ADD CONSTRAINT metering_billing_idempotencecheck_organization_id_fk
+    FOREIGN KEY (organization_id) REFERENCES metering_billing_organization (id)
+    DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX metering_billing_idempotencecheck_organization_id_idx
+    ON metering_billing_idempotencecheck (organization_id);
+"""
+
+
+def copy_guard_rows(apps, schema_editor):
+    after = "00000000-0000-0000-0000-000000000000"
+    while after is not None:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                COPY_GUARD_ROWS_BATCH,
+                {"after": after, "batch_size": COPY_BATCH_SIZE},
+            )
+            after = cursor.fetchone()[0]
+
+
+def swap_guard_table(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(SWAP_GUARD_TABLE)
+
+
+def revert_guard_table(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(REVERT_GUARD_TABLE)
+
+
+def insert_metric_function(guard_clause, lock_clause=""):
+    return f"""
+    CREATE OR REPLACE FUNCTION insert_metric(
+        p_organization_id integer,
+        p_cust_id text,
+        p_event_name text,
+        p_time_created timestamp with time zone,
+        p_properties jsonb,
+        p_idempotency_id text
+    ) RETURNS VOID AS $$ DECLARE
+
+    v_uuidv5_event_name uuid;
+    v_uuidv5_idempotency_id uuid;
+    v_uuidv5_customer_id uuid;
+
+    BEGIN
+
+    v_uuidv5_customer_id := uuid_generate_v5(
+        'D1337E57-E6A0-4650-B1C3-D6487AFFB8CA' :: uuid,
+        p_cust_id
+    );
+
+    v_uuidv5_event_name := uuid_generate_v5(
+        '843D7005-63DE-4B72-B731-77E2866DCCFF' :: uuid,
+        p_event_name
+    );
+
+    v_uuidv5_idempotency_id := uuid_generate_v5(
+        '904C0FFB-7005-414E-9B7D-8E3C5DDE266D' :: uuid,
+        p_idempotency_id
+    );
+    {lock_clause}
+    INSERT INTO
+        metering_billing_idempotencecheck (
+            organization_id,
+            time_created,
+            uuidv5_idempotency_id
+        )
+    SELECT
+        p_organization_id,
+        p_time_created,
+        v_uuidv5_idempotency_id
+    {guard_clause}
+    ON CONFLICT DO NOTHING;
+
+    IF FOUND THEN
+    INSERT INTO
+        metering_billing_usageevent (
+            organization_id,
+            cust_id,
+            uuidv5_customer_id,
+            event_name,
+            uuidv5_event_name,
+            idempotency_id,
+            uuidv5_idempotency_id,
+            properties,
+            time_created,
+            inserted_at
+        )
+    VALUES
+        (
+            p_organization_id,
+            p_cust_id,
+            v_uuidv5_customer_id,
+            p_event_name,
+            v_uuidv5_event_name,
+            p_idempotency_id,
+            v_uuidv5_idempotency_id,
+            p_properties,
+            p_time_created,
+            CURRENT_TIMESTAMP
+        );
+
+    END IF;
+
+    END;
+
+    $$ LANGUAGE plpgsql;
+    """
+
+
+class Migration(migrations.Migration):
+    # the rows are copied in batches that commit on their own, the steps that have to
+    # be atomic run in a transaction of their own
+    atomic = False
+
+    dependencies = [
+        ("metering_billing", "0243_alter_backtest_backtest_name_and_more"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveConstraint(
+                    model_name="idempotencecheck",
+                    name="unique_hashed_idempotency_id_per_org_raw",
+                ),
+                migrations.AlterModelOptions(
+                    name="idempotencecheck",
+                    options={"managed": False},
+                ),
+            ],
+            database_operations=[
+                migrations.RunSQL(
+                    sql=CREATE_PARTITIONED_GUARD_TABLE,
+                    reverse_sql=DROP_PARTITIONED_GUARD_TABLE,
+                ),
+                migrations.RunPython(
+                    copy_guard_rows,
+                    reverse_code=migrations.RunPython.noop,
+                    atomic=False,
+                ),
+                migrations.RunPython(
+                    swap_guard_table,
+                    reverse_code=revert_guard_table,
+                    atomic=True,
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            sql=insert_metric_function(
+                """WHERE
+        NOT EXISTS (
+            SELECT 1
+            FROM metering_billing_idempotencecheck
+            WHERE uuidv5_idempotency_id = v_uuidv5_idempotency_id
+        )""",
+                lock_clause=f"""
+    -- serializes concurrent claims of the same id, so the check below sees the
+    -- other one's row once it commits
+    PERFORM pg_advisory_xact_lock(
+        {IDEMPOTENCY_ADVISORY_LOCK},
+        hashtext(v_uuidv5_idempotency_id :: text)
+    );
+""",
+            ),
+            reverse_sql=insert_metric_function(""),
+        ),
+    ]
@@ -0,0 +1,41 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0244_idempotencecheck_hypertable"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="historicalmetric",
+            name="approximate_unique_error",
+            field=models.DecimalField(
+                blank=True,
+                decimal_places=4,
+                help_text="Only applies to metrics of type 'counter' with a unique aggregation. If set, unique values are counted approximately using HyperLogLog sketches with roughly this relative standard error (0.01 is 1%). Leave empty to count them exactly.",
+                max_digits=5,
+                null=True,
+                validators=[
+                    django.core.validators.MinValueValidator(0),
+                    django.core.validators.MaxValueValidator(1),
+                ],
+            ),
+        ),
+        migrations.AddField(
+            model_name="metric",
+            name="approximate_unique_error",
+            field=models.DecimalField(
+                blank=True,
+                decimal_places=4,
+                help_text="Only applies to metrics of type 'counter' with a unique aggregation. If set, unique values are counted approximately using HyperLogLog sketches with roughly this relative standard error (0.01 is 1%). Leave empty to count them exactly.",
+                max_digits=5,
+                null=True,
+                validators=[
+                    django.core.validators.MinValueValidator(0),
+                    django.core.validators.MaxValueValidator(1),
+                ],
+            ),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, models
+
+PER_SECOND_AGGREGATE_HELP_TEXT = "Only applies to metrics of type 'counter' that aren't unique. Whether to keep a per second continuous aggregate for the partial hours at either end of a billing period. If false, those are read from the raw events instead, which is cheaper to maintain but slower to query for very busy customers."
+
+
+def provision_hour_caggs(apps, schema_editor):
+    Metric = apps.get_model("metering_billing", "Metric")
+
+    # counter metrics now also read from an hourly cagg, which is created the next time
+    # the metric's views are provisioned
+    Metric.objects.filter(metric_type="counter").exclude(
+        usage_aggregation_type="unique"
+    ).update(mat_views_provisioned=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0245_metric_approximate_unique_error"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="historicalmetric",
+            name="per_second_aggregate",
+            field=models.BooleanField(
+                default=True, help_text=PER_SECOND_AGGREGATE_HELP_TEXT
+            ),
+        ),
+        migrations.AddField(
+            model_name="metric",
+            name="per_second_aggregate",
+            field=models.BooleanField(
+                default=True, help_text=PER_SECOND_AGGREGATE_HELP_TEXT
+            ),
+        ),
+        migrations.RunPython(
+            provision_hour_caggs, reverse_code=migrations.RunPython.noop
+        ),
+    ]
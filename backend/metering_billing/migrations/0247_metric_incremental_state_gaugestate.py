@@ -0,0 +1,68 @@
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+INCREMENTAL_STATE_HELP_TEXT = "Only applies to metrics of type 'gauge'. Whether to keep each customer's running state in a table that is updated as events are written, so the current usage is read from the last state and the events since then instead of the whole event history."
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0246_metric_per_second_aggregate"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="historicalmetric",
+            name="incremental_state",
+            field=models.BooleanField(
+                default=False, help_text=INCREMENTAL_STATE_HELP_TEXT
+            ),
+        ),
+        migrations.AddField(
+            model_name="metric",
+            name="incremental_state",
+            field=models.BooleanField(
+                default=False, help_text=INCREMENTAL_STATE_HELP_TEXT
+            ),
+        ),
+        migrations.CreateModel(
+            name="GaugeState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("uuidv5_customer_id", models.UUIDField()),
+                ("group_values", models.JSONField(default=dict)),
+                (
+                    "usage_qty",
+                    models.DecimalField(
+                        decimal_places=10, default=Decimal("0"), max_digits=20
+                    ),
+                ),
+                ("last_event_time", models.DateTimeField(blank=True, null=True)),
+                ("checkpoint", models.DateTimeField()),
+                (
+                    "metric",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="gauge_states",
+                        to="metering_billing.metric",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="gaugestate",
+            constraint=models.UniqueConstraint(
+                fields=("metric", "uuidv5_customer_id", "group_values"),
+                name="unique_gauge_state",
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+def provision_minute_caggs(apps, schema_editor):
+    Metric = apps.get_model("metering_billing", "Metric")
+
+    # rate metrics now read their current usage from a per minute cagg, which is
+    # created the next time the metric's views are provisioned
+    Metric.objects.filter(metric_type="rate").update(mat_views_provisioned=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0247_metric_incremental_state_gaugestate"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            provision_minute_caggs, reverse_code=migrations.RunPython.noop
+        ),
+    ]
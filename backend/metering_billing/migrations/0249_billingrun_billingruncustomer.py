@@ -0,0 +1,104 @@
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import metering_billing.utils.utils
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0248_provision_rate_minute_caggs"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BillingRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "billing_run_id",
+                    models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+                (
+                    "started_at",
+                    models.DateTimeField(default=metering_billing.utils.utils.now_utc),
+                ),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "status",
+                    models.PositiveSmallIntegerField(
+                        choices=[(1, "running"), (2, "completed")], default=1
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="BillingRunCustomer",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.PositiveSmallIntegerField(
+                        choices=[
+                            (1, "pending"),
+                            (2, "done"),
+                            (3, "failed"),
+                            (4, "skipped"),
+                            (5, "running"),
+                        ],
+                        default=1,
+                    ),
+                ),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                ("error", models.TextField(blank=True, null=True)),
+                (
+                    "billing_run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="customers",
+                        to="metering_billing.billingrun",
+                    ),
+                ),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="billing_run_entries",
+                        to="metering_billing.customer",
+                    ),
+                ),
+                (
+                    "organization",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="billing_run_entries",
+                        to="metering_billing.organization",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="billingruncustomer",
+            constraint=models.UniqueConstraint(
+                fields=("billing_run", "customer"), name="unique_billing_run_customer"
+            ),
+        ),
+    ]
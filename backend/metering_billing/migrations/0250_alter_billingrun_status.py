@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0249_billingrun_billingruncustomer"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="billingrun",
+            name="status",
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, "running"), (2, "completed"), (3, "failed")], default=1
+            ),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("metering_billing", "0250_alter_billingrun_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="billingruncustomer",
+            name="claimed_by",
+            field=models.UUIDField(blank=True, null=True),
+        ),
+    ]
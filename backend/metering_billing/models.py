@@ -22,10 +22,11 @@ from django.core.validators import (
     MinValueValidator,
 )
 from django.db import connection, models
-from django.db.models import Count, F, FloatField, Q, Sum
+from django.db.models import Count, F, FloatField, Max, Q, Sum
 from django.db.models.constraints import CheckConstraint, UniqueConstraint
 from django.db.models.functions import Cast, Coalesce
 from django.utils.translation import gettext_lazy as _
+from metering_billing.aggregation.usage_cache import cached_usage, cached_usage_many
 from metering_billing.exceptions.exceptions import (
     ExternalConnectionFailure,
     NotEditable,
@@ -773,8 +774,6 @@ class Customer(models.Model):
                 charge_next_plan=True,
             )
             total += sum([inv.amount for inv in invs])
-            for inv in invs:
-                inv.delete()
         return total
 
     def get_currency_balance(self, currency):
@@ -1042,15 +1041,13 @@ class IdempotenceCheck(models.Model):
     time_created = models.DateTimeField(
         help_text="The time that the event occured, represented as a datetime in RFC3339 in the UTC timezome."
     )
+    # the table is a hypertable on time_created, so its real primary key is
+    # (uuidv5_idempotency_id, time_created); expired chunks are dropped by
+    # prune_guard_table
     uuidv5_idempotency_id = models.UUIDField(primary_key=True)
 
     class Meta:
-        constraints = [
-            models.UniqueConstraint(
-                fields=["organization", "uuidv5_idempotency_id"],
-                name="unique_hashed_idempotency_id_per_org_raw",
-            )
-        ]
+        managed = False
 
     def __str__(self):
         return str(self.time_created)[:10] + "-" + str(self.idempotency_id)[:6]
@@ -1216,6 +1213,22 @@ class Metric(models.Model):
         null=True,
         help_text="A custom SQL query that can be used to define the metric. Please refer to our documentation for more information.",
     )
+    approximate_unique_error = models.DecimalField(
+        max_digits=5,
+        decimal_places=4,
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(0), MaxValueValidator(1)],
+        help_text="Only applies to metrics of type 'counter' with a unique aggregation. If set, unique values are counted approximately using HyperLogLog sketches with roughly this relative standard error (0.01 is 1%). Leave empty to count them exactly.",
+    )
+    per_second_aggregate = models.BooleanField(
+        default=True,
+        help_text="Only applies to metrics of type 'counter' that aren't unique. Whether to keep a per second continuous aggregate for the partial hours at either end of a billing period. If false, those are read from the raw events instead, which is cheaper to maintain but slower to query for very busy customers.",
+    )
+    incremental_state = models.BooleanField(
+        default=False,
+        help_text="Only applies to metrics of type 'gauge'. Whether to keep each customer's running state in a table that is updated as events are written, so the current usage is read from the last state and the events since then instead of the whole event history.",
+    )
 
     # filters
     numeric_filters = models.ManyToManyField(NumericFilter, blank=True)
@@ -1326,7 +1339,32 @@ class Metric(models.Model):
             self.provision_materialized_views()
 
         handler = METRIC_HANDLER_MAP[self.metric_type]
-        usage = handler.get_billing_record_total_billable_usage(self, billing_record)
+        usage = cached_usage(
+            "total",
+            self,
+            billing_record,
+            lambda: handler.get_billing_record_total_billable_usage(
+                self, billing_record
+            ),
+        )
+
+        return usage
+
+    def get_billing_records_total_billable_usage(self, billing_records):
+        from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+
+        if self.status == METRIC_STATUS.ACTIVE and not self.mat_views_provisioned:
+            self.provision_materialized_views()
+
+        handler = METRIC_HANDLER_MAP[self.metric_type]
+        usage = cached_usage_many(
+            "total",
+            self,
+            billing_records,
+            lambda missing: handler.get_billing_records_total_billable_usage(
+                self, missing
+            ),
+        )
 
         return usage
 
@@ -1337,7 +1375,14 @@ class Metric(models.Model):
             self.provision_materialized_views()
 
         handler = METRIC_HANDLER_MAP[self.metric_type]
-        usage = handler.get_billing_record_daily_billable_usage(self, billing_record)
+        usage = cached_usage(
+            "daily",
+            self,
+            billing_record,
+            lambda: handler.get_billing_record_daily_billable_usage(
+                self, billing_record
+            ),
+        )
 
         return usage
 
@@ -1348,7 +1393,16 @@ class Metric(models.Model):
             self.provision_materialized_views()
 
         handler = METRIC_HANDLER_MAP[self.metric_type]
-        usage = handler.get_billing_record_current_usage(self, billing_record)
+        if self.metric_type == METRIC_TYPE.COUNTER:
+            # the current usage of a counter is its total billable usage
+            usage = cached_usage(
+                "total",
+                self,
+                billing_record,
+                lambda: handler.get_billing_record_current_usage(self, billing_record),
+            )
+        else:
+            usage = handler.get_billing_record_current_usage(self, billing_record)
 
         return usage
 
@@ -1388,6 +1442,31 @@ class Metric(models.Model):
         self.save()
 
 
+class GaugeState(models.Model):
+    """Running state of an incremental gauge metric for one customer and set of
+    subscription filter values, counting the events before `checkpoint`. Every state
+    of a metric has the same checkpoint."""
+
+    metric = models.ForeignKey(
+        Metric, on_delete=models.CASCADE, related_name="gauge_states"
+    )
+    uuidv5_customer_id = models.UUIDField()
+    group_values = models.JSONField(default=dict)
+    usage_qty = models.DecimalField(
+        decimal_places=10, max_digits=20, default=Decimal(0)
+    )
+    last_event_time = models.DateTimeField(null=True, blank=True)
+    checkpoint = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["metric", "uuidv5_customer_id", "group_values"],
+                name="unique_gauge_state",
+            ),
+        ]
+
+
 class UsageRevenueSummary(TypedDict):
     revenue: Decimal
     usage_qty: Decimal
@@ -1750,20 +1829,23 @@ class PlanComponent(models.Model):
         return reset_ranges
 
     def calculate_total_revenue(
-        self, billing_record, prepaid_units=None
+        self,
+        billing_record,
+        prepaid_units=None,
+        has_component_charges=None,
+        usage_qty=None,
     ) -> UsageRevenueSummary:
         assert isinstance(
             billing_record, BillingRecord
         ), "billing_record must be a BillingRecord"
-        billable_metric = self.billable_metric
-        usage_qty = billable_metric.get_billing_record_total_billable_usage(
-            billing_record
-        )
+        if usage_qty is None:
+            usage_qty = self.billable_metric.get_billing_record_total_billable_usage(
+                billing_record
+            )
         revenue = self.tier_rating_function(usage_qty)
-        latest_component_charge = self.component_charge_records.order_by(
-            "-start_date"
-        ).first()
-        if latest_component_charge is not None:
+        if has_component_charges is None:
+            has_component_charges = self.component_charge_records.exists()
+        if has_component_charges:
             revenue_from_prepaid_units = self.tier_rating_function(prepaid_units)
             revenue = max(revenue - revenue_from_prepaid_units, 0)
         return {"revenue": revenue, "usage_qty": usage_qty}
@@ -3519,18 +3601,18 @@ class BillingRecord(models.Model):
             else:
                 return full_amount
 
-    def handle_invoicing(self, invoice_date):
+    def handle_invoicing(self, invoice_date, save=True):
         if self.next_invoicing_date < invoice_date:
             found_next = False
             for invoicing_date in sorted(self.invoicing_dates):
                 if invoicing_date > invoice_date:
                     self.next_invoicing_date = invoicing_date
-                    self.save()
                     found_next = True
                     break
             if not found_next:
                 self.fully_billed = True
                 self.next_invoicing_date = self.invoicing_dates[-1]
+            if save:
                 self.save()
         else:
             # do nothing, we have an invociing date coming up. This invoice was likely from attaching a subscription or something
@@ -3614,7 +3696,9 @@ class BillingRecord(models.Model):
             self.next_invoicing_date = cancel_date
         self.save()
 
-    def calculate_prepay_usage_revenue(self, component_charge_record):
+    def calculate_prepay_usage_revenue(
+        self, component_charge_record, amt_already_invoiced=None
+    ):
         # the main consideration here is 1. how to handle proration and 2. how much has been invoiced already
         # 1. how to handle proration // how much is actually owed
         component = component_charge_record.component
@@ -3642,7 +3726,8 @@ class BillingRecord(models.Model):
         else:
             total_amt = component.tier_rating_function(component_charge_record.units)
         # 2. how much has been invoiced already
-        amt_already_invoiced = self.prepaid_already_invoiced()
+        if amt_already_invoiced is None:
+            amt_already_invoiced = self.prepaid_already_invoiced()
         # 3. how much is left to invoice
         amt_left_to_invoice = total_amt - amt_already_invoiced
         return amt_left_to_invoice
@@ -3688,6 +3773,83 @@ class ComponentChargeRecord(models.Model):
         super().save(*args, **kwargs)
 
 
+class BillingRun(models.Model):
+    """One pass of the periodic invoice run, with an entry per customer it set out to
+    invoice so a run that was cut short can be picked up where it stopped."""
+
+    class Status(models.IntegerChoices):
+        RUNNING = (1, _("running"))
+        COMPLETED = (2, _("completed"))
+        FAILED = (3, _("failed"))
+
+    billing_run_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    started_at = models.DateTimeField(default=now_utc)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.PositiveSmallIntegerField(
+        choices=Status.choices, default=Status.RUNNING
+    )
+
+    def __str__(self):
+        return f"{self.billing_run_id} - {self.started_at}"
+
+    def last_activity(self):
+        activity = self.customers.aggregate(
+            last_started=Max("started_at"), last_finished=Max("finished_at")
+        )
+        return max(
+            filter(
+                None,
+                [self.started_at, activity["last_started"], activity["last_finished"]],
+            )
+        )
+
+    def customers_per_minute(self):
+        done = self.customers.filter(status=BillingRunCustomer.Status.DONE)
+        end = self.finished_at or self.last_activity()
+        minutes = (end - self.started_at).total_seconds() / 60
+        if minutes <= 0:
+            return None
+        return done.count() / minutes
+
+
+class BillingRunCustomer(models.Model):
+    class Status(models.IntegerChoices):
+        PENDING = (1, _("pending"))
+        DONE = (2, _("done"))
+        FAILED = (3, _("failed"))
+        SKIPPED = (4, _("skipped"))
+        RUNNING = (5, _("running"))
+
+    billing_run = models.ForeignKey(
+        BillingRun, on_delete=models.CASCADE, related_name="customers"
+    )
+    customer = models.ForeignKey(
+        Customer, on_delete=models.CASCADE, related_name="billing_run_entries"
+    )
+    organization = models.ForeignKey(
+        Organization, on_delete=models.CASCADE, related_name="billing_run_entries"
+    )
+    status = models.PositiveSmallIntegerField(
+        choices=Status.choices, default=Status.PENDING
+    )
+    # the pass invoicing the customer, only it moves the entry out of running
+    claimed_by = models.UUIDField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(
+                fields=["billing_run", "customer"],
+                name="unique_billing_run_customer",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.billing_run} - {self.customer}"
+
+
 class Analysis(models.Model):
     organization = models.ForeignKey(
         Organization, on_delete=models.CASCADE, related_name="historical_analyses"
@@ -3927,20 +4089,21 @@ class UsageAlertResult(models.Model):
             ),
         ]
 
-    def refresh(self):
-        # calculate the value for the alert
+    def refresh(self, new_value=None):
+        # calculate the value for the alert, unless it was already calculated in bulk
         # update the last_run_value and last_run_timestamp
         # save the object
 
         metric = self.alert.metric
         subscription_record = self.subscription_record
         now = now_utc()
-        billing_record = subscription_record.billing_records.filter(
-            start_date__lte=now,
-            end_date__gt=now,
-            component__billable_metric=metric,
-        ).first()
-        new_value = metric.get_billing_record_total_billable_usage(billing_record)
+        if new_value is None:
+            billing_record = subscription_record.billing_records.filter(
+                start_date__lte=now,
+                end_date__gt=now,
+                component__billable_metric=metric,
+            ).first()
+            new_value = metric.get_billing_record_total_billable_usage(billing_record)
         if (
             new_value >= self.alert.threshold
             and self.last_run_value < self.alert.threshold
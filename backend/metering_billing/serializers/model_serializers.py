@@ -767,6 +767,9 @@ class MetricDetailSerializer(api_serializers.MetricSerializer):
         ) + (
             "usage_aggregation_type",
             "billable_aggregation_type",
+            "approximate_unique_error",
+            "per_second_aggregate",
+            "incremental_state",
         )
 
 
@@ -788,6 +791,9 @@ class MetricCreateSerializer(TimezoneFieldMixin, serializers.ModelSerializer):
             "custom_sql",
             "categorical_filters",
             "numeric_filters",
+            "approximate_unique_error",
+            "per_second_aggregate",
+            "incremental_state",
         )
         extra_kwargs = {
             "event_name": {"write_only": True, "required": False, "allow_blank": False},
@@ -812,6 +818,9 @@ class MetricCreateSerializer(TimezoneFieldMixin, serializers.ModelSerializer):
             },
             "categorical_filters": {"write_only": True, "required": False},
             "numeric_filters": {"write_only": True, "required": False},
+            "approximate_unique_error": {"write_only": True, "required": False},
+            "per_second_aggregate": {"write_only": True, "required": False},
+            "incremental_state": {"write_only": True, "required": False},
         }
 
     metric_name = serializers.CharField(source="billable_metric_name")
@@ -2072,23 +2081,39 @@ class DraftInvoiceSerializer(InvoiceDetailSerializer):
     line_items = serializers.SerializerMethodField()
 
     def get_line_items(self, obj) -> GroupedLineItemSerializer(many=True):
-        associated_subscription_records = (
-            obj.line_items.filter(associated_subscription_record__isnull=False)
-            .values_list("associated_subscription_record", flat=True)
-            .distinct()
-        )
+        try:
+            all_line_items = obj.draft_line_items
+        except AttributeError:
+            all_line_items = list(
+                obj.line_items.select_related(
+                    "associated_subscription_record"
+                ).prefetch_related("adjustments")
+            )
+        associated_subscription_records = []
+        for line_item in all_line_items:
+            sr = line_item.associated_subscription_record
+            if sr is not None and sr not in associated_subscription_records:
+                associated_subscription_records.append(sr)
         srs = []
         taxes = []
         discounts = []
-        for associated_subscription_record in associated_subscription_records:
-            line_items = obj.line_items.filter(
-                associated_subscription_record=associated_subscription_record
-            ).order_by("name", "start_date", "base")
-            sr = line_items[0].associated_subscription_record
+        for sr in associated_subscription_records:
+            line_items = sorted(
+                (
+                    line_item
+                    for line_item in all_line_items
+                    if line_item.associated_subscription_record == sr
+                ),
+                key=lambda line_item: (
+                    line_item.name,
+                    line_item.start_date,
+                    line_item.base,
+                ),
+            )
             grouped_line_item_dict = {
                 "plan_name": sr.billing_plan.plan.plan_name,
                 "subscription_filters": sr.subscription_filters,
-                "base": line_items.aggregate(Sum("amount"))["amount__sum"] or 0,
+                "base": sum(line_item.amount for line_item in line_items),
                 "start_date": sr.start_date,
                 "end_date": sr.end_date,
                 "sub_items": line_items,
@@ -2096,7 +2121,11 @@ class DraftInvoiceSerializer(InvoiceDetailSerializer):
             tax_owed = Decimal(0)
             plan_discounts = Decimal(0)
             for line_item in line_items:
-                for adjustment in line_item.adjustments.all():
+                try:
+                    adjustments = line_item.draft_adjustments
+                except AttributeError:
+                    adjustments = line_item.adjustments.all()
+                for adjustment in adjustments:
                     if (
                         adjustment.adjustment_type
                         == InvoiceLineItemAdjustment.AdjustmentType.SALES_TAX
@@ -1,10 +1,12 @@
 import logging
+import uuid
 from decimal import Decimal, InvalidOperation
 
 import pytz
 from celery import shared_task
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
+from django.db import connection
 from django.db.models import Q
 
 from metering_billing.payment_processors import PAYMENT_PROCESSOR_MAP
@@ -29,6 +31,13 @@ from metering_billing.webhooks import invoice_past_due_webhook
 
 logger = logging.getLogger("django.server")
 POSTHOG_PERSON = settings.POSTHOG_PERSON
+INVOICE_RUN_CONCURRENCY = settings.INVOICE_RUN_CONCURRENCY
+# first key of the advisory locks held on a customer while it is invoiced, the second
+# one is the customer's pk. Incremental gauge states use 1, idempotency ids use 3
+INVOICING_ADVISORY_LOCK = 2
+# a billing run that hasn't finished invoicing a customer in this long is resumed by
+# the next periodic run. Only the customers whose pass has died are handed out again
+BILLING_RUN_STALE_MINUTES = 15
 
 
 @shared_task
@@ -82,25 +91,129 @@ def generate_invoice_pdf_async(invoice_pk):
 
 @shared_task
 def calculate_invoice():
-    calculate_invoice_inner()
-
-
-def calculate_invoice_inner():
+    from metering_billing.models import BillingRun
+
+    # runs that stopped making progress are resumed, the ones still going keep their
+    # customers and a new run is started for everyone else that is due
+    for billing_run in BillingRun.objects.filter(status=BillingRun.Status.RUNNING):
+        if billing_run.last_activity() < now_utc() - relativedelta(
+            minutes=BILLING_RUN_STALE_MINUTES
+        ):
+            logger.info(
+                "Billing run {} stopped making progress, resuming it".format(
+                    billing_run.billing_run_id
+                )
+            )
+            resume_billing_run_inner(billing_run, shards=INVOICE_RUN_CONCURRENCY)
+    calculate_invoice_inner(shards=INVOICE_RUN_CONCURRENCY)
+
+
+def calculate_invoice_inner(shards=1):
+    """Invoice every customer with a subscription that ended or a billing record that
+    is due, other than the ones a billing run that is still going has yet to get to or
+    is invoicing right now. The customers are recorded as pending entries of a new billing run, which
+    are updated as each one is invoiced. With more than one shard the customers are
+    split round robin into that many subtasks, which caps how many are invoiced at once,
+    and a callback completes the run once all of them have finished. Otherwise they're
+    invoiced here and the summary is returned."""
     # GENERAL PHILOSOPHY: this task is for periodic maintenance of ending susbcriptions. We only end and re-start subscriptions when they're scheduled to end, if for some other reason they end early then it is up to the other process to handle the invoice creationg and .
-    # get ending subs
-
-    from metering_billing.invoice import generate_invoice
-    from metering_billing.models import BillingRecord, Invoice, SubscriptionRecord
+    from metering_billing.models import BillingRun, BillingRunCustomer
 
     now_minus_30 = now_utc() - relativedelta(
         minutes=30
     )  # grace period of 30 minutes for sending events
+    claimed_customers = BillingRunCustomer.objects.filter(
+        billing_run__status=BillingRun.Status.RUNNING,
+        status__in=[
+            BillingRunCustomer.Status.PENDING,
+            BillingRunCustomer.Status.RUNNING,
+        ],
+    ).values("customer")
+    cust_info = list(
+        subscription_records_to_invoice(now_minus_30)
+        .exclude(customer__in=claimed_customers)
+        .values_list("customer", "organization")
+        .distinct()
+    )
+    billing_run = BillingRun.objects.create()
+    BillingRunCustomer.objects.bulk_create(
+        [
+            BillingRunCustomer(
+                billing_run=billing_run,
+                customer_id=customer_id,
+                organization_id=organization_id,
+            )
+            for customer_id, organization_id in cust_info
+        ]
+    )
+    return run_billing_run(billing_run, cust_info, shards)
+
+
+def resume_billing_run_inner(billing_run, retry_failed=False, shards=1):
+    """Invoice the customers of a billing run that are still pending, and with
+    `retry_failed` the ones that failed too. Customers already invoiced by the run are
+    left alone, and so are the ones a pass of the run is invoicing right now. A claim is
+    only handed out again once it is old and nobody holds its customer's invoicing lock.
+    A pass holds that lock the whole time it invoices the customer, and loses it along
+    with its connection if it dies.
+
+    The original pass may still be waiting in the queue, so the same customers can be
+    handed to two passes. Each entry is claimed before its customer is invoiced, so only
+    one of them does it."""
+    from metering_billing.models import BillingRun, BillingRunCustomer
+
+    billing_run.customers.filter(
+        status=BillingRunCustomer.Status.RUNNING,
+        started_at__lt=now_utc() - relativedelta(minutes=BILLING_RUN_STALE_MINUTES),
+    ).exclude(customer__in=customers_being_invoiced()).update(
+        status=BillingRunCustomer.Status.PENDING, claimed_by=None
+    )
+    if retry_failed:
+        billing_run.customers.filter(status=BillingRunCustomer.Status.FAILED).update(
+            status=BillingRunCustomer.Status.PENDING, claimed_by=None
+        )
+    cust_info = list(
+        billing_run.customers.filter(
+            status=BillingRunCustomer.Status.PENDING
+        ).values_list("customer", "organization")
+    )
+    billing_run.status = BillingRun.Status.RUNNING
+    billing_run.finished_at = None
+    billing_run.save(update_fields=["status", "finished_at"])
+    return run_billing_run(billing_run, cust_info, shards)
+
+
+def run_billing_run(billing_run, cust_info, shards):
+    from celery import chord
+
+    if shards > 1 and len(cust_info) > 1:
+        chord(
+            invoice_customers.s(cust_info[i::shards], billing_run_pk=billing_run.pk)
+            for i in range(min(shards, len(cust_info)))
+        )(
+            summarize_invoice_run.s(billing_run_pk=billing_run.pk).on_error(
+                fail_billing_run.s(billing_run_pk=billing_run.pk)
+            )
+        )
+        return None
+    summary = invoice_customers_inner(cust_info, billing_run_pk=billing_run.pk)
+    return summarize_invoice_run_inner([summary], billing_run_pk=billing_run.pk)
+
+
+def subscription_records_to_invoice(now_minus_30, customer_id=None):
+    from metering_billing.models import BillingRecord, SubscriptionRecord
+
     sub_records_to_bill = SubscriptionRecord.objects.filter(
         Q(end_date__lt=now_minus_30)
     )
     billing_records_to_bill = BillingRecord.objects.filter(
         Q(next_invoicing_date__lt=now_minus_30) & Q(fully_billed=False),
     )
+    if customer_id is not None:
+        sub_records_to_bill = sub_records_to_bill.filter(customer_id=customer_id)
+        billing_records_to_bill = billing_records_to_bill.filter(
+            customer_id=customer_id
+        )
     # Get a list of distinct subscription IDs from the billing records
     subscription_id_from_br = billing_records_to_bill.values_list(
         "subscription", flat=True
@@ -109,7 +222,7 @@ def calculate_invoice_inner():
         "id", flat=True
     ).distinct()
     # Get the subscription records for the subscriptions
-    all_sub_records = SubscriptionRecord.objects.filter(
+    return SubscriptionRecord.objects.filter(
         Q(id__in=subscription_id_from_br) | Q(id__in=subscription_id_from_sr)
     ).prefetch_related(
         "customer",
@@ -122,25 +235,53 @@ def calculate_invoice_inner():
         "billing_records",
     )
 
-    # now generate invoices and new subs
-    cust_info = all_sub_records.values_list("customer", "organization").distinct()
-    for customer_id, organization_id in cust_info:
-        customer_subscription_records = all_sub_records.filter(customer_id=customer_id)
+
+def customers_being_invoiced():
+    """The pks of the customers some connection holds the invoicing lock on."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT objid
+            FROM pg_locks
+            WHERE locktype = 'advisory'
+                AND classid = %s
+                AND objsubid = 2
+                AND granted
+            """,
+            [INVOICING_ADVISORY_LOCK],
+        )
+        return [int(customer_id) for (customer_id,) in cursor.fetchall()]
+
+
+def invoice_customer(customer_id, organization_id):
+    """Invoice what is due for one customer. Holds an advisory lock on the customer
+    while it does, and looks up what is due again once it has it, so runs that overlap
+    never bill the same subscriptions twice. Returns False if another run has the
+    customer locked."""
+    from metering_billing.invoice import generate_invoice
+    from metering_billing.models import Invoice
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_try_advisory_lock(%s, %s)",
+            [INVOICING_ADVISORY_LOCK, customer_id],
+        )
+        if not cursor.fetchone()[0]:
+            return False
+    try:
+        now_minus_30 = now_utc() - relativedelta(minutes=30)
+        customer_subscription_records = subscription_records_to_invoice(
+            now_minus_30, customer_id=customer_id
+        )
+        if not customer_subscription_records.exists():
+            return True
         # Generate the invoice
-        try:
-            generate_invoice(
-                customer_subscription_records,
-                charge_next_plan=True,
-                generate_next_subscription_record=True,
-            )
-            now = now_utc()
-        except Exception as e:
-            logger.error(
-                "Error generating invoice for subscription records {}. Error was {}".format(
-                    [str(x) for x in customer_subscription_records], e
-                )
-            )
-            continue
+        generate_invoice(
+            customer_subscription_records,
+            charge_next_plan=True,
+            generate_next_subscription_record=True,
+        )
+        now = now_utc()
         # delete draft invoices
         Invoice.objects.filter(
             issue_date__lt=now,
@@ -148,19 +289,191 @@ def calculate_invoice_inner():
             customer_id=customer_id,
             organization_id=organization_id,
         ).delete()
+        return True
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_unlock(%s, %s)",
+                [INVOICING_ADVISORY_LOCK, customer_id],
+            )
+
+
+def invoice_customers_inner(cust_info, billing_run_pk=None):
+    from metering_billing.models import BillingRunCustomer
+
+    summary = {"invoiced": 0, "skipped": 0, "failed": []}
+    claim = uuid.uuid4()
+    for customer_id, organization_id in cust_info:
+        run_entry = BillingRunCustomer.objects.filter(
+            billing_run_id=billing_run_pk, customer_id=customer_id
+        )
+        if billing_run_pk is not None:
+            # another pass over the same run may have the customer already, whoever
+            # moves the entry out of pending invoices it
+            claimed = run_entry.filter(status=BillingRunCustomer.Status.PENDING).update(
+                status=BillingRunCustomer.Status.RUNNING,
+                claimed_by=claim,
+                started_at=now_utc(),
+                finished_at=None,
+                error=None,
+            )
+            if not claimed:
+                continue
+        try:
+            if invoice_customer(customer_id, organization_id):
+                summary["invoiced"] += 1
+                status = BillingRunCustomer.Status.DONE
+            else:
+                summary["skipped"] += 1
+                status = BillingRunCustomer.Status.SKIPPED
+            error = None
+        except Exception as e:
+            logger.error(
+                "Error generating invoice for customer {}. Error was {}".format(
+                    customer_id, e
+                )
+            )
+            error = f"{type(e).__name__}: {e}"
+            summary["failed"].append(
+                {
+                    "customer_id": customer_id,
+                    "organization_id": organization_id,
+                    "error": error,
+                }
+            )
+            status = BillingRunCustomer.Status.FAILED
+        if billing_run_pk is not None:
+            # if the claim was handed to another pass in the meantime, the entry is that
+            # pass's to finish
+            run_entry.filter(
+                status=BillingRunCustomer.Status.RUNNING, claimed_by=claim
+            ).update(status=status, finished_at=now_utc(), error=error)
+    return summary
+
+
+@shared_task
+def invoice_customers(cust_info, billing_run_pk=None):
+    return invoice_customers_inner(cust_info, billing_run_pk=billing_run_pk)
+
+
+def summarize_invoice_run_inner(shard_summaries, billing_run_pk=None):
+    from metering_billing.models import BillingRun, BillingRunCustomer
+
+    summary = {"invoiced": 0, "skipped": 0, "failed": []}
+    for shard_summary in shard_summaries:
+        summary["invoiced"] += shard_summary["invoiced"]
+        summary["skipped"] += shard_summary["skipped"]
+        summary["failed"] += shard_summary["failed"]
+    logger.info(
+        "Invoice run finished: {} customers invoiced, {} skipped because another run had them, {} failed".format(
+            summary["invoiced"], summary["skipped"], len(summary["failed"])
+        )
+    )
+    if summary["failed"]:
+        logger.error(
+            "Invoice run failed for customers {}".format(
+                [failure["customer_id"] for failure in summary["failed"]]
+            )
+        )
+    if billing_run_pk is not None:
+        billing_run = BillingRun.objects.get(pk=billing_run_pk)
+        if billing_run.customers.filter(
+            status__in=[
+                BillingRunCustomer.Status.PENDING,
+                BillingRunCustomer.Status.RUNNING,
+            ]
+        ).exists():
+            # another pass over the run is still going and completes it when it's done
+            return summary
+        billing_run.status = BillingRun.Status.COMPLETED
+        billing_run.finished_at = now_utc()
+        billing_run.save(update_fields=["status", "finished_at"])
+        customers_per_minute = billing_run.customers_per_minute()
+        if customers_per_minute is not None:
+            logger.info(
+                "Billing run {} invoiced {:.1f} customers per minute".format(
+                    billing_run.billing_run_id, customers_per_minute
+                )
+            )
+    return summary
+
+
+@shared_task
+def summarize_invoice_run(shard_summaries, billing_run_pk=None):
+    return summarize_invoice_run_inner(shard_summaries, billing_run_pk=billing_run_pk)
+
+
+def fail_billing_run_inner(billing_run_pk, error):
+    """Mark a billing run whose subtasks didn't all finish as failed. Its customers stop
+    counting as claimed, so the next periodic run invoices the ones still due, and the
+    run itself can still be picked up with the resume_billing_run command."""
+    from metering_billing.models import BillingRun
+
+    BillingRun.objects.filter(
+        pk=billing_run_pk, status=BillingRun.Status.RUNNING
+    ).update(status=BillingRun.Status.FAILED, finished_at=now_utc())
+    logger.error("Billing run {} failed: {}".format(billing_run_pk, error))
+
+
+@shared_task
+def fail_billing_run(request, exc, traceback, billing_run_pk=None):
+    fail_billing_run_inner(billing_run_pk, exc)
 
 
 def refresh_alerts_inner():
-    from metering_billing.models import UsageAlertResult
+    from metering_billing.models import BillingRecord, UsageAlertResult
 
     # get all UsageAlertResults
     now = now_utc()
     UsageAlertResult.objects.filter(subscription_record__end_date__lt=now).delete()
-    alert_results = UsageAlertResult.objects.filter(
-        subscription_record__end_date__gte=now
-    ).prefetch_related("alert", "subscription_record", "alert__metric")
+    alert_results = list(
+        UsageAlertResult.objects.filter(
+            subscription_record__end_date__gte=now
+        ).select_related(
+            "alert", "alert__metric", "subscription_record", "organization"
+        )
+    )
+    # compute the usage of every alerted billing record with one batch per metric
+    # instead of one query per alert
+    metrics = {
+        alert_result.alert.metric.pk: alert_result.alert.metric
+        for alert_result in alert_results
+    }
+    billing_records = (
+        BillingRecord.objects.filter(
+            subscription__in={
+                alert_result.subscription_record_id for alert_result in alert_results
+            },
+            component__billable_metric__in=metrics.keys(),
+            start_date__lte=now,
+            end_date__gt=now,
+        )
+        .select_related("subscription", "customer", "component")
+        .order_by("pk")
+    )
+    billing_records_by_metric = {}
+    current_billing_record = {}
+    for billing_record in billing_records:
+        metric_pk = billing_record.component.billable_metric_id
+        key = (billing_record.subscription_id, metric_pk)
+        if key in current_billing_record:
+            continue
+        current_billing_record[key] = billing_record
+        billing_records_by_metric.setdefault(metric_pk, []).append(billing_record)
+    usage = {}
+    for metric_pk, metric_billing_records in billing_records_by_metric.items():
+        usage.update(
+            metrics[metric_pk].get_billing_records_total_billable_usage(
+                metric_billing_records
+            )
+        )
     for alert_result in alert_results:
-        alert_result.refresh()
+        billing_record = current_billing_record.get(
+            (alert_result.subscription_record_id, alert_result.alert.metric.pk)
+        )
+        if billing_record is None:
+            continue
+        alert_result.refresh(new_value=usage[billing_record])
 
 
 @shared_task
@@ -168,12 +481,82 @@ def refresh_alerts():
     refresh_alerts_inner()
 
 
-def prune_guard_table_inner():
-    from metering_billing.models import IdempotenceCheck
+def reconcile_usage_counters_inner():
+    from metering_billing.kafka.usage_counters import (
+        REALTIME_USAGE_COUNTERS,
+        correct_usage_counters,
+        counts_in_real_time,
+        tracked_billing_record_pks,
+        untrack_billing_records,
+    )
+    from metering_billing.models import BillingRecord
 
-    # get all UsageAlertResults
+    if not REALTIME_USAGE_COUNTERS:
+        return
+    now = now_utc()
+    tracked_pks = set(tracked_billing_record_pks())
+    billing_records = BillingRecord.objects.filter(
+        pk__in=tracked_pks,
+        start_date__lte=now,
+        end_date__gte=now,
+        component__isnull=False,
+    ).select_related(
+        "component__billable_metric", "subscription", "customer", "organization"
+    )
+    billing_records_by_metric = {}
+    metrics = {}
+    for billing_record in billing_records:
+        metric = billing_record.component.billable_metric
+        if not counts_in_real_time(metric):
+            continue
+        metrics[metric.pk] = metric
+        billing_records_by_metric.setdefault(metric.pk, []).append(billing_record)
+        tracked_pks.discard(billing_record.pk)
+    # whatever is left has ended, was deleted or its metric isn't counted anymore
+    untrack_billing_records(list(tracked_pks))
+    for metric_pk, metric_billing_records in billing_records_by_metric.items():
+        correct_usage_counters(metrics[metric_pk], metric_billing_records)
+
+
+@shared_task
+def reconcile_usage_counters():
+    reconcile_usage_counters_inner()
+
+
+def advance_gauge_state_checkpoints_inner():
+    from metering_billing.aggregation.billable_metrics import GaugeHandler
+    from metering_billing.models import Metric
+    from metering_billing.utils.enums import METRIC_STATUS, METRIC_TYPE
+
+    metrics = Metric.objects.filter(
+        metric_type=METRIC_TYPE.GAUGE,
+        status=METRIC_STATUS.ACTIVE,
+        incremental_state=True,
+        mat_views_provisioned=True,
+    ).select_related("organization")
+    for metric in metrics:
+        try:
+            GaugeHandler.advance_state_checkpoint(metric)
+        except Exception as e:
+            logger.error(
+                f"Could not advance gauge state of metric {metric.metric_id}. Exception message: {e}"
+            )
+
+
+@shared_task
+def advance_gauge_state_checkpoints():
+    advance_gauge_state_checkpoints_inner()
+
+
+def prune_guard_table_inner():
+    # the guard table is a hypertable, so expired rows are removed a whole chunk at a
+    # time instead of with a row-by-row delete
     thirty_three_days = now_utc() - relativedelta(days=33)
-    IdempotenceCheck.objects.filter(time_created__lt=thirty_three_days).delete()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT drop_chunks('metering_billing_idempotencecheck', older_than => %s)",
+            [thirty_three_days],
+        )
 
 
 @shared_task
@@ -181,6 +564,17 @@ def prune_guard_table():
     prune_guard_table_inner()
 
 
+@shared_task
+def sync_metric_property_indexes(metric_pk, exclude_metric=False):
+    from metering_billing.aggregation.billable_metrics import MetricHandler
+    from metering_billing.models import Metric
+
+    metric = Metric.objects.filter(pk=metric_pk).first()
+    if metric is None:
+        return
+    MetricHandler.sync_property_indexes(metric, exclude_metric=exclude_metric)
+
+
 @shared_task
 def zero_out_expired_balance_adjustments():
     from metering_billing.models import CustomerBalanceAdjustment
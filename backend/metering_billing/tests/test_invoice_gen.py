@@ -1,16 +1,24 @@
 import itertools
 import json
 import unittest.mock as mock
+import uuid
 from datetime import timedelta
 from decimal import Decimal
 
 import pytest
 from dateutil.relativedelta import relativedelta
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from metering_billing.invoice import BillingContext, generate_invoice
 from metering_billing.models import (
     BillingRecord,
+    BillingRun,
+    BillingRunCustomer,
     Event,
     Invoice,
+    InvoiceLineItem,
+    InvoiceLineItemAdjustment,
     Metric,
     PlanComponent,
     PriceAdjustment,
@@ -18,9 +26,17 @@ from metering_billing.models import (
     SubscriptionRecord,
 )
 from metering_billing.serializers.serializer_utils import DjangoJSONEncoder
-from metering_billing.tasks import calculate_invoice_inner
+from metering_billing.tasks import (
+    INVOICING_ADVISORY_LOCK,
+    calculate_invoice,
+    calculate_invoice_inner,
+    fail_billing_run_inner,
+    invoice_customers_inner,
+    resume_billing_run_inner,
+    summarize_invoice_run_inner,
+)
 from metering_billing.utils import now_utc
-from metering_billing.utils.enums import PRICE_ADJUSTMENT_TYPE
+from metering_billing.utils.enums import CHARGEABLE_ITEM_TYPE, PRICE_ADJUSTMENT_TYPE
 from model_bakery import baker
 from rest_framework import status
 from rest_framework.test import APIClient
@@ -158,6 +174,32 @@ class TestGenerateInvoice:
 
         assert new_invoices_len == prev_invoices_len  # don't generate from drafts
 
+    def test_draft_invoice_is_not_saved(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        setup_dict["org"].tax_rate = Decimal("10")
+        setup_dict["org"].save()
+
+        invoices_before = Invoice.objects.count()
+        history_before = Invoice.history.count()
+        line_items_before = InvoiceLineItem.objects.count()
+        adjustments_before = InvoiceLineItemAdjustment.objects.count()
+        response = setup_dict["client"].get(
+            reverse(
+                "customer-draft_invoice",
+                kwargs={"customer_id": setup_dict["customer"].customer_id},
+            )
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert len(response.data["invoices"]) == 1
+        draft_amount = response.data["invoices"][0]["amount"]
+        assert draft_amount > 0
+        drafts_revenue = setup_dict["customer"].get_active_sub_drafts_revenue()
+        assert abs(drafts_revenue - draft_amount) < Decimal("0.01")
+        assert Invoice.objects.count() == invoices_before
+        assert Invoice.history.count() == history_before
+        assert InvoiceLineItem.objects.count() == line_items_before
+        assert InvoiceLineItemAdjustment.objects.count() == adjustments_before
+
     def test_generate_invoice_with_price_adjustments(self, invoice_test_common_setup):
         # deleting inv objects because it marks it as already paid and we get 0s everywhere
 
@@ -318,6 +360,145 @@ class TestGenerateInvoice:
         assert result_invoice.invoice_pdf != ""
 
 
+@pytest.mark.django_db(transaction=True)
+class TestBillingContext:
+    def test_context_matches_billing_records(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        subscription_record = setup_dict["subscription_record"]
+        generate_invoice(subscription_record)
+
+        with CaptureQueriesContext(connection) as context_queries:
+            context = BillingContext([subscription_record])
+        billing_records = context.billing_records(subscription_record)
+        assert len(billing_records) == subscription_record.billing_records.count()
+        # one query for each kind of record, however many components the plan has
+        assert len(context_queries) <= 6
+        for billing_record in billing_records:
+            assert (
+                context.amt_already_invoiced(billing_record)
+                == billing_record.amt_already_invoiced()
+            )
+            if billing_record.component is None:
+                continue
+            assert (
+                context.qty_already_invoiced(billing_record)
+                == billing_record.qty_already_invoiced()
+            )
+            with CaptureQueriesContext(connection) as rating_queries:
+                billing_record.component.tier_rating_function(Decimal(100))
+            assert len(rating_queries) == 0
+
+    def test_usage_is_loaded_in_one_batch_per_metric(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        subscription_record = setup_dict["subscription_record"]
+        context = BillingContext([subscription_record])
+        usage_records = [
+            br
+            for br in context.billing_records(subscription_record)
+            if br.component is not None
+        ]
+        expected = {
+            br.pk: br.component.billable_metric.get_billing_record_total_billable_usage(
+                br
+            )
+            for br in usage_records
+        }
+        with mock.patch.object(
+            Metric,
+            "get_billing_records_total_billable_usage",
+            autospec=True,
+            side_effect=Metric.get_billing_records_total_billable_usage,
+        ) as batch_usage:
+            context.load_usage(draft=True, issue_date=now_utc())
+        assert batch_usage.call_count == len(
+            {br.component.billable_metric_id for br in usage_records}
+        )
+        with mock.patch.object(
+            Metric,
+            "get_billing_record_total_billable_usage",
+            side_effect=AssertionError("usage read one billing record at a time"),
+        ):
+            for billing_record in usage_records:
+                usage_and_revenue = context.usage_and_revenue(billing_record)
+                assert usage_and_revenue["usage_qty"] == expected[billing_record.pk]
+
+    def test_recorded_line_items_count_as_invoiced(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        subscription_record = setup_dict["subscription_record"]
+        context = BillingContext([subscription_record])
+        billing_record = next(
+            br
+            for br in context.billing_records(subscription_record)
+            if br.component is not None
+        )
+        amt_before = context.amt_already_invoiced(billing_record)
+        qty_before = context.qty_already_invoiced(billing_record)
+        context.record_line_item(
+            InvoiceLineItem(
+                name="usage",
+                base=Decimal(10),
+                quantity=Decimal(3),
+                chargeable_item_type=CHARGEABLE_ITEM_TYPE.USAGE_CHARGE,
+                associated_billing_record=billing_record,
+            )
+        )
+        assert context.amt_already_invoiced(billing_record) == amt_before + 10
+        assert context.qty_already_invoiced(billing_record) == qty_before + 3
+
+    def test_invoice_writes_line_items_in_bulk(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        subscription_record = setup_dict["subscription_record"]
+        issue_date = subscription_record.end_date + relativedelta(minutes=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            (invoice,) = generate_invoice(subscription_record, issue_date=issue_date)
+        line_item_inserts = [
+            query
+            for query in queries
+            if query["sql"].startswith('INSERT INTO "metering_billing_invoicelineitem"')
+        ]
+        billing_record_updates = [
+            query
+            for query in queries
+            if query["sql"].startswith('UPDATE "metering_billing_billingrecord"')
+        ]
+        assert invoice.line_items.count() > 1
+        assert len(line_item_inserts) == 1
+        assert len(billing_record_updates) == 1
+        assert all(
+            billing_record.fully_billed
+            for billing_record in subscription_record.billing_records.filter(
+                component__isnull=False
+            )
+        )
+
+    def test_invoice_writes_adjustments_in_bulk(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        setup_dict["org"].tax_rate = Decimal("10")
+        setup_dict["org"].save()
+        subscription_record = setup_dict["subscription_record"]
+        issue_date = subscription_record.end_date + relativedelta(minutes=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            (invoice,) = generate_invoice(subscription_record, issue_date=issue_date)
+        adjustment_inserts = [
+            query
+            for query in queries
+            if query["sql"].startswith(
+                'INSERT INTO "metering_billing_invoicelineitemadjustment"'
+            )
+        ]
+        line_items = list(invoice.line_items.prefetch_related("adjustments"))
+        assert len(adjustment_inserts) == 1
+        assert len(line_items) > 1
+        for line_item in line_items:
+            assert line_item.adjustments.count() == 1
+            adjusted = line_item.base + sum(
+                adjustment.amount for adjustment in line_item.adjustments.all()
+            )
+            assert abs(line_item.amount - adjusted) < Decimal("0.00001")
+
+
 @pytest.mark.django_db(transaction=True)
 class TestInvoiceTask:
     def test_call_invoice_on_subscription_end(self, invoice_test_common_setup):
@@ -336,9 +517,240 @@ class TestInvoiceTask:
                 return_value=mock_date,
             ),
         ):
-            calculate_invoice_inner()
+            summary = calculate_invoice_inner()
         invoices_after = len(Invoice.objects.all())
         assert invoices_after == invoices_before + 1
+        assert summary == {"invoiced": 1, "skipped": 0, "failed": []}
+
+    def test_customer_locked_by_another_run_is_skipped(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        mock_date = setup_dict["subscription_record"].end_date + relativedelta(
+            minutes=30, seconds=1
+        )
+        invoices_before = len(Invoice.objects.all())
+        other_run = connection.copy()
+        try:
+            with other_run.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_lock(%s, %s)",
+                    [INVOICING_ADVISORY_LOCK, setup_dict["customer"].pk],
+                )
+            with (
+                mock.patch(
+                    "metering_billing.tasks.now_utc",
+                    return_value=mock_date,
+                ),
+                mock.patch(
+                    "metering_billing.invoice.now_utc",
+                    return_value=mock_date,
+                ),
+            ):
+                summary = calculate_invoice_inner()
+        finally:
+            other_run.close()
+        assert summary == {"invoiced": 0, "skipped": 1, "failed": []}
+        assert len(Invoice.objects.all()) == invoices_before
+
+    def test_billing_run_records_each_customer(self, invoice_test_common_setup):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        mock_date = setup_dict["subscription_record"].end_date + relativedelta(
+            minutes=30, seconds=1
+        )
+        with (
+            mock.patch(
+                "metering_billing.tasks.now_utc",
+                return_value=mock_date,
+            ),
+            mock.patch(
+                "metering_billing.invoice.now_utc",
+                return_value=mock_date,
+            ),
+        ):
+            calculate_invoice_inner()
+        billing_run = BillingRun.objects.get()
+        assert billing_run.status == BillingRun.Status.COMPLETED
+        assert billing_run.finished_at == mock_date
+        run_entry = billing_run.customers.get()
+        assert run_entry.customer == setup_dict["customer"]
+        assert run_entry.status == BillingRunCustomer.Status.DONE
+        assert run_entry.finished_at == mock_date
+        assert run_entry.error is None
+
+    def test_resume_billing_run_retries_failed_customers(
+        self, invoice_test_common_setup
+    ):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        mock_date = setup_dict["subscription_record"].end_date + relativedelta(
+            minutes=30, seconds=1
+        )
+        invoices_before = len(Invoice.objects.all())
+        with (
+            mock.patch(
+                "metering_billing.tasks.now_utc",
+                return_value=mock_date,
+            ),
+            mock.patch(
+                "metering_billing.invoice.now_utc",
+                return_value=mock_date,
+            ),
+        ):
+            with mock.patch(
+                "metering_billing.invoice.generate_invoice",
+                side_effect=ValueError("payment processor unavailable"),
+            ):
+                summary = calculate_invoice_inner()
+            assert len(summary["failed"]) == 1
+            billing_run = BillingRun.objects.get()
+            run_entry = billing_run.customers.get()
+            assert run_entry.status == BillingRunCustomer.Status.FAILED
+            assert run_entry.error == "ValueError: payment processor unavailable"
+            assert len(Invoice.objects.all()) == invoices_before
+
+            # without retry_failed there is nothing left to do
+            summary = resume_billing_run_inner(billing_run)
+            assert summary == {"invoiced": 0, "skipped": 0, "failed": []}
+            run_entry.refresh_from_db()
+            assert run_entry.status == BillingRunCustomer.Status.FAILED
+
+            summary = resume_billing_run_inner(billing_run, retry_failed=True)
+        assert summary == {"invoiced": 1, "skipped": 0, "failed": []}
+        run_entry.refresh_from_db()
+        assert run_entry.status == BillingRunCustomer.Status.DONE
+        assert run_entry.error is None
+        assert len(Invoice.objects.all()) == invoices_before + 1
+
+    def test_second_pass_leaves_claimed_customers_alone(
+        self, invoice_test_common_setup
+    ):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        customer = setup_dict["customer"]
+        billing_run = BillingRun.objects.create()
+        run_entry = BillingRunCustomer.objects.create(
+            billing_run=billing_run,
+            customer=customer,
+            organization=setup_dict["org"],
+            status=BillingRunCustomer.Status.RUNNING,
+            started_at=now_utc(),
+        )
+
+        # a resumed pass got the same customer while the first one is invoicing it
+        with mock.patch("metering_billing.tasks.invoice_customer") as invoice_customer:
+            summary = invoice_customers_inner(
+                [(customer.pk, setup_dict["org"].pk)], billing_run_pk=billing_run.pk
+            )
+            summarize_invoice_run_inner([summary], billing_run_pk=billing_run.pk)
+        invoice_customer.assert_not_called()
+        assert summary == {"invoiced": 0, "skipped": 0, "failed": []}
+        run_entry.refresh_from_db()
+        assert run_entry.status == BillingRunCustomer.Status.RUNNING
+        billing_run.refresh_from_db()
+        assert billing_run.status == BillingRun.Status.RUNNING
+
+        # resuming only hands out claims that went stale
+        with mock.patch("metering_billing.tasks.run_billing_run") as run_billing_run:
+            resume_billing_run_inner(billing_run)
+            assert run_billing_run.call_args[0][1] == []
+            run_entry.started_at = now_utc() - relativedelta(hours=1)
+            run_entry.save()
+            resume_billing_run_inner(billing_run)
+            assert run_billing_run.call_args[0][1] == [
+                (customer.pk, setup_dict["org"].pk)
+            ]
+
+    def test_claims_of_passes_still_invoicing_are_not_handed_out(
+        self, invoice_test_common_setup
+    ):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        customer = setup_dict["customer"]
+        billing_run = BillingRun.objects.create()
+        run_entry = BillingRunCustomer.objects.create(
+            billing_run=billing_run,
+            customer=customer,
+            organization=setup_dict["org"],
+            status=BillingRunCustomer.Status.RUNNING,
+            claimed_by=uuid.uuid4(),
+            started_at=now_utc() - relativedelta(hours=1),
+        )
+
+        # the pass is slow but alive, it still holds the customer's lock
+        slow_pass = connection.copy()
+        try:
+            with slow_pass.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_lock(%s, %s)",
+                    [INVOICING_ADVISORY_LOCK, customer.pk],
+                )
+            with mock.patch(
+                "metering_billing.tasks.run_billing_run"
+            ) as run_billing_run:
+                resume_billing_run_inner(billing_run)
+            assert run_billing_run.call_args[0][1] == []
+            run_entry.refresh_from_db()
+            assert run_entry.status == BillingRunCustomer.Status.RUNNING
+        finally:
+            slow_pass.close()
+
+        # once its connection is gone the claim is handed out again
+        with mock.patch("metering_billing.tasks.run_billing_run") as run_billing_run:
+            resume_billing_run_inner(billing_run)
+        assert run_billing_run.call_args[0][1] == [(customer.pk, setup_dict["org"].pk)]
+        run_entry.refresh_from_db()
+        assert run_entry.status == BillingRunCustomer.Status.PENDING
+        assert run_entry.claimed_by is None
+
+        # a pass whose claim was handed out again while it invoiced leaves the entry
+        # to the pass that has it now
+        other_claim = uuid.uuid4()
+
+        def lose_claim(customer_id, organization_id):
+            BillingRunCustomer.objects.filter(pk=run_entry.pk).update(
+                claimed_by=other_claim
+            )
+            return True
+
+        with mock.patch(
+            "metering_billing.tasks.invoice_customer", side_effect=lose_claim
+        ):
+            invoice_customers_inner(
+                [(customer.pk, setup_dict["org"].pk)], billing_run_pk=billing_run.pk
+            )
+        run_entry.refresh_from_db()
+        assert run_entry.status == BillingRunCustomer.Status.RUNNING
+        assert run_entry.claimed_by == other_claim
+
+    def test_new_run_skips_customers_claimed_by_a_run_in_progress(
+        self, invoice_test_common_setup
+    ):
+        setup_dict = invoice_test_common_setup(auth_method="api_key")
+        customer = setup_dict["customer"]
+        mock_date = setup_dict["subscription_record"].end_date + relativedelta(
+            minutes=30, seconds=1
+        )
+        billing_run = BillingRun.objects.create(started_at=mock_date)
+        BillingRunCustomer.objects.create(
+            billing_run=billing_run,
+            customer=customer,
+            organization=setup_dict["org"],
+        )
+
+        with (
+            mock.patch("metering_billing.tasks.now_utc", return_value=mock_date),
+            mock.patch("metering_billing.tasks.run_billing_run") as run_billing_run,
+        ):
+            # the run in progress keeps its customer, the new one gets everyone else
+            calculate_invoice()
+            assert run_billing_run.call_count == 1
+            assert run_billing_run.call_args[0][1] == []
+
+            # once the run failed its customers are up for grabs again
+            fail_billing_run_inner(billing_run.pk, ValueError("worker lost"))
+            billing_run.refresh_from_db()
+            assert billing_run.status == BillingRun.Status.FAILED
+            assert billing_run.finished_at == mock_date
+            calculate_invoice()
+            assert run_billing_run.call_args[0][1] == [
+                (customer.pk, setup_dict["org"].pk)
+            ]
 
     def test_call_invoice_on_intermediate_billing_record(
         self, invoice_test_common_setup
@@ -0,0 +1,419 @@
+import datetime
+import unittest.mock as mock
+from collections import namedtuple
+from decimal import Decimal
+
+import pytest
+from metering_billing.kafka.consumer import Consumer
+
+Message = namedtuple("Message", ["key", "value"])
+
+
+def _raise_for(buffer, failing_ids):
+    """Stands in for write_batch_events_to_db: fails the batch if it contains one of
+    `failing_ids` and otherwise reports every event as inserted."""
+    if any(
+        event["idempotency_id"] in failing_ids
+        for events in buffer.values()
+        for event in events
+    ):
+        raise Exception("bad event")
+    return buffer
+
+
+def make_message(organization_pk, idempotency_id):
+    return Message(
+        key="customer",
+        value={
+            "organization_id": organization_pk,
+            "event": {
+                "organization_id": organization_pk,
+                "cust_id": "customer",
+                "customer_id": "customer",
+                "event_name": "test_event",
+                "idempotency_id": idempotency_id,
+                "time_created": "2023-01-01T00:00:00+00:00",
+                "properties": {},
+            },
+        },
+    )
+
+
+@pytest.fixture
+def consumer():
+    consumer = Consumer()
+    consumer._Consumer__connection = mock.MagicMock()
+    consumer.config.batch_size = 3
+    consumer.config.batch_timeout_ms = 60 * 1000
+    yield consumer
+    consumer.__init__()
+
+
+class TestConsumerBatching:
+    def test_buffers_until_batch_size(self, consumer):
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db"
+        ) as write_batch:
+            consumer.add_to_buffer(make_message(1, "a"))
+            consumer.add_to_buffer(make_message(2, "b"))
+            assert not consumer._flush_due()
+            consumer.add_to_buffer(make_message(1, "c"))
+            assert consumer._flush_due()
+            consumer.flush()
+
+        write_batch.assert_called_once()
+        buffer = write_batch.call_args[0][0]
+        assert [e["idempotency_id"] for e in buffer[1]] == ["a", "c"]
+        assert [e["idempotency_id"] for e in buffer[2]] == ["b"]
+        consumer._Consumer__connection.commit.assert_called_once()
+        assert consumer.buffer_size == 0
+
+    def test_skips_malformed_messages(self, consumer):
+        consumer.add_to_buffer(None)
+        consumer.add_to_buffer(Message(key="customer", value=None))
+        consumer.add_to_buffer(Message(key="customer", value={"event": {}}))
+        assert consumer.buffer_size == 0
+        assert len(consumer.dead_letters) == 1
+
+    def test_failed_batch_retries_individually_before_commit(self, consumer):
+        consumer.add_to_buffer(make_message(1, "a"))
+        consumer.add_to_buffer(make_message(1, "b"))
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db",
+            side_effect=[Exception("bad event"), None, None],
+        ) as write_batch:
+            consumer.flush()
+
+        assert write_batch.call_count == 3
+        consumer._Consumer__connection.commit.assert_called_once()
+
+    def test_unwritable_events_go_to_dead_letter_topic(self, consumer):
+        consumer.add_to_buffer(make_message(1, "a"))
+        consumer.add_to_buffer(make_message(1, "b"))
+        consumer.add_to_buffer(Message(key="customer", value={"event": {}}))
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db",
+            side_effect=[Exception("bad event"), None, Exception("bad event")],
+        ), mock.patch("metering_billing.kafka.consumer.Producer") as producer:
+            consumer.flush()
+
+        dead_letters = producer.return_value.produce_dead_letters.call_args[0][0]
+        assert [dl["event"] for dl in dead_letters] == [
+            None,
+            make_message(1, "b").value["event"],
+        ]
+        assert "bad event" in dead_letters[1]["error"]
+        consumer._Consumer__connection.commit.assert_called_once()
+        assert consumer.dead_letters == []
+
+    def test_stop_flushes_buffer_before_returning(self, consumer):
+        consumer.add_to_buffer(make_message(1, "a"))
+        consumer.stop()
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db"
+        ) as write_batch:
+            consumer.consume()
+
+        consumer._Consumer__connection.poll.assert_not_called()
+        write_batch.assert_called_once()
+        consumer._Consumer__connection.commit.assert_called_once()
+
+    def test_redelivered_events_are_dropped_before_the_database(self, consumer):
+        from django.core.cache.backends.locmem import LocMemCache
+
+        with mock.patch(
+            "metering_billing.kafka.dedupe.cache", LocMemCache("dedupe-test", {})
+        ), mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db"
+        ) as write_batch:
+            consumer.add_to_buffer(make_message(1, "a"))
+            consumer.add_to_buffer(make_message(1, "a"))
+            consumer.flush()
+            consumer.add_to_buffer(make_message(1, "a"))
+            consumer.add_to_buffer(make_message(1, "b"))
+            consumer.flush()
+
+        first_batch, second_batch = [c[0][0] for c in write_batch.call_args_list]
+        assert [e["idempotency_id"] for e in first_batch[1]] == ["a"]
+        assert [e["idempotency_id"] for e in second_batch[1]] == ["b"]
+        assert consumer._Consumer__connection.commit.call_count == 2
+
+    def test_revoked_partitions_flush_buffer(self, consumer):
+        from metering_billing.kafka.consumer import FlushOnRevokeListener
+
+        consumer.add_to_buffer(make_message(1, "a"))
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db"
+        ) as write_batch:
+            FlushOnRevokeListener(consumer).on_partitions_revoked(set())
+
+        write_batch.assert_called_once()
+        assert consumer.buffer_size == 0
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCopyEventWriter:
+    def test_copy_writer_applies_idempotency_rules(self, generate_org_and_api_key):
+        from metering_billing.kafka.consumer import copy_batch_events_to_db
+        from metering_billing.models import Event, IdempotenceCheck
+
+        org, _ = generate_org_and_api_key()
+        first = make_message(org.pk, "idem-1").value["event"]
+        duplicate = make_message(org.pk, "idem-1").value["event"]
+        second = make_message(org.pk, "idem-2").value["event"]
+        second["properties"] = {"quoted": 'a "value", with commas'}
+
+        inserted = copy_batch_events_to_db({org.pk: [first, duplicate, second]})
+        assert inserted == {org.pk: [first, second]}
+        assert copy_batch_events_to_db({org.pk: [first]}) == {}
+        # the guard table is partitioned on time_created, but a reused idempotency_id
+        # with a different time_created must still be rejected
+        retimed = {**first, "time_created": "2023-01-02T00:00:00+00:00"}
+        copy_batch_events_to_db({org.pk: [retimed]})
+
+        events = Event.objects.filter(organization=org)
+        assert events.count() == 2
+        assert events.get(idempotency_id="idem-2").properties == second["properties"]
+        assert IdempotenceCheck.objects.filter(organization=org).count() == 2
+
+    def test_insert_writer_applies_idempotency_rules(self, generate_org_and_api_key):
+        from metering_billing.kafka.consumer import insert_batch_events_to_db
+        from metering_billing.models import Event, IdempotenceCheck
+
+        org, _ = generate_org_and_api_key()
+        first = make_message(org.pk, "idem-1").value["event"]
+        retimed = {**first, "time_created": "2023-01-02T00:00:00+00:00"}
+
+        insert_batch_events_to_db({org.pk: [first, first]})
+        insert_batch_events_to_db({org.pk: [retimed]})
+
+        assert Event.objects.filter(organization=org).count() == 1
+        assert IdempotenceCheck.objects.filter(organization=org).count() == 1
+
+
+class TestDirectEventWriter:
+    def test_events_are_flushed_in_batches_on_shutdown(self):
+        from metering_billing.kafka.direct_ingest import DirectEventWriter
+
+        writer = object.__new__(DirectEventWriter)
+        writer.__init__()
+        with mock.patch(
+            "metering_billing.kafka.direct_ingest.write_batch_events_to_db"
+        ) as write_batch:
+            for idem in ["a", "b", "c"]:
+                writer.write(1, make_message(1, idem).value["event"])
+            writer.shutdown()
+
+        written = [
+            event["idempotency_id"]
+            for call in write_batch.call_args_list
+            for event in call[0][0][1]
+        ]
+        assert sorted(written) == ["a", "b", "c"]
+        assert not writer.thread.is_alive()
+
+    def test_full_queue_writes_synchronously(self):
+        from metering_billing.kafka.direct_ingest import DirectEventWriter
+
+        writer = object.__new__(DirectEventWriter)
+        writer.__init__()
+        with mock.patch(
+            "metering_billing.kafka.direct_ingest.write_batch_events_to_db"
+        ) as write_batch:
+            writer._ensure_started()
+            writer.stopping.set()
+            writer.write(1, make_message(1, "a").value["event"])
+            write_batch.assert_called_once()
+            writer.shutdown()
+
+    def test_events_that_cannot_be_written_are_logged(self):
+        from metering_billing.kafka.direct_ingest import DirectEventWriter
+
+        writer = object.__new__(DirectEventWriter)
+        writer.__init__()
+        good = make_message(1, "good").value["event"]
+        bad = make_message(1, "bad").value["event"]
+        with mock.patch(
+            "metering_billing.kafka.direct_ingest.write_batch_events_to_db",
+            side_effect=Exception("batch failed"),
+        ), mock.patch(
+            "metering_billing.kafka.direct_ingest.write_events_individually",
+            return_value=([(1, bad, Exception("bad event"))], {1: [good]}),
+        ), mock.patch(
+            "metering_billing.kafka.direct_ingest.logger"
+        ) as logger, mock.patch(
+            "metering_billing.kafka.direct_ingest.count_written_events"
+        ) as count_written_events:
+            writer._flush({1: [good, bad]})
+
+        logger.error.assert_called_once()
+        assert "idempotency_id=bad" in logger.error.call_args[0][0]
+        assert count_written_events.call_args[0][0] == {1: [good]}
+
+
+class TestUsageCounters:
+    now = datetime.datetime(2023, 1, 15, tzinfo=datetime.timezone.utc)
+    target = {
+        "start_date": "2023-01-01T00:00:00+00:00",
+        "end_date": "2023-01-31T23:59:59.999999+00:00",
+        "subscription_filters": [["region", "us"]],
+    }
+
+    def make_metric(self, **kwargs):
+        return {
+            "pk": 1,
+            "usage_aggregation_type": "sum",
+            "property_name": "tokens",
+            "numeric_filters": [],
+            "categorical_filters": [],
+            **kwargs,
+        }
+
+    def make_event(self, time_created="2023-01-10T00:00:00+00:00", **properties):
+        event = make_message(1, "a").value["event"]
+        return {**event, "time_created": time_created, "properties": properties}
+
+    def test_event_usage_follows_counter_query_rules(self):
+        from metering_billing.kafka.usage_counters import event_usage
+
+        metric = self.make_metric()
+        assert (
+            event_usage(
+                metric, self.target, self.make_event(region="us", tokens=3), self.now
+            )
+            == 3
+        )
+        assert (
+            event_usage(
+                metric, self.target, self.make_event(region="eu", tokens=3), self.now
+            )
+            == 0
+        )
+        assert (
+            event_usage(
+                metric, self.target, self.make_event(region="us", tokens="x"), self.now
+            )
+            == 0
+        )
+        assert (
+            event_usage(
+                metric,
+                self.target,
+                self.make_event("2023-01-20T00:00:00+00:00", region="us", tokens=3),
+                self.now,
+            )
+            == 0
+        )
+        assert (
+            event_usage(
+                metric,
+                self.target,
+                self.make_event("2022-12-31T00:00:00+00:00", region="us", tokens=3),
+                self.now,
+            )
+            == 0
+        )
+        assert (
+            event_usage(
+                self.make_metric(usage_aggregation_type="count"),
+                self.target,
+                self.make_event(region="us"),
+                self.now,
+            )
+            == 1
+        )
+
+    def test_event_usage_applies_metric_filters(self):
+        from metering_billing.kafka.usage_counters import event_usage
+
+        metric = self.make_metric(
+            numeric_filters=[("tokens", "gt", 2.0)],
+            categorical_filters=[("model", "isnotin", ["small"])],
+        )
+        assert (
+            event_usage(
+                metric,
+                self.target,
+                self.make_event(region="us", tokens=3, model="large"),
+                self.now,
+            )
+            == 3
+        )
+        assert (
+            event_usage(
+                metric,
+                self.target,
+                self.make_event(region="us", tokens=2, model="large"),
+                self.now,
+            )
+            == 0
+        )
+        assert (
+            event_usage(
+                metric,
+                self.target,
+                self.make_event(region="us", tokens=3, model="small"),
+                self.now,
+            )
+            == 0
+        )
+
+    def test_counters_are_corrected_by_the_difference(self):
+        from metering_billing.kafka import usage_counters
+
+        counted, expired = mock.Mock(pk=1), mock.Mock(pk=2)
+        metric = mock.Mock()
+        metric.get_billing_records_total_billable_usage.return_value = {
+            counted: Decimal(7),
+            expired: Decimal(3),
+        }
+        redis = mock.MagicMock()
+        redis.mget.return_value = [b"5", None]
+        redis.pipeline.return_value.execute.return_value = [True]
+        with mock.patch.object(
+            usage_counters, "get_redis_connection", return_value=redis
+        ), mock.patch.object(
+            usage_counters,
+            "usage_counter_key",
+            side_effect=lambda metric, billing_record: f"counter_{billing_record.pk}",
+        ), mock.patch.object(
+            usage_counters, "untrack_billing_records"
+        ) as untrack:
+            usage_counters.correct_usage_counters(metric, [counted, expired])
+
+        correct_counter = redis.register_script.return_value
+        correct_counter.assert_called_once_with(
+            keys=["counter_1"],
+            args=["2", usage_counters.REALTIME_USAGE_COUNTER_TTL_SECONDS],
+            client=redis.pipeline.return_value,
+        )
+        untrack.assert_called_once_with([2])
+
+    def test_only_written_events_are_counted(self, consumer):
+        consumer.add_to_buffer(make_message(1, "a"))
+        consumer.add_to_buffer(make_message(1, "b"))
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db",
+            side_effect=lambda buffer: _raise_for(buffer, ["b"]),
+        ), mock.patch("metering_billing.kafka.consumer.Producer"), mock.patch(
+            "metering_billing.kafka.consumer.count_written_events"
+        ) as count_written:
+            consumer.flush()
+
+        counted = count_written.call_args[0][0]
+        assert [e["idempotency_id"] for e in counted[1]] == ["a"]
+
+    def test_events_dropped_as_duplicates_are_not_counted(self, consumer):
+        consumer.add_to_buffer(make_message(1, "a"))
+        consumer.add_to_buffer(make_message(1, "b"))
+        # "a" got past the dedupe cache, but the database already had it
+        inserted = {1: [make_message(1, "b").value["event"]]}
+        with mock.patch(
+            "metering_billing.kafka.consumer.write_batch_events_to_db",
+            return_value=inserted,
+        ), mock.patch(
+            "metering_billing.kafka.consumer.count_written_events"
+        ) as count_written:
+            consumer.flush()
+
+        count_written.assert_called_once_with(inserted)
@@ -0,0 +1,82 @@
+import asyncio
+import unittest.mock as mock
+
+from kafka.errors import KafkaTimeoutError
+from kafka.future import Future
+from metering_billing.kafka.async_producer import AsyncProducer
+from metering_billing.kafka.producer import Producer
+
+
+def make_stream_events(idempotency_id):
+    return {
+        "organization_id": 1,
+        "event": {"idempotency_id": idempotency_id, "event_name": "test_event"},
+    }
+
+
+class TestProduceBatch:
+    def test_reports_undelivered_events(self):
+        delivered, failed, pending = Future(), Future(), Future()
+        delivered.success(None)
+        failed.failure(KafkaTimeoutError("broker unavailable"))
+
+        producer = object.__new__(Producer)
+        producer._Producer__connection = mock.MagicMock()
+        producer._Producer__connection.send.side_effect = [delivered, failed, pending]
+
+        failed_events = producer.produce_batch(
+            [
+                ("customer", make_stream_events("a")),
+                ("customer", make_stream_events("b")),
+                ("customer", make_stream_events("c")),
+            ]
+        )
+
+        assert producer._Producer__connection.send.call_count == 3
+        producer._Producer__connection.flush.assert_called_once()
+        assert set(failed_events) == {"b", "c"}
+        assert "broker unavailable" in failed_events["b"]
+
+    def test_flush_timeout_only_fails_undelivered_events(self):
+        delivered, pending = Future(), Future()
+        delivered.success(None)
+
+        producer = object.__new__(Producer)
+        producer._Producer__connection = mock.MagicMock()
+        producer._Producer__connection.send.side_effect = [delivered, pending]
+        producer._Producer__connection.flush.side_effect = KafkaTimeoutError(
+            "Timeout after waiting for 5 secs."
+        )
+
+        failed_events = producer.produce_batch(
+            [
+                ("customer", make_stream_events("a")),
+                ("customer", make_stream_events("b")),
+            ]
+        )
+
+        assert failed_events == {"b": "Timed out waiting for event delivery"}
+
+
+class TestAsyncProduceBatch:
+    def test_reports_undelivered_events(self):
+        async def produce():
+            loop = asyncio.get_running_loop()
+            delivered, failed = loop.create_future(), loop.create_future()
+            delivered.set_result(None)
+            failed.set_exception(KafkaTimeoutError("broker unavailable"))
+            connection = mock.MagicMock()
+            connection.send = mock.AsyncMock(side_effect=[delivered, failed])
+
+            producer = object.__new__(AsyncProducer)
+            producer.get_connection = mock.AsyncMock(return_value=connection)
+            return await producer.produce_batch(
+                [
+                    ("customer", make_stream_events("a")),
+                    ("customer", make_stream_events("b")),
+                ]
+            )
+
+        failed_events = asyncio.run(produce())
+        assert list(failed_events) == ["b"]
+        assert "broker unavailable" in failed_events["b"]
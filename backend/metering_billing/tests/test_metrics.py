@@ -1,18 +1,35 @@
+import datetime
 import itertools
 import json
+import re
 import unittest.mock as mock
+import uuid
 from decimal import Decimal
 
 import pytest
 from dateutil.relativedelta import relativedelta
+from django.db import connection
 from django.urls import reverse
 from model_bakery import baker
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from metering_billing.aggregation.billable_metrics import METRIC_HANDLER_MAP
+from metering_billing.aggregation.billable_metrics import (
+    METRIC_HANDLER_MAP,
+    CounterHandler,
+    MetricHandler,
+)
+from metering_billing.aggregation.counter_query_templates import (
+    COUNTER_CAGG_TOTAL,
+    COUNTER_CAGG_TOTAL_BATCH,
+    COUNTER_UNIQUE_TOTAL,
+)
+from metering_billing.aggregation.query_builder import BOUND_PARAMETERS, build_query
+from metering_billing.exceptions import MetricValidationFailed
 from metering_billing.models import (
+    BillingRecord,
     CategoricalFilter,
+    Customer,
     Event,
     Metric,
     NumericFilter,
@@ -380,6 +397,162 @@ class TestCalculateMetric:
         )
         assert metric_usage == 2
 
+    def test_batch_usage_matches_single_billing_record(
+        self, billable_metric_test_common_setup, add_subscription_record_to_org
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        unique_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.UNIQUE,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        sum_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="qty",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        rate_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="qty",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            billable_aggregation_type=METRIC_AGGREGATION.MAX,
+            metric_type=METRIC_TYPE.RATE,
+            granularity=METRIC_GRANULARITY.HOUR,
+        )
+        for metric in [unique_metric, sum_metric, rate_metric]:
+            METRIC_HANDLER_MAP[metric.metric_type].create_continuous_aggregate(metric)
+        now = now_utc()
+        customers = [
+            setup_dict["customer"],
+            Customer.objects.create(
+                organization=setup_dict["org"],
+                customer_name="test_customer_2",
+                customer_id="test_customer_2",
+            ),
+        ]
+        for i, customer in enumerate(customers):
+            baker.make(
+                Event,
+                event_name="test_event",
+                properties=itertools.cycle(
+                    [{"test_property": f"foo_{j}", "qty": 2} for j in range(i + 2)]
+                ),
+                organization=setup_dict["org"],
+                time_created=now - relativedelta(days=3),
+                cust_id=customer.customer_id,
+                _quantity=5,
+            )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        for metric in [unique_metric, sum_metric, rate_metric]:
+            PlanComponent.objects.create(
+                billable_metric=metric,
+                plan_version=billing_plan,
+            )
+        with (
+            mock.patch(
+                "metering_billing.models.now_utc",
+                return_value=now - relativedelta(days=5),
+            ),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc",
+                return_value=now - relativedelta(days=5),
+            ),
+        ):
+            for customer in customers:
+                add_subscription_record_to_org(
+                    setup_dict["org"],
+                    billing_plan,
+                    customer,
+                    now - relativedelta(days=5),
+                )
+        for metric, expected in [
+            (unique_metric, [2, 3]),
+            (sum_metric, [10, 10]),
+            (rate_metric, [10, 10]),
+        ]:
+            billing_records = [
+                BillingRecord.objects.get(
+                    component__billable_metric=metric, customer=customer
+                )
+                for customer in customers
+            ]
+            batch_usage = metric.get_billing_records_total_billable_usage(
+                billing_records
+            )
+            assert [batch_usage[br] for br in billing_records] == expected
+            for billing_record in billing_records:
+                assert batch_usage[
+                    billing_record
+                ] == metric.get_billing_record_total_billable_usage(billing_record)
+
+    def test_daily_usage_many_matches_single_metric(
+        self, billable_metric_test_common_setup
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="api_key",
+            user_org_and_api_key_org_different=False,
+        )
+        metrics = [
+            Metric.objects.create(
+                organization=setup_dict["org"],
+                event_name="rows_inserted",
+                property_name="num_rows",
+                usage_aggregation_type=aggregation,
+                metric_type=METRIC_TYPE.COUNTER,
+            )
+            for aggregation in [METRIC_AGGREGATION.SUM, METRIC_AGGREGATION.MAX]
+        ] + [
+            Metric.objects.create(
+                organization=setup_dict["org"],
+                event_name="rows_inserted",
+                property_name="num_rows",
+                usage_aggregation_type=METRIC_AGGREGATION.SUM,
+                billable_aggregation_type=METRIC_AGGREGATION.MAX,
+                metric_type=METRIC_TYPE.RATE,
+                granularity=METRIC_GRANULARITY.HOUR,
+            )
+        ]
+        for metric in metrics:
+            METRIC_HANDLER_MAP[metric.metric_type].create_continuous_aggregate(metric)
+        time_created = now_utc() - relativedelta(days=3)
+        baker.make(
+            Event,
+            event_name="rows_inserted",
+            properties=iter([{"num_rows": i} for i in range(1, 7)]),
+            organization=setup_dict["org"],
+            time_created=iter(
+                [time_created + relativedelta(days=i // 2) for i in range(6)]
+            ),
+            cust_id=setup_dict["customer"].customer_id,
+            _quantity=6,
+        )
+        start_date = now_utc() - relativedelta(days=5)
+        end_date = now_utc()
+
+        usage_by_metric = MetricHandler.get_daily_total_usage_many(
+            metrics, start_date, end_date
+        )
+
+        assert set(usage_by_metric) == set(metrics)
+        for metric in metrics:
+            assert usage_by_metric[metric] == metric.get_daily_total_usage(
+                start_date, end_date
+            )
+        assert usage_by_metric[metrics[0]] != {}
+
     def test_gauge_total_granularity(
         self, billable_metric_test_common_setup, add_subscription_record_to_org
     ):
@@ -664,6 +837,64 @@ class TestCalculateMetric:
         # 1 dollar per for 64 rows - 3 free rows = 61 rows * 1 dollar = 61 dollars
         assert usage_revenue_dict["revenue"] == Decimal(61)
 
+    def test_rate_current_usage_window(
+        self, billable_metric_test_common_setup, add_subscription_record_to_org
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="api_key",
+            user_org_and_api_key_org_different=False,
+        )
+        customer = setup_dict["customer"]
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        subscription_record = add_subscription_record_to_org(
+            setup_dict["org"], billing_plan, customer, now_utc() - relativedelta(days=1)
+        )
+        billing_record = subscription_record.billing_records.first()
+        now = now_utc()
+        # only the events of the last hour count, whole minutes of it are read from
+        # the minute buckets and the current minute from the events
+        baker.make(
+            Event,
+            event_name="rows_inserted",
+            properties=iter([{"num_rows": 7}, {"num_rows": 3}, {"num_rows": 2}]),
+            organization=setup_dict["org"],
+            time_created=iter(
+                [
+                    now - relativedelta(hours=2),
+                    now - relativedelta(minutes=30),
+                    now - relativedelta(seconds=1),
+                ]
+            ),
+            cust_id=customer.customer_id,
+            _quantity=3,
+        )
+        for aggregation, expected in [
+            (METRIC_AGGREGATION.SUM, Decimal(5)),
+            (METRIC_AGGREGATION.AVERAGE, Decimal("2.5")),
+            (METRIC_AGGREGATION.MAX, Decimal(3)),
+            (METRIC_AGGREGATION.COUNT, Decimal(2)),
+        ]:
+            billable_metric = Metric.objects.create(
+                organization=setup_dict["org"],
+                event_name="rows_inserted",
+                property_name="num_rows",
+                usage_aggregation_type=aggregation,
+                billable_aggregation_type=METRIC_AGGREGATION.MAX,
+                metric_type=METRIC_TYPE.RATE,
+                granularity=METRIC_GRANULARITY.HOUR,
+            )
+            handler = METRIC_HANDLER_MAP[billable_metric.metric_type]
+            handler.create_continuous_aggregate(billable_metric)
+            usage = handler.get_billing_record_current_usage(
+                billable_metric, billing_record
+            )
+            assert usage == expected
+            handler.archive_metric(billable_metric)
+
     def test_gauge_daily_granularity_delta_event(
         self, billable_metric_test_common_setup, add_subscription_record_to_org
     ):
@@ -2335,3 +2566,483 @@ class TestRegressions:
         assert usage_revenue_dict["revenue"] <= Decimal(8700) / (
             Decimal(60) * Decimal(24) * Decimal(28)
         ) * Decimal(100)
+
+
+class TestBuildQuery:
+    def injection_dict(self, customer_id, filter_value):
+        return {
+            "query_type": METRIC_AGGREGATION.SUM,
+            "filter_properties": {"region": [filter_value]},
+            "uuidv5_customer_id": customer_id,
+            "group_by": ["region"],
+            "cagg_name": "test_cagg",
+            "start_date": now_utc() - relativedelta(days=1),
+            "end_date": now_utc(),
+        }
+
+    def test_values_are_bound_not_rendered(self):
+        customer_id = uuid.uuid4()
+        query, params = build_query(
+            COUNTER_CAGG_TOTAL, **self.injection_dict(customer_id, "o'hare")
+        )
+        assert str(customer_id) not in query
+        assert "o'hare" not in query
+        assert "%(uuidv5_customer_id)s" in query
+        assert "%(filter_region)s" in query
+        assert params["uuidv5_customer_id"] == customer_id
+        assert params["filter_region"] == ["o'hare"]
+
+    def test_same_shape_reuses_rendered_query(self):
+        query_1, params_1 = build_query(
+            COUNTER_CAGG_TOTAL, **self.injection_dict(uuid.uuid4(), "eu")
+        )
+        query_2, params_2 = build_query(
+            COUNTER_CAGG_TOTAL, **self.injection_dict(uuid.uuid4(), "us")
+        )
+        assert query_1 is query_2
+        assert params_1 != params_2
+
+    def test_metric_filter_values_are_bound(self):
+        injection_dict = {
+            "query_type": METRIC_AGGREGATION.UNIQUE,
+            "filter_properties": {},
+            "group_by": [],
+            "property_name": "user_id",
+            "uuidv5_event_name": uuid.uuid4(),
+            "organization_id": 1,
+            "uuidv5_customer_id": uuid.uuid4(),
+            "start_date": now_utc() - relativedelta(days=1),
+            "end_date": now_utc(),
+            "numeric_filters": [("discount%", "gt", 5)],
+            "categorical_filters": [("plan", "isnotin", ["50%", "o'hare"])],
+        }
+        query, params = build_query(
+            COUNTER_UNIQUE_TOTAL, param_prefix="metric_0_", **injection_dict
+        )
+        assert "o'hare" not in query
+        assert "'discount%%'" in query
+        assert "%(metric_0_categorical_filter_0)s" in query
+        assert "%(metric_0_numeric_filter_0)s" in query
+        assert params["metric_0_categorical_filter_0"] == ["50%", "o'hare"]
+        assert params["metric_0_numeric_filter_0"] == 5
+
+    def test_billing_record_windows_are_bound_as_arrays(self):
+        customer_ids = [uuid.uuid4(), uuid.uuid4()]
+        windows = [
+            {
+                "record_idx": record_idx,
+                "window_kind": "events",
+                "uuidv5_customer_id": customer_id,
+                "start_date": now_utc() - relativedelta(days=1),
+                "end_date": now_utc(),
+                "filter_values": [filter_value],
+            }
+            for record_idx, (customer_id, filter_value) in enumerate(
+                zip(customer_ids, ["o'hare", None])
+            )
+        ]
+        query, params = build_query(
+            COUNTER_CAGG_TOTAL_BATCH,
+            group_by=["region"],
+            cagg_prefix="test_cagg___",
+            property_name="qty",
+            uuidv5_event_name=uuid.uuid4(),
+            organization_id=1,
+            numeric_filters=[],
+            categorical_filters=[],
+            windows=windows,
+            window_kinds=["events"],
+        )
+        assert "o'hare" not in query
+        assert str(customer_ids[0]) not in query
+        assert "%(window_filter_0)s::text[]" in query
+        assert params["window_record_idx"] == [0, 1]
+        assert params["window_uuidv5_customer_id"] == customer_ids
+        assert params["window_filter_0"] == ["o'hare", None]
+
+    def test_prefixed_queries_can_be_combined(self):
+        customer_id = uuid.uuid4()
+        statement = []
+        params = {}
+        for metric_idx, filter_value in enumerate(["eu", "us"]):
+            query, metric_params = build_query(
+                COUNTER_CAGG_TOTAL,
+                param_prefix=f"metric_{metric_idx}_",
+                **self.injection_dict(customer_id, filter_value),
+            )
+            assert not (set(metric_params) - BOUND_PARAMETERS) & set(params)
+            params.update(metric_params)
+            statement.append(query)
+        statement = "\nUNION ALL\n".join(statement)
+        assert set(re.findall(r"%\((\w+)\)s", statement)) == set(params)
+        assert "%(metric_0_filter_region)s" in statement
+        assert "%(metric_1_filter_region)s" in statement
+        assert params["metric_0_filter_region"] == ["eu"]
+        assert params["metric_1_filter_region"] == ["us"]
+
+
+class TestApproximateUniqueHelpers:
+    def test_hll_buckets_for_error(self):
+        assert CounterHandler._hll_buckets(Decimal("0.01")) == 2**14
+        assert CounterHandler._hll_buckets(Decimal("0.26")) == 2**4
+        with pytest.raises(MetricValidationFailed):
+            CounterHandler._hll_buckets(Decimal("0.001"))
+
+    def test_sketch_window_is_whole_hours(self):
+        start = datetime.datetime(2023, 1, 1, 10, 30, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(
+            2023, 1, 31, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc
+        )
+        sketch_start, sketch_end = CounterHandler._split_into_sketch_window(start, end)
+        assert sketch_start == start.replace(hour=11, minute=0)
+        assert sketch_end == datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc)
+
+    def test_sketch_window_empty_inside_an_hour(self):
+        start = datetime.datetime(2023, 1, 1, 10, 10, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(2023, 1, 1, 10, 50, tzinfo=datetime.timezone.utc)
+        assert CounterHandler._split_into_sketch_window(start, end) == (end, end)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestApproximateUnique:
+    def test_approximate_count_unique(
+        self, billable_metric_test_common_setup, add_subscription_record_to_org
+    ):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'timescaledb_toolkit'"
+            )
+            if cursor.fetchone() is None:
+                pytest.skip("timescaledb_toolkit is not available")
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="session_auth",
+            user_org_and_api_key_org_different=False,
+        )
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            property_name="test_property",
+            event_name="test_event",
+            usage_aggregation_type=METRIC_AGGREGATION.UNIQUE,
+            metric_type=METRIC_TYPE.COUNTER,
+            approximate_unique_error=Decimal("0.01"),
+        )
+        METRIC_HANDLER_MAP[billable_metric.metric_type].create_continuous_aggregate(
+            billable_metric
+        )
+        now = now_utc()
+        customer = setup_dict["customer"]
+        # some events in whole hours, some in the partial hour at the end of the period
+        for time_created in [now - relativedelta(days=1), now]:
+            baker.make(
+                Event,
+                event_name="test_event",
+                properties=itertools.cycle(
+                    [{"test_property": f"user_{i}"} for i in range(500)]
+                ),
+                organization=setup_dict["org"],
+                time_created=time_created,
+                cust_id=customer.customer_id,
+                _quantity=1000,
+            )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        with (
+            mock.patch(
+                "metering_billing.models.now_utc",
+                return_value=now - relativedelta(days=2),
+            ),
+            mock.patch(
+                "metering_billing.tests.test_metrics.now_utc",
+                return_value=now - relativedelta(days=2),
+            ),
+        ):
+            subscription_record = add_subscription_record_to_org(
+                setup_dict["org"],
+                billing_plan,
+                customer,
+                now - relativedelta(days=2),
+            )
+        metric_usage = billable_metric.get_billing_record_total_billable_usage(
+            subscription_record.billing_records.first()
+        )
+        assert abs(metric_usage - 500) <= 500 * 0.03
+
+
+class TestSplitIntoCaggWindows:
+    def test_whole_month_is_read_from_days(self):
+        start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(
+            2023, 1, 31, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc
+        )
+        assert CounterHandler._split_into_cagg_windows(start, end) == [
+            ("day", start, datetime.datetime(2023, 2, 1, tzinfo=datetime.timezone.utc))
+        ]
+
+    def test_partial_days_use_hours_then_leftover_tier(self):
+        start = datetime.datetime(2023, 1, 1, 10, 30, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(2023, 1, 3, 4, 20, tzinfo=datetime.timezone.utc)
+        windows = CounterHandler._split_into_cagg_windows(
+            start, end, per_second_aggregate=False
+        )
+        assert [tier for tier, _, _ in windows] == [
+            "events",
+            "hour",
+            "day",
+            "hour",
+            "events",
+        ]
+        # the windows cover the period without gaps or overlaps
+        assert windows[0][1] == start
+        assert windows[-1][2] == end + relativedelta(microseconds=1)
+        for (_, _, prev_end), (_, next_start, _) in zip(windows, windows[1:]):
+            assert prev_end == next_start
+
+
+class TestUsageCache:
+    @pytest.fixture
+    def usage_cache(self):
+        from django.core.cache.backends.locmem import LocMemCache
+
+        from metering_billing.aggregation import usage_cache
+
+        with mock.patch.object(
+            usage_cache, "cache", LocMemCache("usage-cache-test", {})
+        ), mock.patch.object(usage_cache, "USAGE_CACHE_TTL_SECONDS", 60):
+            yield usage_cache
+
+    def make_billing_record(self, customer_id):
+        return mock.Mock(
+            customer=mock.Mock(uuidv5_customer_id=None, customer_id=customer_id),
+            subscription=mock.Mock(subscription_filters=[["region", "us"]]),
+            start_date=now_utc() - relativedelta(days=1),
+            end_date=now_utc() + relativedelta(days=1),
+        )
+
+    def test_new_events_invalidate_only_their_customer(self, usage_cache):
+        metric = mock.Mock(
+            pk=1,
+            organization_id=1,
+            event_name="test_event",
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        record_1 = self.make_billing_record("customer_1")
+        record_2 = self.make_billing_record("customer_2")
+        compute = mock.Mock(
+            side_effect=lambda records: {r: Decimal(1) for r in records}
+        )
+
+        usage_cache.cached_usage_many("total", metric, [record_1, record_2], compute)
+        usage_cache.cached_usage_many("total", metric, [record_1, record_2], compute)
+        assert compute.call_count == 1
+
+        usage_cache.bump_usage_watermarks(
+            {1: [{"customer_id": "customer_1", "event_name": "test_event"}]}
+        )
+        usage_cache.cached_usage_many("total", metric, [record_1, record_2], compute)
+        assert compute.call_count == 2
+        assert compute.call_args[0][0] == [record_1]
+
+    def test_ongoing_gauge_usage_is_not_cached(self, usage_cache):
+        metric = mock.Mock(
+            pk=1,
+            organization_id=1,
+            event_name="test_event",
+            metric_type=METRIC_TYPE.GAUGE,
+        )
+        record = self.make_billing_record("customer_1")
+        compute = mock.Mock(return_value=Decimal(1))
+
+        usage_cache.cached_usage("total", metric, record, compute)
+        usage_cache.cached_usage("total", metric, record, compute)
+        assert compute.call_count == 2
+
+    def test_bypassed_cache_is_not_read(self, usage_cache):
+        metric = mock.Mock(
+            pk=1,
+            organization_id=1,
+            event_name="test_event",
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+        record = self.make_billing_record("customer_1")
+        compute = mock.Mock(return_value=Decimal(1))
+
+        usage_cache.cached_usage("total", metric, record, compute)
+        with usage_cache.bypass_usage_cache():
+            usage_cache.cached_usage("total", metric, record, compute)
+        assert compute.call_count == 2
+        usage_cache.cached_usage("total", metric, record, compute)
+        assert compute.call_count == 2
+
+
+@pytest.mark.django_db(transaction=True)
+class TestGaugeIncrementalState:
+    def test_current_usage_matches_event_history(
+        self, billable_metric_test_common_setup, add_subscription_record_to_org
+    ):
+        from metering_billing.aggregation.billable_metrics import GaugeHandler
+
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="api_key",
+            user_org_and_api_key_org_different=False,
+        )
+        customer = setup_dict["customer"]
+        billable_metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            event_name="storage_change",
+            property_name="delta",
+            usage_aggregation_type=METRIC_AGGREGATION.MAX,
+            metric_type=METRIC_TYPE.GAUGE,
+            granularity=METRIC_GRANULARITY.MONTH,
+            event_type=EVENT_TYPE.DELTA,
+            incremental_state=True,
+        )
+        METRIC_HANDLER_MAP[billable_metric.metric_type].create_continuous_aggregate(
+            billable_metric
+        )
+        billing_plan = PlanVersion.objects.create(
+            organization=setup_dict["org"],
+            plan=setup_dict["plan"],
+        )
+        PlanComponent.objects.create(
+            billable_metric=billable_metric,
+            plan_version=billing_plan,
+        )
+        subscription_record = add_subscription_record_to_org(
+            setup_dict["org"], billing_plan, customer, now_utc() - relativedelta(days=3)
+        )
+        billing_record = subscription_record.billing_records.first()
+
+        def add_events(time_created, deltas):
+            baker.make(
+                Event,
+                event_name="storage_change",
+                properties=iter([{"delta": delta} for delta in deltas]),
+                organization=setup_dict["org"],
+                time_created=time_created,
+                cust_id=customer.customer_id,
+                _quantity=len(deltas),
+            )
+
+        # before the checkpoint, read from the state once it is advanced
+        add_events(now_utc() - relativedelta(days=2), [5, 5, 2])
+        GaugeHandler.advance_state_checkpoint(billable_metric)
+        assert billable_metric.gauge_states.get().usage_qty == Decimal(12)
+        # late events are added to the state by the trigger, newer ones are read from
+        # the event table
+        add_events(now_utc() - relativedelta(days=1), [-4])
+        add_events(now_utc() - relativedelta(minutes=1), [3])
+        assert billable_metric.gauge_states.get().usage_qty == Decimal(8)
+        usage = GaugeHandler.get_billing_record_current_usage(
+            billable_metric, billing_record
+        )
+        assert usage == Decimal(11)
+
+        GaugeHandler.advance_state_checkpoint(billable_metric)
+        assert billable_metric.gauge_states.get().usage_qty == Decimal(11)
+        assert (
+            GaugeHandler.get_billing_record_current_usage(
+                billable_metric, billing_record
+            )
+            == usage
+        )
+
+
+@pytest.mark.django_db(transaction=True)
+class TestPropertyIndexes:
+    @pytest.fixture(autouse=True)
+    def sync_indexes_inline(self):
+        from metering_billing.aggregation import billable_metrics
+        from metering_billing.tasks import sync_metric_property_indexes
+
+        with mock.patch.object(
+            billable_metrics, "EVENT_PROPERTY_INDEXES", True
+        ), mock.patch.object(
+            sync_metric_property_indexes,
+            "delay",
+            side_effect=sync_metric_property_indexes,
+        ):
+            yield
+
+    def event_indexes(self, metric):
+        prefix = MetricHandler._property_index_prefix(
+            metric.organization, metric.event_name
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname, indexdef FROM pg_indexes WHERE left(indexname, %s) = %s",
+                [len(prefix), prefix],
+            )
+            return dict(cursor.fetchall())
+
+    def test_metrics_share_index_until_archived(
+        self, billable_metric_test_common_setup
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="api_key",
+            user_org_and_api_key_org_different=False,
+        )
+        setup_dict["org"].subscription_filter_keys = ["region"]
+        setup_dict["org"].save()
+        metrics = [
+            Metric.objects.create(
+                organization=setup_dict["org"],
+                event_name="api_call",
+                property_name="latency",
+                usage_aggregation_type=aggregation,
+                metric_type=METRIC_TYPE.COUNTER,
+            )
+            for aggregation in [METRIC_AGGREGATION.SUM, METRIC_AGGREGATION.MAX]
+        ]
+        for metric in metrics:
+            METRIC_HANDLER_MAP[metric.metric_type].create_continuous_aggregate(metric)
+
+        indexes = self.event_indexes(metrics[0])
+        assert len(indexes) == 1
+        assert "(properties ->> 'region'::text)" in list(indexes.values())[0]
+
+        METRIC_HANDLER_MAP[metrics[0].metric_type].archive_metric(metrics[0])
+        metrics[0].status = METRIC_STATUS.ARCHIVED
+        metrics[0].save()
+        assert len(self.event_indexes(metrics[0])) == 1
+
+        metrics[1].status = METRIC_STATUS.ARCHIVED
+        metrics[1].save()
+        METRIC_HANDLER_MAP[metrics[1].metric_type].archive_metric(metrics[1])
+        assert self.event_indexes(metrics[1]) == {}
+
+    def test_property_names_are_quoted_in_index(
+        self, billable_metric_test_common_setup
+    ):
+        setup_dict = billable_metric_test_common_setup(
+            num_billable_metrics=0,
+            auth_method="api_key",
+            user_org_and_api_key_org_different=False,
+        )
+        property_name = "region'); DROP TABLE metering_billing_metric; --"
+        setup_dict["org"].subscription_filter_keys = [property_name]
+        setup_dict["org"].save()
+        metric = Metric.objects.create(
+            organization=setup_dict["org"],
+            event_name="api_call",
+            property_name="latency",
+            usage_aggregation_type=METRIC_AGGREGATION.SUM,
+            metric_type=METRIC_TYPE.COUNTER,
+        )
+
+        MetricHandler.sync_property_indexes(metric)
+        indexes = self.event_indexes(metric)
+        assert len(indexes) == 1
+        assert (
+            "(properties ->> 'region''); DROP TABLE metering_billing_metric; --'::text)"
+            in list(indexes.values())[0]
+        )
+        assert Metric.objects.filter(pk=metric.pk).exists()
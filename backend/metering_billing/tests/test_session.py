@@ -1,8 +1,19 @@
+import unittest.mock as mock
+
 import pytest
-from django.urls import reverse
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient
+from django.urls import path, reverse
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from api.views import track_event_async
+from metering_billing.utils import now_utc
+
+urlpatterns = [
+    path("api/track/", track_event_async, name="track_event"),
+]
+
 
 @pytest.mark.django_db
 class TestSession:
@@ -22,3 +33,51 @@ class TestSession:
             content_type="application/json",
         )
         assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.django_db
+class TestTrackEventAsync:
+    """Testing track_event_async through Django's ASGI handler, routed the way lotus.urls
+    routes /api/track/ when it's served by lotus.asgi."""
+
+    @pytest.fixture(autouse=True)
+    def route_track_event_async(self, settings):
+        settings.ROOT_URLCONF = __name__
+
+    def test_track_event_async_is_served_as_async_view(self, generate_org_and_api_key):
+        _, key = generate_org_and_api_key()
+        client = AsyncClient()
+        payload = {
+            "batch": [
+                {
+                    "event_name": "test_event",
+                    "idempotency_id": "async-test-event",
+                    "customer_id": "test-customer",
+                    "time_created": now_utc().isoformat(),
+                }
+            ]
+        }
+
+        with mock.patch("api.views.async_kafka_producer") as async_kafka_producer:
+            async_kafka_producer.produce_batch = mock.AsyncMock(return_value={})
+            response = async_to_sync(client.post)(
+                reverse("track_event"),
+                data=payload,
+                content_type="application/json",
+                # AsyncClient in Django 4.0 passes extra kwargs through as headers
+                **{"X-API-KEY": key},
+            )
+
+        assert response.status_code == status.HTTP_201_CREATED
+        assert response.json() == {"success": "all"}
+        async_kafka_producer.produce_batch.assert_awaited_once()
+
+    def test_track_event_async_only_accepts_post(self, generate_org_and_api_key):
+        _, key = generate_org_and_api_key()
+        client = AsyncClient()
+
+        response = async_to_sync(client.get)(
+            reverse("track_event"), **{"X-API-KEY": key}
+        )
+
+        assert response.status_code == status.HTTP_405_METHOD_NOT_ALLOWED
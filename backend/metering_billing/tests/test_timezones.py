@@ -361,3 +361,24 @@ class TestTimezones:
             end_date.replace(tzinfo=None)
         )
         assert start_date.utcoffset() != end_date.utcoffset()
+
+
+class TestParseEventTimestamp:
+    @pytest.mark.parametrize(
+        "value",
+        [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T00:00:00.123456789+05:30",
+            "2023-01-01T00:00:00-0800",
+            "2023-01-01 10:00:00",
+            "2023-01-01T00:00:00.5",
+            "Jan 1 2023 10am",
+        ],
+    )
+    def test_matches_dateutil(self, value):
+        from metering_billing.utils import parse_event_timestamp
+
+        expected = dateutil.parser.parse(value)
+        if expected.tzinfo is None:
+            expected = expected.replace(tzinfo=pytz.UTC)
+        assert parse_event_timestamp(value) == expected
@@ -1,6 +1,7 @@
 import collections
 import datetime
 import json
+import re
 import uuid
 from collections import OrderedDict, namedtuple
 from collections.abc import MutableMapping, MutableSequence
@@ -83,6 +84,55 @@ def convert_to_datetime(value, date_behavior="min", tz=pytz.UTC):
         raise ServerError(f"can't convert type {type(value)} into date")
 
 
+RFC3339_REGEX = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?"
+    r"(?:([Zz])|([+-])(\d{2}):?(\d{2}))?"
+)
+
+
+def parse_event_timestamp(value):
+    """Parse an event timestamp into an aware datetime, treating naive ones as UTC.
+
+    The RFC3339 / ISO 8601 formats SDKs send (`Z` or `+hh:mm` offsets, up to nanosecond
+    fractions) are parsed with a regex, anything else falls back to dateutil."""
+    match = RFC3339_REGEX.fullmatch(value)
+    if match is None:
+        dt = parser.parse(value)
+        if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+            dt = dt.replace(tzinfo=pytz.UTC)
+        return dt
+    (
+        year,
+        month,
+        day,
+        hour,
+        minute,
+        second,
+        fraction,
+        zulu,
+        sign,
+        offset_hours,
+        offset_minutes,
+    ) = match.groups()
+    if sign is None:
+        tz = pytz.UTC
+    else:
+        offset = datetime.timedelta(
+            hours=int(offset_hours), minutes=int(offset_minutes)
+        )
+        tz = datetime.timezone(-offset if sign == "-" else offset)
+    return datetime.datetime(
+        int(year),
+        int(month),
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        int(fraction[:6].ljust(6, "0")) if fraction else 0,
+        tzinfo=tz,
+    )
+
+
 def make_all_decimals_floats(data):
     if isinstance(data, list):
         return [make_all_decimals_floats(x) for x in data]
@@ -5,6 +5,7 @@ import pytz
 from django.conf import settings
 from django.db.models import Count, F, Q, Sum
 from drf_spectacular.utils import extend_schema, inline_serializer
+from metering_billing.aggregation.billable_metrics import MetricHandler
 from metering_billing.exceptions import (
     ExternalConnectionFailure,
     ExternalConnectionInvalid,
@@ -242,12 +243,12 @@ class PeriodMetricUsageView(APIView):
         final_results = {}
         metrics = organization.metrics.filter(
             ~Q(metric_type=METRIC_TYPE.CUSTOM), status=METRIC_STATUS.ACTIVE
+        ).prefetch_related("numeric_filters", "categorical_filters")
+        usage_by_metric = MetricHandler.get_daily_total_usage_many(
+            metrics, start_date=q_start, end_date=q_end, customer=None, top_n=top_n
         )
-        for metric in metrics:
+        for metric, per_customer_usage in usage_by_metric.items():
             metric_dict = {}
-            per_customer_usage = metric.get_daily_total_usage(
-                start_date=q_start, end_date=q_end, customer=None, top_n=top_n
-            )
             for customer, customer_dict in per_customer_usage.items():
                 for date, usage in customer_dict.items():
                     if date not in metric_dict: